@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import datetime
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+
+from coba import FileQueue  # noqa: E402
+from coba.cas import COMPRESSION_MODES  # noqa: E402
+from coba.store import Store  # noqa: E402
+from coba.utils import parse_file_size  # noqa: E402
+
+
+# Version of the format of the result files
+FORMAT_VERSION = 1
+
+BENCHMARKS = ['ingest', 'history', 'queries', 'restore', 'queue']
+
+# Number of files per directory in the synthetic tree
+FILES_PER_DIRECTORY = 100
+
+# Number of bytes that are changed in a file to create a new version
+CHANGE_SIZE = 64
+
+
+def _percentile(sorted_values, fraction):
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def _latencies(values):
+    '''
+    Summarize a list of latencies in seconds.
+    '''
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': _percentile(values, 0.5),
+        'p95': _percentile(values, 0.95),
+        'p99': _percentile(values, 0.99),
+        'max': values[-1],
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=str(HERE),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class _Tree:
+    '''
+    A synthetic directory tree with files of random content.
+    '''
+    def __init__(self, root, num_files, file_size, rng):
+        self.root = root
+        self.file_size = file_size
+        self._rng = rng
+        # Explicit modification times make sure that every change is
+        # detected, even on file systems with coarse timestamps
+        self._mtime_ns = int(time.time() * 10**9)
+        self.paths = []
+        for i in range(num_files):
+            directory = root / 'd{:04d}'.format(i // FILES_PER_DIRECTORY)
+            directory.mkdir(parents=True, exist_ok=True)
+            path = directory / 'f{:06d}.bin'.format(i)
+            path.write_bytes(self._random_bytes(file_size))
+            self._touch(path)
+            self.paths.append(path)
+
+    def _random_bytes(self, size):
+        return bytes(self._rng.getrandbits(8) for _ in range(size))
+
+    def _touch(self, path):
+        self._mtime_ns += 10**6
+        os.utime(str(path), ns=(self._mtime_ns, self._mtime_ns))
+
+    def modify(self, path):
+        '''
+        Overwrite a random part of a file.
+        '''
+        size = min(CHANGE_SIZE, self.file_size)
+        with path.open('r+b') as f:
+            f.seek(self._rng.randrange(self.file_size - size + 1))
+            f.write(self._random_bytes(size))
+        self._touch(path)
+
+
+def _put_in_batches(store, paths, batch_size):
+    for i in range(0, len(paths), batch_size):
+        store.put_many(paths[i:i + batch_size])
+
+
+def _benchmark_ingest(store, tree, params):
+    '''
+    Store the first version of every file.
+    '''
+    start = time.perf_counter()
+    _put_in_batches(store, tree.paths, params['batch_size'])
+    duration = time.perf_counter() - start
+    num_bytes = len(tree.paths) * tree.file_size
+    return {
+        'duration': duration,
+        'files_per_second': len(tree.paths) / duration,
+        'bytes_per_second': num_bytes / duration,
+    }
+
+
+def _benchmark_history(store, tree, params):
+    '''
+    Store further versions of every file.
+    '''
+    duration = 0
+    num_versions = 0
+    for _ in range(params['versions'] - 1):
+        for path in tree.paths:
+            tree.modify(path)
+        start = time.perf_counter()
+        _put_in_batches(store, tree.paths, params['batch_size'])
+        duration += time.perf_counter() - start
+        num_versions += len(tree.paths)
+    if not num_versions:
+        return {'duration': 0, 'versions_per_second': None}
+    return {
+        'duration': duration,
+        'versions_per_second': num_versions / duration,
+    }
+
+
+def _benchmark_queries(store, tree, params, rng):
+    '''
+    Look up versions of random files.
+    '''
+    versions = list(store.get_versions(tree.paths[0]))
+    first = versions[0].stored_at
+    last = versions[-1].stored_at
+    span = (last - first).total_seconds()
+    version_at = []
+    all_versions = []
+    for _ in range(params['queries']):
+        path = rng.choice(tree.paths)
+        at = first + datetime.timedelta(seconds=rng.uniform(0, span))
+        start = time.perf_counter()
+        store.get_version_at(path, at)
+        version_at.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        list(store.get_versions(path))
+        all_versions.append(time.perf_counter() - start)
+    return {
+        'get_version_at': _latencies(version_at),
+        'get_versions': _latencies(all_versions),
+    }
+
+
+def _benchmark_restore(store, tree, params, target):
+    '''
+    Restore the latest versions of the whole tree.
+    '''
+    at = datetime.datetime.utcnow()
+    start = time.perf_counter()
+    restored = store.restore_tree(tree.root, at, target=target)
+    duration = time.perf_counter() - start
+    return {
+        'duration': duration,
+        'files_per_second': len(restored) / duration,
+        'bytes_per_second': len(restored) * tree.file_size / duration,
+    }
+
+
+def _benchmark_queue(tree, params, rng):
+    '''
+    Register modification events and drain the queue.
+    '''
+    queue = FileQueue(idle_wait=0)
+    paths = [rng.choice(tree.paths) for _ in range(params['events'])]
+    start = time.perf_counter()
+    for path in paths:
+        queue.register_file_modification(path)
+    register_duration = time.perf_counter() - start
+    start = time.perf_counter()
+    num_due = 0
+    while len(queue):
+        num_due += len(queue.get_due_paths())
+    drain_duration = time.perf_counter() - start
+    return {
+        'events_per_second': len(paths) / register_duration,
+        'due_files': num_due,
+        'due_files_per_second': num_due / drain_duration,
+    }
+
+
+def _flatten(results, prefix=''):
+    '''
+    Flatten nested result dicts into a dict with dotted keys.
+    '''
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+@click.group()
+def benchmark():
+    '''
+    Benchmarks for the hot paths of coba.
+
+    Generates a synthetic directory tree and version history and measures
+    ingest throughput, query latency, restore throughput and the event
+    rate of the file queue. The results are written to a JSON file, which
+    can be compared with the results of another commit:
+
+    \b
+        python benchmarks/benchmark.py run --output old.json
+        git checkout other-branch
+        python benchmarks/benchmark.py run --output new.json
+        python benchmarks/benchmark.py compare old.json new.json
+    '''
+
+
+@benchmark.command()
+@click.option('--files', type=click.IntRange(min=1), default=1000,
+              help='Number of files in the synthetic tree.')
+@click.option('--file-size', default='4 k', help='Size of each file.')
+@click.option('--versions', type=click.IntRange(min=1), default=10,
+              help='Number of versions per file.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=100,
+              help='Number of files stored per transaction.')
+@click.option('--queries', type=click.IntRange(min=1), default=1000,
+              help='Number of version lookups.')
+@click.option('--events', type=click.IntRange(min=1), default=100000,
+              help='Number of file system events for the queue.')
+@click.option('--compression', type=click.Choice(COMPRESSION_MODES),
+              default='none')
+@click.option('--chunking/--no-chunking', default=False)
+@click.option('--pack-threshold', default='0',
+              help='Size below which contents are stored in packs.')
+@click.option('--seed', type=int, default=0,
+              help='Seed of the random number generator.')
+@click.option('--only', type=click.Choice(BENCHMARKS), multiple=True,
+              help='Run only the given benchmarks (repeatable).')
+@click.option('--work-dir', type=click.Path(file_okay=False),
+              help='Directory for the temporary files.')
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='JSON file for the results (default: based on the '
+                   'current commit).')
+def run(files, file_size, versions, batch_size, queries, events, compression,
+        chunking, pack_threshold, seed, only, work_dir, output):
+    '''
+    Run the benchmarks and save the results.
+    '''
+    params = {
+        'files': files,
+        'file_size': parse_file_size(file_size),
+        'versions': versions,
+        'batch_size': batch_size,
+        'queries': queries,
+        'events': events,
+        'compression': compression,
+        'chunking': chunking,
+        'pack_threshold': parse_file_size(pack_threshold),
+        'seed': seed,
+    }
+    selected = set(only or BENCHMARKS)
+    rng = random.Random(seed)
+    commit = _git_commit()
+    results = {}
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+        temp_dir = Path(temp_dir)
+        click.echo('Generating {} files of {} bytes...'.format(
+                   files, params['file_size']))
+        tree = _Tree(temp_dir / 'tree', files, params['file_size'], rng)
+        needs_store = selected & {'ingest', 'history', 'queries', 'restore'}
+        if needs_store:
+            with Store(temp_dir / 'store', compression=compression,
+                       chunking=chunking,
+                       pack_threshold=params['pack_threshold']) as store:
+                # The other store benchmarks need the stored versions
+                click.echo('Running ingest...')
+                result = _benchmark_ingest(store, tree, params)
+                if 'ingest' in selected:
+                    results['ingest'] = result
+                if selected & {'history', 'queries'}:
+                    click.echo('Running history...')
+                    result = _benchmark_history(store, tree, params)
+                    if 'history' in selected:
+                        results['history'] = result
+                if 'queries' in selected:
+                    click.echo('Running queries...')
+                    results['queries'] = _benchmark_queries(store, tree,
+                                                            params, rng)
+                if 'restore' in selected:
+                    click.echo('Running restore...')
+                    results['restore'] = _benchmark_restore(
+                        store, tree, params, temp_dir / 'restore')
+        if 'queue' in selected:
+            click.echo('Running queue...')
+            results['queue'] = _benchmark_queue(tree, params, rng)
+    data = {
+        'format_version': FORMAT_VERSION,
+        'commit': commit,
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': params,
+        'results': results,
+    }
+    if not output:
+        output = 'benchmark-{}.json'.format((commit or 'unknown')[:12])
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    for key, value in sorted(_flatten(results).items()):
+        click.echo('{:40} {}'.format(key, value))
+    click.echo('Results written to {}'.format(output))
+
+
+@benchmark.command()
+@click.argument('baseline', type=click.Path(exists=True, dir_okay=False))
+@click.argument('current', type=click.Path(exists=True, dir_okay=False))
+def compare(baseline, current):
+    '''
+    Compare the results of two benchmark runs.
+    '''
+    with open(baseline, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(current, encoding='utf-8') as f:
+        new = json.load(f)
+    if old['parameters'] != new['parameters']:
+        click.echo('Warning: the runs used different parameters', err=True)
+    old_results = _flatten(old['results'])
+    new_results = _flatten(new['results'])
+    click.echo('{:40} {:>14} {:>14} {:>9}'.format(
+               'Measurement', (old['commit'] or '?')[:12],
+               (new['commit'] or '?')[:12], 'Change'))
+    for key in sorted(set(old_results) & set(new_results)):
+        old_value, new_value = old_results[key], new_results[key]
+        if not isinstance(old_value, (int, float)) or not old_value \
+                or new_value is None:
+            continue
+        click.echo('{:40} {:14.6g} {:14.6g} {:+8.1%}'.format(
+                   key, old_value, new_value, new_value / old_value - 1))
+
+
+if __name__ == '__main__':
+    benchmark()
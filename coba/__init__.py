@@ -21,6 +21,12 @@
 # THE SOFTWARE.
 
 import collections
+import concurrent.futures
+import contextlib
+import copy
+import functools
+import heapq
+import itertools
 import logging
 from pathlib import Path
 import threading
@@ -29,6 +35,8 @@ import time
 import watchdog
 import watchdog.events
 
+from . import metrics, tracing
+
 
 __version__ = '0.2.0'
 
@@ -45,39 +53,41 @@ log = logging.getLogger(__name__)
 # Seconds to wait for another modification before backing up a file
 IDLE_WAIT_SECONDS = 5
 
+# Maximum number of seconds that a file which is modified continuously waits
+# for its backup
+MAX_WAIT_SECONDS = 60
 
-class DictQueue:
-    '''
-    A dict-like queue.
-    '''
-    def __init__(self):
-        self._dict = collections.OrderedDict()
+# A directory with more than this number of events within the storm window is
+# rescanned instead of backing up its files individually
+STORM_THRESHOLD = 1000
+STORM_WINDOW_SECONDS = 1
 
-    def __setitem__(self, key, value):
-        try:
-            self._dict.move_to_end(key)
-        except KeyError:
-            pass
-        self._dict[key] = value
+# Number of directories with event counts after which counts of directories
+# without recent events are discarded
+_MAX_COUNTED_DIRECTORIES = 4096
 
-    def __getitem__(self, key):
-        return self._dict[key]
 
-    def __len__(self):
-        return len(self._dict)
+_EVENTS = metrics.counter('coba_events_total',
+                          'Number of file system events for files')
+_QUEUE_WAIT_SECONDS = metrics.histogram(
+    'coba_queue_wait_seconds',
+    'Time from the first event of a file until it is due for backup',
+    buckets=(1, 2, 5, 10, 30, 60, 300, 900, 3600))
 
-    def __contains__(self, key):
-        return key in self._dict
 
-    def pop_oldest_item(self):
-        '''
-        Remove and return the oldest item.
-        '''
-        try:
-            oldest_key = next(iter(self._dict.keys()))
-        except StopIteration:
-            raise ValueError('DictQueue is empty')
-        return self._dict.popitem(oldest_key)
+# Pending rescan of a directory in a ``FileQueue``
+_Rescan = collections.namedtuple('_Rescan', ['directory'])
+
+
+class _EventCount:
+    '''
+    Events of a directory within the current storm window.
+    '''
+    __slots__ = ['start', 'paths']
+
+    def __init__(self, start):
+        self.start = start
+        self.paths = set()
 
 
 class FileQueue:
@@ -87,42 +97,319 @@ class FileQueue:
     Not every file system event results in a backup: for example, if a
     file is quickly modified several times then only the last version of
     the file is backed up.
+
+    Internally, pending files are scheduled by their deadline (the time
+    of their last modification plus the idle wait time, but at most the
+    maximum wait time after their first modification) using a heap.
+    Modifying a pending file only updates its deadline, its heap entry is
+    moved once it reaches the top of the heap.
+
+    The queue can be made persistent using a ``coba.journal.QueueJournal``:
+    pending files are recorded in the journal until they are marked as
+    done via ``mark_done``, and the files that were pending when the
+    journal was last closed (or when the process was killed) are queued
+    again.
+
+    Operations like ``git checkout`` can cause event storms. If a
+    ``rescan`` callback is given then the events are counted per
+    directory. Once more than ``storm_threshold`` files in a directory
+    have events within ``storm_window`` seconds, its pending files are
+    replaced by a single rescan of the directory. Further events in the
+    directory only postpone the rescan, up to the maximum wait time. Once
+    the directory has been quiet for the idle wait time (or the maximum
+    wait time has passed), the callback is used to find the files in it
+    that need a backup. Memory and CPU usage during a storm therefore do
+    not depend on the number of events.
     '''
-    def __init__(self):
-        self._queue = DictQueue()
+    def __init__(self, idle_wait=IDLE_WAIT_SECONDS, journal=None,
+                 rescan=None, storm_threshold=STORM_THRESHOLD,
+                 storm_window=STORM_WINDOW_SECONDS,
+                 max_wait=MAX_WAIT_SECONDS):
+        '''
+        Constructor.
+
+        ``idle_wait`` is the number of seconds to wait for another
+        modification of a file before it is backed up.
+
+        ``journal`` is an optional open ``coba.journal.QueueJournal``.
+        Its pending files are added to the queue.
+
+        ``rescan`` is an optional callable that receives the ``Path`` of
+        a directory and returns a list of the files directly in that
+        directory that need a backup. Event storms are only detected if
+        it is given.
+
+        ``max_wait`` is the maximum number of seconds between the first
+        modification of a pending file and its backup, so that files
+        which are modified continuously are still backed up.
+        '''
+        self._idle_wait = idle_wait
+        self._max_wait = max_wait
+        self._deadlines = {}
+        # Monotonic times at which the pending entries were first scheduled
+        self._first_seen = {}
+        self._heap = []
+        self._counter = itertools.count()
         self._condition = threading.Condition()
+        self._due = collections.deque()
+        self._journal = journal
+        self._rescan = rescan
+        self._storm_threshold = storm_threshold
+        self._storm_window = storm_window
+        self._event_counts = {}
+        if journal is not None:
+            pending = journal.pending
+            for path in pending:
+                self._schedule(path)
+            if pending:
+                log.info('Restored {} pending files from {}'.format(
+                         len(pending), journal.path))
+
+    def _schedule(self, entry):
+        '''
+        Schedule a file for backup (or a directory for a rescan) once the
+        idle wait time or the maximum wait time has passed.
+
+        Must be called while holding the lock.
+        '''
+        now = time.monotonic()
+        deadline = now + self._idle_wait
+        if entry in self._deadlines:
+            deadline = min(deadline, self._first_seen[entry] + self._max_wait)
+            # The entry's heap entry is moved to the new deadline once it
+            # reaches the top of the heap
+            self._deadlines[entry] = deadline
+            return
+        self._deadlines[entry] = deadline
+        self._first_seen[entry] = now
+        heapq.heappush(self._heap, (deadline, next(self._counter), entry))
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._compact()
+
+    def _is_storming(self, path):
+        '''
+        Count an event and check whether its directory has an event storm.
+
+        If the number of files with events in the directory exceeds the
+        storm threshold then its pending files are removed and ``True``
+        is returned.
+
+        Must be called while holding the lock.
+        '''
+        directory = path.parent
+        if _Rescan(directory) in self._deadlines:
+            return True
+        now = time.monotonic()
+        count = self._event_counts.get(directory)
+        if count is None or now - count.start > self._storm_window:
+            if len(self._event_counts) >= _MAX_COUNTED_DIRECTORIES:
+                self._discard_event_counts(now)
+            count = self._event_counts[directory] = _EventCount(now)
+        count.paths.add(path)
+        if len(count.paths) <= self._storm_threshold:
+            return False
+        del self._event_counts[directory]
+        for pending in count.paths:
+            # The corresponding heap entries are discarded lazily
+            self._deadlines.pop(pending, None)
+            self._first_seen.pop(pending, None)
+        log.info('Event storm in {}, rescanning it once it is quiet'.format(
+                 directory))
+        return True
+
+    def _discard_event_counts(self, now):
+        '''
+        Discard the event counts of directories without recent events.
+
+        Must be called while holding the lock.
+        '''
+        self._event_counts = {
+            directory: count for directory, count
+            in self._event_counts.items()
+            if now - count.start <= self._storm_window
+        }
+        if len(self._event_counts) >= _MAX_COUNTED_DIRECTORIES // 2:
+            # Events are spread over many directories. Starting over keeps
+            # the cost of discarding counts low.
+            self._event_counts.clear()
 
     def register_file_modification(self, path):
         '''
         Register a file modification event.
         '''
         with self._condition:
-            self._queue[path] = time.time()
-            self._condition.notify()
-            log.debug('{} has been modified'.format(path))
+            was_empty = not self._deadlines
+            if self._rescan is not None and self._is_storming(path):
+                self._schedule(_Rescan(path.parent))
+                if was_empty:
+                    self._condition.notify()
+                return
+            self._schedule(path)
+            if self._journal is not None:
+                self._journal.add(path)
+            # Deadlines are increasing, so a waiting consumer only needs to
+            # be woken up if the queue was empty.
+            if was_empty:
+                self._condition.notify()
+        log.debug('{} has been modified'.format(path))
+
+    def mark_done(self, paths):
+        '''
+        Mark files as backed up.
 
-    def __next__(self):
+        Only has an effect if the queue has a journal, in which case the
+        files are removed from it unless they have been modified again
+        in the meantime.
         '''
-        Return the next file to be backed up.
+        if self._journal is None:
+            return
+        with self._condition:
+            self._journal.done([path for path in paths
+                                if path not in self._deadlines])
+
+    def _compact(self):
+        '''
+        Rebuild the heap without outdated entries.
+
+        Must be called while holding the lock.
+        '''
+        self._heap = [(deadline, next(self._counter), entry)
+                      for entry, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
         '''
+        Return the number of pending files and directory rescans.
+        '''
+        with self._condition:
+            return len(self._deadlines) + len(self._due)
+
+    def get_due_paths(self, timeout=None):
+        '''
+        Return all files that are due for backup.
+
+        Blocks until at least one file is due. If ``timeout`` is given
+        and no file becomes due within ``timeout`` seconds then an empty
+        list is returned.
+        '''
+        end = None if timeout is None else time.monotonic() + timeout
         while True:
-            with self._condition:
-                while not self._queue:
-                    self._condition.wait()
-                path, modification_time = self._queue.pop_oldest_item()
-            backup_time = modification_time + IDLE_WAIT_SECONDS
-            time.sleep(max(0, backup_time - time.time()))
-            with self._condition:
-                if path in self._queue:
-                    # The file has been modified while we were waiting
-                    log.debug('{} is still being modified'.format(path))
+            with self._condition, tracing.span('queue.wait'):
+                due = self._wait_for_due(end)
+            paths = []
+            rescanned = False
+            for entry in due:
+                if isinstance(entry, _Rescan):
+                    # The callback is run without holding the lock, so that
+                    # events can be registered in the meantime
+                    paths.extend(self._rescan_directory(entry.directory))
+                    rescanned = True
+                else:
+                    paths.append(entry)
+            if paths or not rescanned:
+                return paths
+
+    def _wait_for_due(self, end):
+        '''
+        Wait until at least one entry is due and remove the due entries.
+
+        ``end`` is the monotonic time at which to give up or ``None``.
+
+        Returns a list of the due entries, which is empty if ``end`` has
+        passed.
+
+        Must be called while holding the lock.
+        '''
+        while True:
+            now = time.monotonic()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, entry = heapq.heappop(self._heap)
+                current = self._deadlines.get(entry)
+                if current is None:
+                    continue  # Removed in the meantime
+                if current > deadline:
+                    heapq.heappush(self._heap,
+                                   (current, next(self._counter), entry))
                     continue
-                return path
+                del self._deadlines[entry]
+                _QUEUE_WAIT_SECONDS.observe(now - self._first_seen.pop(entry))
+                due.append(entry)
+            if due:
+                return due
+            if self._heap:
+                wait = self._heap[0][0] - now
+            else:
+                wait = None
+            if end is not None:
+                remaining = end - now
+                if remaining <= 0:
+                    return []
+                wait = remaining if wait is None else min(wait, remaining)
+            self._condition.wait(wait)
+
+    def _rescan_directory(self, directory):
+        '''
+        Find the files in a directory that need a backup after a storm.
+        '''
+        try:
+            paths = self._rescan(directory)
+        except Exception as e:
+            log.error('Could not rescan {}: {}'.format(directory, e))
+            metrics.ERRORS.labels('rescan').inc()
+            return []
+        log.debug('Rescan of {} found {} files'.format(directory, len(paths)))
+        return paths
+
+    def __next__(self):
+        '''
+        Return the next file to be backed up.
+        '''
+        if not self._due:
+            self._due.extend(self.get_due_paths())
+        return self._due.popleft()
 
     def __iter__(self):
         return self
 
 
+def catch_up(store, directory, queue, config=None, stopped=None):
+    '''
+    Queue the files that have changed while they were not watched.
+
+    ``store`` is an open ``coba.store.Store``, ``directory`` the absolute
+    path of the watched directory and ``queue`` a ``FileQueue``. The
+    files in the directory tree that have changed since their latest
+    version was stored (see ``Store.find_changed_files``) are registered
+    as modified in the queue.
+
+    If ``config`` is given then it is a ``coba.config.Config`` instance,
+    and files that are ignored according to it are skipped.
+
+    This should be called once the directory is being watched, so that
+    no modification is missed between the check and the start of the
+    watch.
+
+    If ``stopped`` is given then it is a ``threading.Event``. Once it is
+    set, the check stops after the current batch of files.
+
+    Returns the number of queued files.
+    '''
+    num_files = 0
+    batches = store.find_changed_files(directory, config)
+    with contextlib.closing(batches):
+        for paths in batches:
+            for path in paths:
+                queue.register_file_modification(path)
+            num_files += len(paths)
+            if stopped is not None and stopped.is_set():
+                log.info('Stopped checking {} for changes'.format(directory))
+                return num_files
+    log.info('Queued {} files that changed in {} while not watched'.format(
+             num_files, directory))
+    return num_files
+
+
 class EventHandler(watchdog.events.FileSystemEventHandler):
     '''
     Event handler for file system events.
@@ -131,14 +418,19 @@ class EventHandler(watchdog.events.FileSystemEventHandler):
     # a file is removed between being scheduled for backup and the backup
     # itself then this is handled in the backup code.
 
-    def __init__(self, queue):
+    def __init__(self, queue, config=None):
         '''
         Constructor.
 
         ``queue`` is an instance of ``FileQueue``.
+
+        If ``config`` is given then it is a ``coba.config.Config``
+        instance, and files that are ignored according to it are not
+        added to the queue.
         '''
         super().__init__()
         self._queue = queue
+        self._config = config
 
     def dispatch(self, event):
         if event.is_directory:
@@ -147,7 +439,9 @@ class EventHandler(watchdog.events.FileSystemEventHandler):
             #       of the target files -- do we get separate creation events
             #       for these?
             return  # Ignore directory events
-        super().dispatch(event)
+        _EVENTS.inc()
+        with tracing.span('event.dispatch', type=event.event_type):
+            super().dispatch(event)
 
     def on_created(self, event):
         self._register(Path(event.src_path))
@@ -156,6 +450,8 @@ class EventHandler(watchdog.events.FileSystemEventHandler):
         self._register(Path(event.src_path))
 
     def _register(self, path):
+        if self._config is not None and self._config.is_file_ignored(path):
+            return
         self._queue.register_file_modification(path)
 
     def on_moved(self, event):
@@ -164,3 +460,183 @@ class EventHandler(watchdog.events.FileSystemEventHandler):
         # modification events for the destinations.
         self._register(Path(event.dest_path))
 
+
+# Stores opened by backup worker processes, indexed by store path
+_process_stores = {}
+
+
+def _put_many_in_process(store, paths):
+    '''
+    Put files into a store from within a worker process.
+
+    ``store`` is an unopened copy of the pool's store. Each worker
+    process opens the store once and uses it for all of its batches.
+    The store is never closed explicitly: worker processes end via
+    ``os._exit``, which skips ``atexit`` handlers, and the operating
+    system releases the database connection and open files. Since every
+    batch is committed in its own transaction, no data is lost.
+    '''
+    try:
+        store = _process_stores[store.path]
+    except KeyError:
+        store = _process_stores[store.path] = store.__enter__()
+    store.put_many(paths)
+
+
+class BackupWorkerPool:
+    '''
+    A pool of workers that back up files concurrently.
+
+    Submitted files are collected into batches which are stored using
+    ``Store.put_many``, so that the versions of a batch are committed
+    in a single database transaction. A batch is started once it has
+    reached the maximum batch size or once the maximum batch delay has
+    passed since its first file was submitted.
+
+    A file is never backed up by two workers at the same time: if a file
+    is submitted while a backup of it is still running then the new
+    backup starts once the running one has finished.
+    '''
+    def __init__(self, store, num_workers=1, worker_type='thread',
+                 batch_size=1, batch_delay=0, on_done=None):
+        '''
+        Constructor.
+
+        ``store`` is an instance of ``coba.store.Store`` that is already
+        open.
+
+        ``num_workers`` is the number of workers.
+
+        ``worker_type`` is either ``'thread'`` or ``'process'``. Thread
+        workers share ``store``, process workers each open their own
+        instance of the store. In that case the limits of the store's
+        throttle are divided between the processes.
+
+        ``batch_size`` is the maximum number of files in a batch.
+
+        ``batch_delay`` is the maximum number of seconds that a file
+        waits for its batch to be started.
+
+        If ``on_done`` is given then it is called with the list of files
+        of a batch once their backup has finished successfully. Files
+        that have been submitted again while their backup was running
+        are not included.
+        '''
+        if worker_type == 'process' and store.throttle:
+            # Each process has its own throttle, so the limits are shared out
+            store = copy.copy(store)
+            store.throttle = store.throttle.split(num_workers)
+        self._store = store
+        self._on_done = on_done
+        self._worker_type = worker_type
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        if worker_type == 'thread':
+            self._executor = concurrent.futures.ThreadPoolExecutor(num_workers)
+        elif worker_type == 'process':
+            self._executor = concurrent.futures.ProcessPoolExecutor(num_workers)
+        else:
+            raise ValueError('Invalid worker type "{}"'.format(worker_type))
+        # Re-entrant because ``Future.add_done_callback`` calls the callback
+        # directly if the future has already completed.
+        self._lock = threading.RLock()
+        self._idle = threading.Condition(self._lock)
+        self._batch = collections.OrderedDict()
+        self._timer = None
+        self._active = set()
+        self._resubmit = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.shutdown()
+
+    def __len__(self):
+        '''
+        Return the number of files that are waiting for or in backup.
+        '''
+        with self._lock:
+            return len(self._batch) + len(self._active)
+
+    def submit(self, path):
+        '''
+        Schedule a file for backup.
+        '''
+        with self._lock:
+            if path in self._active:
+                log.debug('{} is already being backed up'.format(path))
+                self._resubmit.add(path)
+            else:
+                self._add_to_batch(path)
+
+    def _add_to_batch(self, path):
+        '''
+        Add a file to the current batch.
+
+        Must be called while holding the lock.
+        '''
+        self._batch[path] = True
+        if len(self._batch) >= self._batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = threading.Timer(self._batch_delay, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._flush()
+
+    def _flush(self):
+        '''
+        Start a backup of the files in the current batch.
+
+        Must be called while holding the lock.
+        '''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._batch:
+            return
+        paths = list(self._batch)
+        self._batch.clear()
+        self._active.update(paths)
+        if self._worker_type == 'thread':
+            future = self._executor.submit(self._store.put_many, paths)
+        else:
+            future = self._executor.submit(_put_many_in_process, self._store,
+                                           paths)
+        future.add_done_callback(functools.partial(self._done, paths))
+
+    def _done(self, paths, future):
+        exception = future.exception()
+        if exception:
+            log.error('Could not back up {} files: {}'.format(len(paths),
+                      exception))
+            metrics.ERRORS.labels('batch').inc()
+        with self._lock:
+            finished = []
+            for path in paths:
+                self._active.discard(path)
+                if path in self._resubmit:
+                    self._resubmit.discard(path)
+                    self._add_to_batch(path)
+                else:
+                    finished.append(path)
+            if self._on_done and not exception:
+                # Called while holding the lock so that no file can be
+                # submitted again before the callback has seen it
+                self._on_done(finished)
+            self._idle.notify_all()
+
+    def shutdown(self):
+        '''
+        Wait for all scheduled backups to finish and stop the workers.
+        '''
+        with self._idle:
+            while self._active or self._batch:
+                self._flush()
+                self._idle.wait()
+        self._executor.shutdown(wait=True)
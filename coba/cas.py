@@ -0,0 +1,618 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import hashlib
+import logging
+import lzma
+import os
+import shutil
+import tempfile
+import zlib
+
+from . import metrics, tracing
+from .chunking import Chunker
+from .copying import BUFFERED, copy_file, REFLINK, reflink
+from .packs import PackStore
+from .throttle import Throttle
+
+
+__all__ = ['COMPRESSION_MODES', 'ContentStore', 'hash_file']
+
+
+log = logging.getLogger(__name__)
+
+
+# Number of bytes that are read from a file at once
+_BUFFER_SIZE = 1024**2
+
+# Supported compression modes
+COMPRESSION_MODES = ['none', 'zlib', 'lzma']
+
+# File name suffixes of stored contents for each compression mode. Chunked
+# contents are stored as a list of their chunks, which are stored as separate
+# contents.
+_SUFFIXES = collections.OrderedDict([
+    ('none', ''),
+    ('zlib', '.zlib'),
+    ('lzma', '.xz'),
+    ('chunks', '.chunks'),
+])
+
+# Minimum size of files that are split into chunks if chunking is enabled
+_CHUNKING_THRESHOLD = 1024**2
+
+# Number of bytes at the beginning of a file that are used to estimate
+# whether compressing the file is worthwhile
+_SAMPLE_SIZE = 64 * 1024
+
+# Files whose sample cannot be compressed to less than this fraction of its
+# size are stored uncompressed. This catches already compressed formats
+# (images, archives, ...) without relying on file name extensions.
+_MAX_COMPRESSION_RATIO = 0.9
+
+
+_INGESTED_BYTES = metrics.counter('coba_ingested_bytes_total',
+                                  'Number of bytes read from stored files')
+_COPY_SECONDS = metrics.PUT_PHASE_SECONDS.labels('copy')
+_CAS_WRITE_SECONDS = metrics.PUT_PHASE_SECONDS.labels('cas_write')
+
+
+def _compressor(mode):
+    if mode == 'zlib':
+        return zlib.compressobj()
+    if mode == 'lzma':
+        return lzma.LZMACompressor()
+    return None
+
+
+def _decompressor(mode):
+    if mode == 'zlib':
+        return zlib.decompressobj()
+    if mode == 'lzma':
+        return lzma.LZMADecompressor()
+    return None
+
+
+def _decompress(mode, data):
+    if mode == 'zlib':
+        return zlib.decompress(data)
+    if mode == 'lzma':
+        return lzma.decompress(data)
+    return data
+
+
+def _is_compressible(sample):
+    '''
+    Estimate whether a content is worth compressing.
+
+    ``sample`` is the beginning of the content. Its entropy is estimated
+    cheaply by compressing it using zlib's fastest setting.
+    '''
+    if not sample:
+        return False
+    compressed_size = len(zlib.compress(sample, 1))
+    return compressed_size < len(sample) * _MAX_COMPRESSION_RATIO
+
+
+def _hash_fileobj(f, throttle=None):
+    hasher = hashlib.sha1()
+    buf = bytearray(_BUFFER_SIZE)
+    view = memoryview(buf)
+    while True:
+        num_bytes = f.readinto(buf)
+        if not num_bytes:
+            break
+        hasher.update(view[:num_bytes])
+        if throttle:
+            throttle.process_bytes(num_bytes)
+    return hasher.hexdigest()
+
+
+def hash_file(path, throttle=None):
+    '''
+    Compute the hash of a file's content.
+
+    ``path`` is the ``pathlib.Path`` of the file.
+
+    If ``throttle`` is given then it is a ``coba.throttle.Throttle``
+    that limits the rate at which the file is read.
+
+    Returns the SHA-1 hash of the content as a hex string.
+    '''
+    with path.open('rb') as f:
+        return _hash_fileobj(f, throttle)
+
+
+class ContentStore:
+    '''
+    Content-addressable storage for file contents.
+
+    Each content is stored in a file whose name is derived from the SHA-1
+    hash of the content. The first characters of the hash are used as
+    subdirectories to keep the number of entries per directory small.
+    This is the layout used by the ``hashfs`` package with a depth of 4
+    and a width of 1.
+
+    Contents can be stored compressed, in which case a suffix is
+    appended to the file name. Contents are always addressed by the
+    hash of their uncompressed data, so a store can contain contents
+    stored with different compression modes.
+
+    Large contents can also be split into chunks using content-defined
+    chunking. Each chunk is stored as a separate content, and the large
+    content is stored as the list of its chunks. If a large file is
+    modified then only the chunks around the modification change, so
+    storing the new version only needs space for those.
+
+    Small contents (including small chunks) can be appended to pack
+    files instead of being stored in separate files, see
+    ``coba.packs.PackStore``.
+    '''
+    DEPTH = 4
+    WIDTH = 1
+
+    # File mode of stored contents
+    FILE_MODE = 0o664
+
+    def __init__(self, path, compression='none', chunking=False,
+                 pack_threshold=0, throttle=None):
+        '''
+        Constructor.
+
+        ``path`` is the ``pathlib.Path`` of the base directory of the
+        storage. It is created if it does not exist.
+
+        ``compression`` is the compression mode for new contents, one of
+        ``COMPRESSION_MODES``.
+
+        If ``chunking`` is true then large files are split into chunks.
+
+        Contents that are smaller than ``pack_threshold`` bytes are stored
+        in pack files. Contents that are already stored in pack files can
+        be read independently of this setting.
+
+        ``throttle`` is an optional ``coba.throttle.Throttle`` that
+        limits the rate at which new contents are read.
+        '''
+        if compression not in COMPRESSION_MODES:
+            raise ValueError('Invalid compression mode "{}"'.format(
+                             compression))
+        self.path = path
+        self.compression = compression
+        self._chunker = Chunker() if chunking else None
+        self.pack_threshold = pack_threshold
+        self.throttle = throttle or Throttle()
+        self._packs = PackStore(path / 'packs')
+        self._staging_path = path / 'staging'
+        self._staging_path.mkdir(parents=True, exist_ok=True)
+        # Number of times each copy strategy was used for storing content
+        self.copy_strategies = collections.Counter()
+
+    def _content_path(self, hash):
+        '''
+        Return the path at which the content with the given hash is stored.
+        '''
+        parts = [hash[i * self.WIDTH:(i + 1) * self.WIDTH]
+                 for i in range(self.DEPTH)]
+        parts.append(hash[self.DEPTH * self.WIDTH:])
+        return self.path.joinpath(*parts)
+
+    def _find(self, hash):
+        '''
+        Find a stored content.
+
+        Returns a tuple containing the path of the stored content and its
+        compression mode, or ``(None, None)`` if no content with the
+        given hash is stored.
+        '''
+        path = self._content_path(hash)
+        for mode, suffix in _SUFFIXES.items():
+            candidate = path.with_name(path.name + suffix)
+            if candidate.is_file():
+                return candidate, mode
+        return None, None
+
+    def get_path(self, hash):
+        '''
+        Return the path of the file in which a content is stored.
+
+        Note that the file's data may be compressed.
+
+        Returns ``None`` if no content with the given hash is stored in a
+        separate file.
+        '''
+        return self._find(hash)[0]
+
+    def exists(self, hash):
+        '''
+        Check whether a content with the given hash is stored.
+        '''
+        return hash in self._packs or self.get_path(hash) is not None
+
+    def is_packed(self, hash):
+        '''
+        Check whether a content is stored in a pack file.
+        '''
+        return hash in self._packs
+
+    def get_packs(self):
+        '''
+        Return the numbers of the pack files, oldest first.
+        '''
+        return self._packs.get_packs()
+
+    def compact_pack(self, number, find_referenced, min_age=0):
+        '''
+        Remove unreferenced contents from a pack file.
+
+        See ``coba.packs.PackStore.compact``.
+
+        Returns the number of removed contents.
+        '''
+        return self._packs.compact(number, find_referenced, min_age)
+
+    def close(self):
+        '''
+        Close open pack files.
+        '''
+        self._packs.close()
+
+    def get_chunks(self, hash):
+        '''
+        Get the chunks of a content.
+
+        Returns a list of ``(hash, size)`` tuples that contain the hash
+        and size of each chunk of a chunked content (a chunk is listed
+        once for each occurrence), or ``None`` if the content is not
+        stored in chunks.
+        '''
+        entry = self._packs.get(hash)
+        if entry is not None:
+            if entry.mode != 'chunks':
+                return None
+            lines = self._packs.read(entry).decode('ascii').splitlines()
+        else:
+            path, mode = self._find(hash)
+            if mode != 'chunks':
+                return None
+            lines = path.read_text(encoding='ascii').splitlines()
+        chunks = []
+        for line in lines:
+            chunk_hash, size = line.split()
+            chunks.append((chunk_hash, int(size)))
+        return chunks
+
+    def get_size(self, hash):
+        '''
+        Get the size of a content in bytes.
+
+        Compressed contents are decompressed to determine their size.
+        '''
+        chunks = self.get_chunks(hash)
+        if chunks is not None:
+            return sum(size for _, size in chunks)
+        entry = self._packs.get(hash)
+        if entry is not None:
+            return len(_decompress(entry.mode, self._packs.read(entry)))
+        path, mode = self._find(hash)
+        if path is None:
+            raise FileNotFoundError('Content "{}" not found'.format(hash))
+        if mode == 'none':
+            return path.stat().st_size
+        size = 0
+        decompressor = _decompressor(mode)
+        with path.open('rb') as f:
+            while True:
+                data = f.read(_BUFFER_SIZE)
+                if not data:
+                    break
+                size += len(decompressor.decompress(data))
+        if mode == 'zlib':
+            size += len(decompressor.flush())
+        return size
+
+    def get_stored_size(self, hash):
+        '''
+        Get the number of bytes that a content occupies in the store.
+
+        For a chunked content this is the size of its list of chunks,
+        the chunks themselves are separate contents.
+        '''
+        entry = self._packs.get(hash)
+        if entry is not None:
+            return entry.length
+        path = self.get_path(hash)
+        if path is None:
+            raise FileNotFoundError('Content "{}" not found'.format(hash))
+        return path.stat().st_size
+
+    def remove(self, hash):
+        '''
+        Remove a content.
+
+        The chunks of a chunked content are not removed.
+
+        Contents in pack files cannot be removed individually, since the
+        packs are append-only. They are removed when their pack is
+        compacted, see ``compact_pack``.
+
+        Returns ``True`` if the content was removed and ``False`` if it
+        is not stored in a separate file.
+        '''
+        path = self.get_path(hash)
+        if path is None:
+            return False
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            return False
+        log.debug('Removed content {}'.format(hash))
+        return True
+
+    def copy_to(self, hash, target_path):
+        '''
+        Copy a stored content into a file.
+
+        ``target_path`` is the ``pathlib.Path`` of the file. If it exists
+        then it is overwritten.
+
+        Uncompressed contents that are stored in separate files are
+        copied using ``coba.copying.copy_file``, all other contents are
+        decompressed or reassembled while they are copied.
+
+        Returns the name of the strategy that was used for copying.
+        '''
+        if hash not in self._packs:
+            path, mode = self._find(hash)
+            if path is None:
+                raise FileNotFoundError('Content "{}" not found'.format(hash))
+            if mode == 'none':
+                return copy_file(path, target_path)
+        with target_path.open('wb') as target:
+            self._write_content(hash, target)
+        log.debug('Reassembled content {} at {}'.format(hash, target_path))
+        return BUFFERED
+
+    def _write_content(self, hash, target):
+        '''
+        Write a stored content to a file object.
+        '''
+        entry = self._packs.get(hash)
+        if entry is not None:
+            data = self._packs.read(entry)
+            if entry.mode == 'chunks':
+                self._write_chunks(data.decode('ascii').splitlines(), target)
+            else:
+                target.write(_decompress(entry.mode, data))
+            return
+        path, mode = self._find(hash)
+        if path is None:
+            raise FileNotFoundError('Content "{}" not found'.format(hash))
+        if mode == 'chunks':
+            with path.open('r', encoding='ascii') as f:
+                self._write_chunks(f, target)
+            return
+        with path.open('rb') as source:
+            if mode == 'none':
+                shutil.copyfileobj(source, target, _BUFFER_SIZE)
+                return
+            decompressor = _decompressor(mode)
+            while True:
+                data = source.read(_BUFFER_SIZE)
+                if not data:
+                    break
+                target.write(decompressor.decompress(data))
+            if mode == 'zlib':
+                target.write(decompressor.flush())
+
+    def _write_chunks(self, lines, target):
+        '''
+        Write the chunks listed in the lines of a chunked content to a
+        file object.
+        '''
+        for line in lines:
+            self._write_content(line.split()[0], target)
+
+    def put(self, path):
+        '''
+        Store the content of a file.
+
+        ``path`` is the ``pathlib.Path`` of the file.
+
+        If compression is enabled and a sample of the file's content
+        indicates that it is compressible, the content is compressed
+        while it is read. Otherwise, if the file system supports
+        reflinks, the file is cloned into a staging file inside the
+        storage, which is then hashed. Otherwise the file is read only
+        once: its content is hashed while it is written to the staging
+        file. Once the hash is known, the staging file is atomically
+        moved to its final location, or discarded if that content is
+        already stored. The stored content is therefore never affected
+        by modifications of the file that happen after it has been read.
+
+        Small files are read into memory at once and stored in a pack
+        file.
+
+        Reading is throttled using the store's throttle.
+
+        Returns the hash of the content.
+        '''
+        with _COPY_SECONDS.time(), tracing.span('cas.put', path=path):
+            return self._put(path)
+
+    def _put(self, path):
+        self.throttle.start_file()
+        with path.open('rb') as source:
+            size = os.fstat(source.fileno()).st_size
+            _INGESTED_BYTES.inc(size)
+            if self._chunker is not None and size >= _CHUNKING_THRESHOLD:
+                hash = self._put_chunked(source)
+                self.copy_strategies[BUFFERED] += 1
+                log.debug('Read {} in chunks'.format(path))
+                return hash
+            if size < self.pack_threshold:
+                data = source.read()
+                self.throttle.process_bytes(len(data))
+                hash = hashlib.sha1(data).hexdigest()
+                self._put_data(data, hash, self._choose_mode(data))
+                self.copy_strategies[BUFFERED] += 1
+                log.debug('Read {} into pack'.format(path))
+                return hash
+            mode = 'none'
+            if self.compression != 'none':
+                if _is_compressible(source.read(_SAMPLE_SIZE)):
+                    mode = self.compression
+                source.seek(0)
+            staging = self._create_staging_file()
+            try:
+                with staging:
+                    if mode == 'none' and reflink(source, staging):
+                        strategy = REFLINK
+                        staging.seek(0)
+                        hash = _hash_fileobj(staging, self.throttle)
+                    else:
+                        strategy = BUFFERED
+                        hash = self._copy_and_hash(source, staging,
+                                                   _compressor(mode))
+                self._commit(staging.name, hash, mode)
+            except:
+                _unlink_if_exists(staging.name)
+                raise
+        self.copy_strategies[strategy] += 1
+        log.debug('Read {} using {}'.format(path, strategy))
+        return hash
+
+    def _choose_mode(self, data):
+        '''
+        Choose the compression mode for a content given as ``bytes``.
+        '''
+        if (self.compression != 'none' and
+                _is_compressible(data[:_SAMPLE_SIZE])):
+            return self.compression
+        return 'none'
+
+    def _create_staging_file(self):
+        return tempfile.NamedTemporaryFile(dir=str(self._staging_path),
+                                           delete=False)
+
+    def _put_data(self, data, hash, mode):
+        '''
+        Store a content that is given as ``bytes``.
+
+        ``hash`` is the hash of ``data``, ``mode`` is the compression
+        mode in which it is stored. If ``data`` is smaller than the pack
+        threshold then it is stored in a pack file.
+        '''
+        if self.exists(hash):
+            metrics.DEDUP_HITS.inc()
+            return
+        packed = len(data) < self.pack_threshold
+        compressor = _compressor(mode)
+        if compressor:
+            data = compressor.compress(data) + compressor.flush()
+        if packed:
+            with _CAS_WRITE_SECONDS.time(), tracing.span('cas.write'):
+                self._packs.put(hash, data, mode)
+            log.debug('Stored content {} in pack'.format(hash))
+            return
+        staging = self._create_staging_file()
+        try:
+            with staging:
+                staging.write(data)
+            self._commit(staging.name, hash, mode)
+        except:
+            _unlink_if_exists(staging.name)
+            raise
+
+    def _put_chunked(self, source):
+        '''
+        Store the content of a file object as chunks.
+
+        Returns the hash of the content.
+        '''
+        hasher = hashlib.sha1()
+        lines = []
+        for chunk in self._chunker.chunks(source, hasher):
+            self.throttle.process_bytes(len(chunk))
+            chunk_hash = hashlib.sha1(chunk).hexdigest()
+            self._put_data(chunk, chunk_hash, self._choose_mode(chunk))
+            lines.append('{} {:d}\n'.format(chunk_hash, len(chunk)))
+        hash = hasher.hexdigest()
+        self._put_data(''.join(lines).encode('ascii'), hash, 'chunks')
+        log.debug('Stored content {} as {} chunks'.format(hash, len(lines)))
+        return hash
+
+    def _copy_and_hash(self, source, target, compressor=None):
+        '''
+        Copy the content of a file object to another and hash it.
+
+        If ``compressor`` is given then it is used to compress the
+        content before it is written.
+
+        Returns the hash of the (uncompressed) content.
+        '''
+        hasher = hashlib.sha1()
+        buf = bytearray(_BUFFER_SIZE)
+        view = memoryview(buf)
+        while True:
+            num_bytes = source.readinto(buf)
+            if not num_bytes:
+                break
+            hasher.update(view[:num_bytes])
+            self.throttle.process_bytes(num_bytes)
+            if compressor:
+                target.write(compressor.compress(view[:num_bytes]))
+            else:
+                target.write(view[:num_bytes])
+        if compressor:
+            target.write(compressor.flush())
+        return hasher.hexdigest()
+
+    def _commit(self, staging_path, hash, mode):
+        '''
+        Move a staging file to its final location.
+
+        ``mode`` is the compression mode of the staging file.
+
+        If the content is already stored (in any compression mode) then
+        the staging file is removed instead.
+        '''
+        if self.exists(hash):
+            log.debug('Content {} is already stored'.format(hash))
+            metrics.DEDUP_HITS.inc()
+            os.unlink(staging_path)
+            return
+        target = self._content_path(hash)
+        target = target.with_name(target.name + _SUFFIXES[mode])
+        with _CAS_WRITE_SECONDS.time(), tracing.span('cas.write'):
+            os.chmod(staging_path, self.FILE_MODE)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(staging_path, str(target))
+        log.debug('Stored content {} at {}'.format(hash, target))
+
+
+def _unlink_if_exists(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
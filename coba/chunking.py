@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+
+
+__all__ = ['Chunker']
+
+
+_MASK_64 = 2**64 - 1
+
+
+def _make_gear_table():
+    '''
+    Create the table of random values used by the Gear hash.
+
+    The values are derived deterministically so that the same content is
+    always split at the same positions.
+    '''
+    return [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big')
+            for i in range(256)]
+
+
+_GEAR = _make_gear_table()
+
+
+class Chunker:
+    '''
+    Content-defined chunking.
+
+    Splits data into chunks whose boundaries are determined by the data
+    itself, using a Gear rolling hash (as in FastCDC). Inserting or
+    removing data therefore only changes the chunks around the
+    modification, all other chunks stay the same.
+    '''
+    def __init__(self, min_size=16 * 1024, avg_size=64 * 1024,
+                 max_size=256 * 1024):
+        '''
+        Constructor.
+
+        ``min_size`` and ``max_size`` are the minimum and maximum chunk
+        size in bytes. The last chunk of a content can be smaller than
+        ``min_size``.
+
+        ``avg_size`` is the desired average chunk size in bytes. It must
+        be a power of two.
+        '''
+        if not (0 < min_size <= avg_size <= max_size):
+            raise ValueError('Chunk sizes must satisfy 0 < min <= avg <= max')
+        if avg_size & (avg_size - 1):
+            raise ValueError('Average chunk size must be a power of two')
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        # The Gear hash's lower bits only depend on the last few bytes, so
+        # the boundary condition is checked on the upper bits.
+        bits = avg_size.bit_length() - 1
+        self._mask = ((1 << bits) - 1) << (64 - bits)
+
+    def _find_boundary(self, data):
+        '''
+        Find the end of the first chunk in ``data``.
+
+        ``data`` must contain at least ``max_size`` bytes unless it is
+        the end of the content.
+        '''
+        end = min(len(data), self.max_size)
+        if end <= self.min_size:
+            return end
+        gear = _GEAR
+        mask = self._mask
+        h = 0
+        # Bytes before the minimum chunk size cannot be a boundary and are
+        # skipped, as the Gear hash only depends on the last 64 bytes
+        for i in range(self.min_size, end):
+            h = ((h << 1) + gear[data[i]]) & _MASK_64
+            if not h & mask:
+                return i + 1
+        return end
+
+    def chunks(self, f, hasher=None):
+        '''
+        Split the content of a file object into chunks.
+
+        ``f`` is a binary file object.
+
+        If ``hasher`` is given then its ``update`` method is called with
+        all data read from ``f``.
+
+        Yields the chunks as ``bytes``.
+        '''
+        buf = bytearray()
+        while True:
+            data = f.read(self.max_size)
+            if hasher is not None and data:
+                hasher.update(data)
+            buf += data
+            while len(buf) >= self.max_size or (not data and buf):
+                boundary = self._find_boundary(buf)
+                yield bytes(buf[:boundary])
+                del buf[:boundary]
+            if not data:
+                return
@@ -20,20 +20,30 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import contextlib
 import datetime
 import functools
+import hashlib
+import json
 import logging
 from pathlib import Path
 import sys
+import threading
 
 import click
-import watchdog.observers
 
-from .import EventHandler, FileQueue, __version__ as coba_version
+from .import (BackupWorkerPool, catch_up, EventHandler, FileQueue,
+             __version__ as coba_version)
 from .config import Config, DEFAULT_CONFIG
+from .journal import QueueJournal
+from . import metrics, tracing
+from .profiling import profile, PROFILERS
+from .retention import RetentionPolicy
 from .store import Store
-from .utils import (local_to_utc, make_path_absolute, parse_datetime,
-                    utc_to_local)
+from .throttle import Throttle
+from .utils import (format_file_size, local_to_utc, make_path_absolute,
+                    parse_datetime, parse_duration, utc_to_local)
+from .watching import create_observer
 
 
 __all__ = ['coba']
@@ -59,11 +69,32 @@ def _handle_errors(f):
 @click.group()
 @click.option('--config', envvar='COBA_CONFIG', type=click.Path(dir_okay=False,
               readable=True))
+@click.option('--profile', 'profile_path', type=click.Path(dir_okay=False,
+              writable=True), help='Profile the command and write the '
+              'profile to this file.')
+@click.option('--profiler', type=click.Choice(PROFILERS), default='sampling',
+              help='Profiler for --profile: "sampling" covers all threads '
+              'and writes collapsed stacks, "cprofile" only covers the main '
+              'thread and writes pstats data.')
+@click.option('--trace', 'trace_path', type=click.Path(dir_okay=False,
+              writable=True), help='Record tracing spans and write them to '
+              'this file in the Chrome trace format.')
 @click.pass_context
 @_handle_errors
-def coba(ctx, config):
+def coba(ctx, config, profile_path, profiler, trace_path):
     ctx.ensure_object(dict)
 
+    # Profiling and tracing wrap the subcommand and are finished when the
+    # context is closed
+    stack = contextlib.ExitStack()
+    ctx.call_on_close(stack.close)
+    if profile_path:
+        stack.enter_context(profile(Path(profile_path), profiler))
+    if trace_path:
+        tracing.TRACER.enable()
+        stack.callback(tracing.TRACER.write, Path(trace_path))
+        stack.callback(tracing.TRACER.disable)
+
     if config:
         cfg = Config.from_file(Path(config))
     else:
@@ -77,66 +108,269 @@ def coba(ctx, config):
     ctx.obj['log'].addHandler(handler)
     ctx.obj['log'].setLevel(logging.DEBUG)
 
-    ctx.obj['store'] = Store(cfg.store_path)
+    throttle = Throttle(cfg.max_bytes_per_second, cfg.max_files_per_second,
+                        cfg.max_load, cfg.nice, cfg.io_class)
+    ctx.obj['store'] = Store(cfg.store_path, compression=cfg.compression,
+                             chunking=cfg.chunking,
+                             pack_threshold=cfg.pack_threshold,
+                             throttle=throttle)
+
+
+def _rescan(store, cfg, directory):
+    '''
+    Find the files directly in a directory that need a backup.
+    '''
+    return [path for paths in store.find_changed_files(directory, cfg,
+                                                       recursive=False)
+            for path in paths]
+
+
+def _prune_periodically(store, policy, interval, stopped, log):
+    '''
+    Prune old versions and collect garbage in regular intervals.
+
+    Runs until the ``threading.Event`` ``stopped`` is set.
+    '''
+    while not stopped.wait(interval.total_seconds()):
+        try:
+            num_pruned = store.prune(policy)
+            num_removed = store.collect_garbage()
+        except Exception as e:
+            log.exception(e)
+            continue
+        log.info('Pruned {} old versions and {} unreferenced contents'.format(
+                 num_pruned, num_removed))
+
+
+def _get_journal_path(store, directory):
+    '''
+    Return the path of the queue journal for watching a directory.
+    '''
+    key = hashlib.sha1(str(directory).encode('utf-8', 'surrogateescape'))
+    return store.path / 'queue-{}.journal'.format(key.hexdigest()[:16])
 
 
 @coba.command()
+@click.option('--catch-up/--no-catch-up', 'catch_up_on_start', default=True,
+              help='Back up files that changed while not watched.')
 @click.argument('directory', type=click.Path(exists=True, file_okay=False))
 @click.pass_context
 @_handle_errors
-def watch(ctx, directory):
+def watch(ctx, catch_up_on_start, directory):
     '''
     Watch a directory for changes.
     '''
-    directory = Path(directory)
-    queue = FileQueue()
-    handler = EventHandler(queue)
-    with ctx.obj['store'] as store:
-        observer = watchdog.observers.Observer()
+    directory = make_path_absolute(directory)
+    cfg = ctx.obj['config']
+    with contextlib.ExitStack() as stack:
+        store = stack.enter_context(ctx.obj['store'])
+        journal = None
+        if cfg.persistent_queue:
+            journal = stack.enter_context(QueueJournal(
+                _get_journal_path(store, directory)))
+        queue = FileQueue(journal=journal,
+                          rescan=functools.partial(_rescan, store, cfg))
+        handler = EventHandler(queue, cfg)
+        observer = create_observer(cfg)
         observer.schedule(handler, str(directory), recursive=True)
         observer.start()
         click.echo('Watching {}'.format(directory))
-        try:
-            for path in queue:
-                store.put(path)
-        except KeyboardInterrupt:
-            click.echo('Received CTRL+C')
-        click.echo('Stopping observer...')
-        observer.stop()
-        click.echo('Waiting for observer to stop...')
-        observer.join()
+        if catch_up_on_start:
+            # Runs in the background so that files that are modified while
+            # the tree is checked are backed up right away
+            stop_catching_up = threading.Event()
+            catcher = threading.Thread(target=catch_up,
+                                       args=(store, directory, queue, cfg,
+                                             stop_catching_up))
+            catcher.start()
+            # Exit callbacks are called in reverse order, so the thread is
+            # stopped and joined before the store is closed
+            stack.callback(catcher.join)
+            stack.callback(stop_catching_up.set)
+        if cfg.prune_interval:
+            stop_pruning = threading.Event()
+            pruner = threading.Thread(target=_prune_periodically,
+                                      args=(store, cfg.retention,
+                                            cfg.prune_interval, stop_pruning,
+                                            ctx.obj['log']))
+            pruner.start()
+            # Exit callbacks are called in reverse order, so the thread is
+            # stopped and joined before the store is closed
+            stack.callback(pruner.join)
+            stack.callback(stop_pruning.set)
+        worker_type = cfg.worker_type
+        if cfg.chunking and worker_type == 'thread':
+            # The chunker is CPU-bound Python code that would hold the GIL
+            # and stall the other thread workers
+            ctx.obj['log'].info('Using process workers because chunking is '
+                                'enabled')
+            worker_type = 'process'
+        with BackupWorkerPool(store, cfg.workers, worker_type,
+                              cfg.batch_size, cfg.batch_delay,
+                              on_done=queue.mark_done) as pool:
+            metrics.gauge('coba_queue_size',
+                          'Number of files waiting for their backup') \
+                   .set_function(lambda: len(queue))
+            metrics.gauge('coba_backups_pending',
+                          'Number of files that are being backed up') \
+                   .set_function(lambda: len(pool))
+            if cfg.metrics_address:
+                server = stack.enter_context(metrics.MetricsServer(
+                    cfg.metrics_address))
+                click.echo('Serving metrics at {}'.format(server.url))
+            if cfg.metrics_file:
+                stack.enter_context(metrics.MetricsDumper(
+                    cfg.metrics_file, cfg.metrics_interval))
+            try:
+                for path in queue:
+                    pool.submit(path)
+            except KeyboardInterrupt:
+                click.echo('Received CTRL+C')
+            click.echo('Stopping observer...')
+            observer.stop()
+            click.echo('Waiting for observer to stop...')
+            observer.join()
+            click.echo('Waiting for running backups to finish...')
     click.echo('Exiting.')
 
 
 @coba.command()
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.pass_context
+@_handle_errors
+def snapshot(ctx, directory):
+    '''
+    Store all files in a directory tree.
+    '''
+    directory = make_path_absolute(directory)
+    cfg = ctx.obj['config']
+    with ctx.obj['store'] as store:
+        num_stored = store.snapshot(directory, cfg, workers=cfg.workers,
+                                    batch_size=cfg.batch_size)
+    click.echo('Stored {} new versions of files in {}'.format(num_stored,
+               directory))
+
+
+@coba.command()
+@click.option('--keep-last', type=click.IntRange(min=1),
+              help='Maximum number of versions of each file.')
+@click.option('--max-age',
+              help='Maximum age of versions (for example "30 d").')
+@click.pass_context
+@_handle_errors
+def prune(ctx, keep_last, max_age):
+    '''
+    Remove old versions and unreferenced contents.
+    '''
+    policy = ctx.obj['config'].retention
+    if keep_last or max_age:
+        policy = RetentionPolicy(
+            keep_last or policy.keep_last,
+            parse_duration(max_age) if max_age else policy.max_age,
+            policy.thinning)
+    with ctx.obj['store'] as store:
+        num_pruned = store.prune(policy)
+        num_removed = store.collect_garbage()
+    click.echo('Removed {} old versions and {} unreferenced contents'.format(
+               num_pruned, num_removed))
+
+
+@coba.command()
+@click.option('--top', '-n', type=click.IntRange(min=0), default=10,
+              help='Number of files with the largest versions to list.')
+@click.pass_context
+@_handle_errors
+def stats(ctx, top):
+    '''
+    Show statistics of the store.
+    '''
+    with ctx.obj['store'] as store:
+        statistics = store.get_statistics(top=top)
+    click.echo('Versions:    {}'.format(statistics.versions))
+    click.echo('Total size:  {}'.format(format_file_size(statistics.size)))
+    click.echo('Contents:    {}'.format(statistics.contents))
+    click.echo('Stored size: {}'.format(
+               format_file_size(statistics.stored_size)))
+    if statistics.size:
+        click.echo('Saved:       {:.1%}'.format(
+                   1 - statistics.stored_size / statistics.size))
+    if statistics.top_paths:
+        click.echo('Largest files:')
+        for path_statistics in statistics.top_paths:
+            click.echo('  {:>10}  {:6d} versions  {}'.format(
+                       format_file_size(path_statistics.size),
+                       path_statistics.versions, path_statistics.path))
+
+
+@coba.command()
+@click.option('--since', help='List only versions stored at or after this '
+              'time.')
+@click.option('--until', help='List only versions stored at or before this '
+              'time.')
+@click.option('--limit', '-n', type=click.IntRange(min=1),
+              help='Maximum number of versions to list.')
+@click.option('--reverse/--no-reverse', '-r/-R', default=False,
+              help='List the newest versions first.')
+@click.option('--json', 'as_json', is_flag=True,
+              help='Print each version as a line of JSON.')
 @click.argument('path', type=click.Path(dir_okay=False))
 @click.pass_context
 @_handle_errors
-def versions(ctx, path):
+def versions(ctx, since, until, limit, reverse, as_json, path):
     '''
     List the versions of a file.
     '''
     path = Path(path)
+    if since:
+        since = local_to_utc(parse_datetime(since))
+    if until:
+        until = local_to_utc(parse_datetime(until))
     with ctx.obj['store'] as store:
-        for version in store.get_versions(path):
-            stored_at = utc_to_local(version.stored_at)
-            click.echo('{:%Y-%m-%d %H:%M:%S}'.format(stored_at))
+        for version in store.get_versions(path, since=since, until=until,
+                                          limit=limit, reverse=reverse):
+            if as_json:
+                stored_at = version.stored_at.replace(
+                    tzinfo=datetime.timezone.utc)
+                click.echo(json.dumps({
+                    'id': version.id,
+                    'path': str(version.path),
+                    'hash': version.hash,
+                    'stored_at': stored_at.isoformat(),
+                    'size': version.size,
+                }, sort_keys=True))
+            else:
+                stored_at = utc_to_local(version.stored_at)
+                click.echo('{:%Y-%m-%d %H:%M:%S}'.format(stored_at))
 
 
 @coba.command()
 @click.option('--force/--no-force', '-f/-F', default=False)
-@click.option('--to', '-t', type=click.Path(dir_okay=False, writable=True))
+@click.option('--recursive/--no-recursive', '-r/-R', default=False,
+              help='Restore all files in a directory tree.')
+@click.option('--to', '-t', type=click.Path(writable=True))
 @click.argument('when')
-@click.argument('path', type=click.Path(dir_okay=False))
+@click.argument('path', type=click.Path())
 @click.pass_context
 @_handle_errors
-def restore(ctx, force, to, when, path):
+def restore(ctx, force, recursive, to, when, path):
     '''
-    Restore a version of a file.
+    Restore a version of a file or directory tree.
     '''
     path = make_path_absolute(path)
     at = local_to_utc(parse_datetime(when))
     with ctx.obj['store'] as store:
+        if recursive:
+            restored = store.restore_tree(path, at, target=to, force=force)
+            if not restored:
+                raise ValueError('No versions in store for {} at {}'.format(
+                                 path, when))
+            if to:
+                click.echo('Restored {} files of {} to {}'.format(
+                           len(restored), path, to))
+            else:
+                click.echo('Restored {} files of {}'.format(len(restored),
+                           path))
+            return
         version = store.get_version_at(path, at)
         if not version:
             raise ValueError('No version in store for {} at {}'.format(path, when))
@@ -148,4 +382,3 @@ def restore(ctx, force, to, when, path):
         else:
             click.echo('Restored version {:%Y-%m-%d %H:%M:%S} of {}'.format(
                        stored_at, path))
-
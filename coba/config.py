@@ -1,15 +1,68 @@
 #!/usr/bin/env python3
 
+import functools
 from pathlib import Path
+import re
 
-import pathspec
+from pathspec.patterns import GitWildMatchPattern
+from pathspec.util import normalize_file
 import yaml
 
-from .utils import parse_file_size
+from .cas import COMPRESSION_MODES
+from .retention import RetentionPolicy
+from .throttle import IO_CLASSES
+from .utils import parse_duration, parse_file_size
+
+
+# Supported values for the ``worker_type`` configuration option
+WORKER_TYPES = ['thread', 'process']
+
+# Maximum number of directories whose ignore status is cached
+_DIRECTORY_CACHE_SIZE = 65536
+
+_NAMED_GROUP_RE = re.compile(r'\(\?P<\w+>')
+
+
+def _compile_ignores(ignores):
+    '''
+    Compile ignore patterns into a single regular expression.
+
+    ``ignores`` is a list of pattern strings in ``.gitignore`` syntax.
+
+    Returns a tuple containing the compiled expression and a dict that
+    maps the names of its groups to a boolean which says whether a path
+    that matches the corresponding pattern is ignored (``False`` for
+    negated patterns). As in ``.gitignore`` files, the last matching
+    pattern decides. The patterns are therefore combined in reverse
+    order, so that the first matching alternative is the one that
+    decides. Returns ``(None, {})`` if there are no patterns.
+    '''
+    alternatives = []
+    includes = {}
+    for i, ignore in enumerate(ignores):
+        regex, include = GitWildMatchPattern.pattern_to_regex(ignore)
+        if include is None:
+            continue  # Comment or empty line
+        name = 'p{:d}'.format(i)
+        # Groups inside the patterns are made non-capturing, otherwise
+        # their names would collide
+        regex = _NAMED_GROUP_RE.sub('(?:', regex)
+        alternatives.append('(?P<{}>{})'.format(name, regex))
+        includes[name] = include
+    if not alternatives:
+        return None, includes
+    return re.compile('|'.join(reversed(alternatives))), includes
 
 
 class Config:
-    def __init__(self, store_path, max_file_size, ignores):
+    def __init__(self, store_path, max_file_size, ignores, workers=1,
+                 worker_type='thread', batch_size=1, batch_delay=0,
+                 compression='none', chunking=False, pack_threshold=0,
+                 persistent_queue=False, max_bytes_per_second=0,
+                 max_files_per_second=0, max_load=0, nice=0,
+                 io_class='none', retention=None, prune_interval=None,
+                 metrics_address=None, metrics_file=None,
+                 metrics_interval=60):
         '''
         Constructor.
 
@@ -22,11 +75,102 @@ class Config:
         ``ignores`` is a list of pattern strings describing which paths
         to ignore. Their syntax and semantics are those of
         ``.gitignore`` files.
+
+        ``workers`` is the number of workers that back up files in
+        parallel.
+
+        ``worker_type`` is either ``'thread'`` or ``'process'`` and
+        determines whether the backup workers are threads or processes.
+
+        ``batch_size`` is the maximum number of files whose new versions
+        are committed to the store in a single transaction.
+
+        ``batch_delay`` is the maximum number of seconds that a file
+        waits for other files to fill up its batch.
+
+        ``compression`` is the compression mode for new contents in the
+        store, one of ``coba.cas.COMPRESSION_MODES``.
+
+        ``chunking`` is a boolean that determines whether large files are
+        stored in chunks. If it is true then process workers are used
+        even if ``worker_type`` is ``'thread'``.
+
+        ``pack_threshold`` is the size in bytes below which contents are
+        stored in pack files instead of separate files.
+
+        If ``persistent_queue`` is true then the files that are waiting
+        for their backup are recorded on disk, so that they are backed
+        up even if the process is killed in the meantime.
+
+        ``max_bytes_per_second`` and ``max_files_per_second`` limit the
+        rate at which files are read when they are stored, ``0`` means
+        unlimited.
+
+        If ``max_load`` is positive then storing files pauses while the
+        system's one-minute load average is above it.
+
+        ``nice`` is added to the niceness of the threads that store
+        files, and their I/O scheduling class is set to ``io_class``
+        (one of ``coba.throttle.IO_CLASSES``) unless it is ``'none'``.
+
+        ``retention`` is the ``coba.retention.RetentionPolicy`` used for
+        pruning old versions. By default all versions are kept.
+
+        If ``prune_interval`` is a ``datetime.timedelta`` then old
+        versions are pruned in that interval while watching.
+
+        If ``metrics_address`` is given then metrics are served via HTTP
+        while watching, see ``coba.metrics.MetricsServer``.
+
+        If ``metrics_file`` is a ``pathlib.Path`` then metrics are
+        written to it as JSON every ``metrics_interval`` seconds while
+        watching.
         '''
+        if workers < 1:
+            raise ValueError('Number of workers must be positive')
+        if worker_type not in WORKER_TYPES:
+            raise ValueError('Invalid worker type "{}"'.format(worker_type))
+        if batch_size < 1:
+            raise ValueError('Batch size must be positive')
+        if batch_delay < 0:
+            raise ValueError('Batch delay must not be negative')
+        if compression not in COMPRESSION_MODES:
+            raise ValueError('Invalid compression mode "{}"'.format(
+                             compression))
+        if pack_threshold < 0:
+            raise ValueError('Pack threshold must not be negative')
+        if max_bytes_per_second < 0 or max_files_per_second < 0:
+            raise ValueError('Rate limits must not be negative')
+        if max_load < 0:
+            raise ValueError('Maximum load must not be negative')
+        if io_class not in IO_CLASSES:
+            raise ValueError('Invalid I/O class "{}"'.format(io_class))
+        if metrics_interval <= 0:
+            raise ValueError('Metrics interval must be positive')
         self.store_path = store_path
         self.max_file_size = max_file_size
         self.ignores = ignores
-        self._pathspec = pathspec.PathSpec.from_lines('gitwildmatch', ignores)
+        self.workers = workers
+        self.worker_type = worker_type
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.compression = compression
+        self.chunking = chunking
+        self.pack_threshold = pack_threshold
+        self.persistent_queue = persistent_queue
+        self.max_bytes_per_second = max_bytes_per_second
+        self.max_files_per_second = max_files_per_second
+        self.max_load = max_load
+        self.nice = nice
+        self.io_class = io_class
+        self.retention = retention or RetentionPolicy()
+        self.prune_interval = prune_interval or None
+        self.metrics_address = metrics_address or None
+        self.metrics_file = metrics_file or None
+        self.metrics_interval = metrics_interval
+        self._ignore_regex, self._ignore_includes = _compile_ignores(ignores)
+        self._is_directory_ignored = functools.lru_cache(
+            maxsize=_DIRECTORY_CACHE_SIZE)(self._match_directory)
 
     @classmethod
     def from_file(cls, path):
@@ -43,16 +187,126 @@ class Config:
             max_file_size = parse_file_size(y['max_file_size'])
         except KeyError:
             max_file_size = DEFAULT_CONFIG.max_file_size
-        return cls(store_path, max_file_size, ignores)
+        workers = int(y.get('workers', DEFAULT_CONFIG.workers))
+        worker_type = y.get('worker_type', DEFAULT_CONFIG.worker_type)
+        batch_size = int(y.get('batch_size', DEFAULT_CONFIG.batch_size))
+        batch_delay = float(y.get('batch_delay', DEFAULT_CONFIG.batch_delay))
+        compression = y.get('compression', DEFAULT_CONFIG.compression)
+        chunking = bool(y.get('chunking', DEFAULT_CONFIG.chunking))
+        try:
+            pack_threshold = parse_file_size(str(y['pack_threshold']))
+        except KeyError:
+            pack_threshold = DEFAULT_CONFIG.pack_threshold
+        persistent_queue = bool(y.get('persistent_queue',
+                                      DEFAULT_CONFIG.persistent_queue))
+        try:
+            max_bytes_per_second = parse_file_size(
+                str(y['max_bytes_per_second']))
+        except KeyError:
+            max_bytes_per_second = DEFAULT_CONFIG.max_bytes_per_second
+        max_files_per_second = float(y.get(
+            'max_files_per_second', DEFAULT_CONFIG.max_files_per_second))
+        max_load = float(y.get('max_load', DEFAULT_CONFIG.max_load))
+        nice = int(y.get('nice', DEFAULT_CONFIG.nice))
+        io_class = y.get('io_class', DEFAULT_CONFIG.io_class)
+        try:
+            retention = RetentionPolicy.from_dict(y['retention'] or {})
+        except KeyError:
+            retention = DEFAULT_CONFIG.retention
+        try:
+            prune_interval = y['prune_interval']
+        except KeyError:
+            prune_interval = DEFAULT_CONFIG.prune_interval
+        else:
+            if prune_interval is not None:
+                prune_interval = parse_duration(str(prune_interval))
+        metrics_address = y.get('metrics_address',
+                                DEFAULT_CONFIG.metrics_address)
+        if metrics_address is not None:
+            metrics_address = str(metrics_address)
+        try:
+            metrics_file = y['metrics_file']
+        except KeyError:
+            metrics_file = DEFAULT_CONFIG.metrics_file
+        else:
+            if metrics_file is not None:
+                metrics_file = Path(metrics_file)
+        metrics_interval = float(y.get('metrics_interval',
+                                       DEFAULT_CONFIG.metrics_interval))
+        return cls(store_path, max_file_size, ignores, workers=workers,
+                   worker_type=worker_type, batch_size=batch_size,
+                   batch_delay=batch_delay, compression=compression,
+                   chunking=chunking, pack_threshold=pack_threshold,
+                   persistent_queue=persistent_queue,
+                   max_bytes_per_second=max_bytes_per_second,
+                   max_files_per_second=max_files_per_second,
+                   max_load=max_load, nice=nice, io_class=io_class,
+                   retention=retention, prune_interval=prune_interval,
+                   metrics_address=metrics_address, metrics_file=metrics_file,
+                   metrics_interval=metrics_interval)
+
+    def _matches(self, *paths):
+        '''
+        Check if a normalized path string matches the ignore patterns.
+
+        If several variants of the path are given then the last pattern
+        that matches any of them decides.
+        '''
+        if self._ignore_regex is None:
+            return False
+        matches = [match.lastgroup for match in
+                   map(self._ignore_regex.match, paths) if match is not None]
+        if not matches:
+            return False
+        return self._ignore_includes[max(matches, key=lambda name:
+                                         int(name[1:]))]
+
+    def _match_directory(self, path):
+        '''
+        Check if a directory is ignored.
+
+        ``path`` is a normalized path string. The results of this method
+        are cached, see ``__init__``.
+        '''
+        parent = path.rpartition('/')[0]
+        if parent and self._is_directory_ignored(parent):
+            # As in Git, files in an ignored directory cannot be re-included
+            return True
+        # Patterns with a trailing slash only match the first variant. With
+        # some versions of pathspec, patterns without one (like "!.keep")
+        # only match the second.
+        return self._matches(path + '/', path)
 
-    def is_file_ignored(self, path):
+    def is_directory_ignored(self, path):
+        '''
+        Check if a directory is ignored.
+
+        A directory is ignored if it matches an ignore pattern or if one
+        of its parent directories is ignored.
+        '''
+        path = normalize_file(str(path)).rstrip('/')
+        return bool(path) and self._is_directory_ignored(path)
+
+    def is_file_ignored(self, path, size=None):
         '''
         Check if a file is ignored.
 
+        A file is ignored if it is in an ignored directory, if it matches
+        an ignore pattern, or if it is larger than the maximum file size.
+        The file's size is only checked if it is not ignored otherwise.
         If the file does not exist its size is assumed to be 0.
+
+        If ``size`` is given then it is used as the file's size instead
+        of checking the file.
         '''
-        if self._pathspec.match_file(str(path)):
+        normalized = normalize_file(str(path))
+        parent = normalized.rpartition('/')[0]
+        if parent and self._is_directory_ignored(parent):
+            return True
+        if self._matches(normalized):
             return True
+        if size is not None:
+            return size > self.max_file_size
         try:
             file_size = path.stat().st_size
         except FileNotFoundError:
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import errno
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Not available on Windows
+    fcntl = None
+
+
+__all__ = ['BUFFERED', 'COPY_FILE_RANGE', 'copy_file', 'copy_fileobj',
+           'REFLINK', 'reflink', 'SENDFILE']
+
+
+log = logging.getLogger(__name__)
+
+
+# Names of the copy strategies
+REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+SENDFILE = 'sendfile'
+BUFFERED = 'buffered'
+
+# ioctl request code for cloning a file on Linux, see ``ioctl_ficlone(2)``
+_FICLONE = 0x40049409
+
+# Error codes which signal that a strategy is not supported for a pair of
+# files, in which case the next strategy is tried
+_UNSUPPORTED_ERRNOS = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EPERM,
+    errno.EXDEV,
+}
+
+# Maximum number of bytes copied by a single system call
+_CHUNK_SIZE = 64 * 1024**2
+
+# Strategies that failed for a combination of source and target device. They
+# are not tried again for that combination.
+_unsupported = set()
+
+
+def _is_unsupported(strategy, source_fd, target_fd):
+    key = (strategy, os.fstat(source_fd).st_dev, os.fstat(target_fd).st_dev)
+    return key in _unsupported
+
+
+def _mark_unsupported(strategy, source_fd, target_fd, error):
+    key = (strategy, os.fstat(source_fd).st_dev, os.fstat(target_fd).st_dev)
+    _unsupported.add(key)
+    log.debug('Copy strategy {} is not supported: {}'.format(strategy, error))
+
+
+def reflink(source, target):
+    '''
+    Clone a file's content using a reflink.
+
+    ``source`` and ``target`` are open binary file objects. The target
+    must be empty. On file systems that support it (for example Btrfs
+    and XFS), the clone shares the source's data blocks until either file
+    is modified, which makes cloning independent of the file size.
+
+    Returns ``True`` if the content was cloned and ``False`` if reflinks
+    are not supported for the two files.
+    '''
+    if fcntl is None:  # pragma: no cover
+        return False
+    source_fd = source.fileno()
+    target_fd = target.fileno()
+    if _is_unsupported(REFLINK, source_fd, target_fd):
+        return False
+    try:
+        fcntl.ioctl(target_fd, _FICLONE, source_fd)
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+        _mark_unsupported(REFLINK, source_fd, target_fd, e)
+        return False
+    return True
+
+
+def _copy_with_syscall(strategy, syscall, source_fd, target_fd):
+    '''
+    Copy a file's content using an in-kernel copy system call.
+
+    Returns ``True`` if the content was copied and ``False`` if the
+    system call is not supported for the two files.
+    '''
+    if _is_unsupported(strategy, source_fd, target_fd):
+        return False
+    offset = 0
+    while True:
+        try:
+            num_bytes = syscall(source_fd, target_fd, offset)
+        except OSError as e:
+            if offset or e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            _mark_unsupported(strategy, source_fd, target_fd, e)
+            return False
+        if not num_bytes:
+            return True
+        offset += num_bytes
+
+
+def _copy_file_range(source_fd, target_fd, offset):
+    return os.copy_file_range(source_fd, target_fd, _CHUNK_SIZE, offset,
+                              offset)
+
+
+def _sendfile(source_fd, target_fd, offset):
+    return os.sendfile(target_fd, source_fd, offset, _CHUNK_SIZE)
+
+
+def copy_fileobj(source, target):
+    '''
+    Copy the content of a file into another file.
+
+    ``source`` and ``target`` are open binary file objects, positioned
+    at their beginning. The target must be empty.
+
+    The first supported strategy of the following is used:
+
+    1. Cloning the file via a reflink (``REFLINK``)
+    2. An in-kernel copy via ``os.copy_file_range`` (``COPY_FILE_RANGE``)
+    3. An in-kernel copy via ``os.sendfile`` (``SENDFILE``)
+    4. A copy via user space buffers (``BUFFERED``)
+
+    Returns the name of the strategy that was used.
+    '''
+    if reflink(source, target):
+        return REFLINK
+    source_fd = source.fileno()
+    target_fd = target.fileno()
+    if hasattr(os, 'copy_file_range'):
+        if _copy_with_syscall(COPY_FILE_RANGE, _copy_file_range, source_fd,
+                              target_fd):
+            return COPY_FILE_RANGE
+    if hasattr(os, 'sendfile'):
+        if _copy_with_syscall(SENDFILE, _sendfile, source_fd, target_fd):
+            return SENDFILE
+    shutil.copyfileobj(source, target, _CHUNK_SIZE)
+    return BUFFERED
+
+
+def copy_file(source_path, target_path):
+    '''
+    Copy the content of a file.
+
+    ``source_path`` and ``target_path`` are ``pathlib.Path`` instances.
+    If the target file exists it is overwritten.
+
+    See ``copy_fileobj`` for the strategies that are used. Returns the
+    name of the strategy that was used.
+    '''
+    with source_path.open('rb') as source, target_path.open('wb') as target:
+        strategy = copy_fileobj(source, target)
+    log.debug('Copied {} to {} using {}'.format(source_path, target_path,
+              strategy))
+    return strategy
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import json
+import logging
+import os
+from pathlib import Path
+import tempfile
+import threading
+
+
+__all__ = ['QueueJournal']
+
+
+log = logging.getLogger(__name__)
+
+
+# Seconds between two writes of the journal to disk
+_FLUSH_INTERVAL_SECONDS = 1
+
+# Minimum number of journal entries before the journal is compacted
+_MIN_COMPACTION_ENTRIES = 1000
+
+
+def _fsync_directory(path):
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class QueueJournal:
+    '''
+    Persistent record of the files that are waiting for their backup.
+
+    The journal is an append-only text file. Each line is an entry that
+    either adds a file (``+`` followed by the JSON-encoded path) or
+    marks it as done (``-`` followed by the path). Entries are buffered
+    in memory and written and synced to disk by a background thread
+    every ``flush_interval`` seconds, so recording an entry never waits
+    for the disk. If the process is killed then at most the entries of
+    the last interval are lost.
+
+    When the journal is opened, the pending files are read from it and
+    it is rewritten to contain only those. A partially written entry at
+    the end of the file (from a crash during a write) is ignored. While
+    the journal is open it is compacted in the same way once it contains
+    many more entries than pending files.
+    '''
+    def __init__(self, path, flush_interval=_FLUSH_INTERVAL_SECONDS):
+        '''
+        Constructor.
+
+        ``path`` is the ``pathlib.Path`` of the journal file. It is
+        created if it does not exist.
+        '''
+        self.path = path
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        self._buffer = []
+        self._file = None
+        self._num_entries = 0
+        self._closed = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    @property
+    def pending(self):
+        '''
+        List of the files that are pending, in the order they were added.
+        '''
+        with self._lock:
+            return list(self._pending)
+
+    def open(self):
+        '''
+        Open the journal and start writing it in the background.
+        '''
+        self._read()
+        self._rewrite(list(self._pending))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        log.debug('Opened queue journal {} with {} pending files'.format(
+                  self.path, len(self._pending)))
+
+    def _read(self):
+        try:
+            f = self.path.open('r', encoding='ascii')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError('Incomplete entry')
+                    path = Path(json.loads(line[1:]))
+                    if line[0] == '+':
+                        self._pending[path] = True
+                    elif line[0] == '-':
+                        self._pending.pop(path, None)
+                    else:
+                        raise ValueError('Unknown entry type')
+                except ValueError as e:
+                    log.warning('Ignoring invalid entry in {}: {}'.format(
+                                self.path, e))
+
+    def _rewrite(self, paths):
+        '''
+        Atomically replace the journal file by one that contains only
+        the given pending files.
+        '''
+        with tempfile.NamedTemporaryFile('w', encoding='ascii',
+                                         dir=str(self.path.parent),
+                                         delete=False) as f:
+            try:
+                f.write(''.join(_entry('+', path) for path in paths))
+                f.flush()
+                os.fsync(f.fileno())
+            except:
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, str(self.path))
+        _fsync_directory(self.path.parent)
+        if self._file is not None:
+            self._file.close()
+        self._file = self.path.open('a', encoding='ascii')
+        self._num_entries = len(paths)
+
+    def add(self, path):
+        '''
+        Record that a file is waiting for its backup.
+
+        Nothing is recorded if the file is already pending.
+        '''
+        with self._lock:
+            if path not in self._pending:
+                self._pending[path] = True
+                self._buffer.append(_entry('+', path))
+
+    def done(self, paths):
+        '''
+        Record that files have been backed up.
+        '''
+        with self._lock:
+            for path in paths:
+                if self._pending.pop(path, None):
+                    self._buffer.append(_entry('-', path))
+
+    def flush(self):
+        '''
+        Write and sync buffered entries to disk.
+        '''
+        with self._flush_lock:
+            with self._lock:
+                entries = self._buffer
+                self._buffer = []
+                num_entries = self._num_entries + len(entries)
+                compact = num_entries > max(2 * len(self._pending),
+                                            _MIN_COMPACTION_ENTRIES)
+                if compact:
+                    # The pending files already reflect the buffered entries.
+                    # Entries that are added after this point are buffered
+                    # and written to the new file.
+                    pending = list(self._pending)
+            if compact:
+                self._rewrite(pending)
+            elif entries:
+                self._file.write(''.join(entries))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._num_entries = num_entries
+
+    def _run(self):
+        while not self._closed.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                log.error('Could not write queue journal {}: {}'.format(
+                          self.path, e))
+
+    def close(self):
+        '''
+        Write all buffered entries and close the journal.
+        '''
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+
+def _entry(kind, path):
+    return kind + json.dumps(str(path)) + '\n'
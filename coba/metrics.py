@@ -0,0 +1,552 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import contextlib
+import http.server
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import socketserver
+import tempfile
+import threading
+import time
+
+
+__all__ = ['Counter', 'counter', 'DEDUP_HITS', 'ERRORS', 'Gauge', 'gauge',
+           'Histogram', 'histogram', 'MetricsDumper', 'MetricsServer',
+           'PUT_PHASE_SECONDS', 'Registry', 'REGISTRY']
+
+
+log = logging.getLogger(__name__)
+
+
+# Default upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+# Prefix of metrics server addresses that are paths of Unix sockets
+UNIX_PREFIX = 'unix:'
+
+# Content type of the Prometheus text exposition format
+_PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '{:.1f}'.format(value)
+    return repr(value)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value))
+                          for name, value in labels) + '}'
+
+
+class _CounterValue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        '''
+        Increment the counter by a non-negative amount.
+        '''
+        if amount < 0:
+            raise ValueError('Counters can only be incremented')
+        with self._lock:
+            self.value += amount
+
+    def _lines(self, name, labels):
+        yield '{}{} {}'.format(name, _format_labels(labels),
+                               _format_value(self.value))
+
+    def _to_dict(self):
+        return {'value': self.value}
+
+
+class _GaugeValue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+        self._function = None
+
+    @property
+    def value(self):
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        '''
+        Compute the gauge's value by calling ``function`` whenever the
+        value is read.
+        '''
+        self._function = function
+
+    def _lines(self, name, labels):
+        yield '{}{} {}'.format(name, _format_labels(labels),
+                               _format_value(self.value))
+
+    def _to_dict(self):
+        return {'value': self.value}
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._bounds = list(buckets) + [math.inf]
+        self._counts = [0] * len(self._bounds)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        '''
+        Record an observed value.
+        '''
+        with self._lock:
+            for i, bound in enumerate(self._bounds):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        '''
+        Context manager that observes the time it takes to run.
+        '''
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start)
+
+    def _cumulative_counts(self):
+        with self._lock:
+            counts = list(self._counts)
+            total, sum_ = self.count, self.sum
+        cumulative = []
+        running = 0
+        for bound, count in zip(self._bounds, counts):
+            running += count
+            cumulative.append((bound, running))
+        return cumulative, total, sum_
+
+    def _lines(self, name, labels):
+        cumulative, count, sum_ = self._cumulative_counts()
+        for bound, running in cumulative:
+            bucket_labels = labels + [('le', _format_value(bound))]
+            yield '{}_bucket{} {:d}'.format(
+                name, _format_labels(bucket_labels), running)
+        yield '{}_sum{} {}'.format(name, _format_labels(labels),
+                                  _format_value(sum_))
+        yield '{}_count{} {:d}'.format(name, _format_labels(labels), count)
+
+    def _to_dict(self):
+        cumulative, count, sum_ = self._cumulative_counts()
+        return {
+            'count': count,
+            'sum': sum_,
+            'buckets': {_format_value(bound): running
+                        for bound, running in cumulative},
+        }
+
+
+class _Metric:
+    '''
+    A named metric, optionally with labels.
+
+    A metric with labels has a separate value for each combination of
+    label values, see ``labels``. The methods of a metric without
+    labels are those of its single value.
+    '''
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        if not self.labelnames:
+            self._values[()] = self._new_value()
+
+    def _new_value(self):
+        raise NotImplementedError()
+
+    def labels(self, *values):
+        '''
+        Return the value for a combination of label values.
+        '''
+        if len(values) != len(self.labelnames):
+            raise ValueError('Expected {} label values'.format(
+                             len(self.labelnames)))
+        values = tuple(str(value) for value in values)
+        with self._lock:
+            try:
+                return self._values[values]
+            except KeyError:
+                value = self._values[values] = self._new_value()
+                return value
+
+    def __getattr__(self, attr):
+        if attr.startswith('_') or self.labelnames:
+            raise AttributeError(attr)
+        return getattr(self._values[()], attr)
+
+    def _items(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(list(zip(self.labelnames, values)), value)
+                for values, value in items]
+
+    def _lines(self):
+        yield '# HELP {} {}'.format(self.name, self.help.replace('\n', ' '))
+        yield '# TYPE {} {}'.format(self.name, self.type)
+        for labels, value in self._items():
+            yield from value._lines(self.name, labels)
+
+    def _to_dict(self):
+        samples = []
+        for labels, value in self._items():
+            sample = {'labels': dict(labels)}
+            sample.update(value._to_dict())
+            samples.append(sample)
+        return {'type': self.type, 'help': self.help, 'samples': samples}
+
+
+class Counter(_Metric):
+    '''
+    A value that only increases, like the number of processed files.
+    '''
+    type = 'counter'
+
+    def _new_value(self):
+        return _CounterValue()
+
+
+class Gauge(_Metric):
+    '''
+    A value that can increase and decrease, like the size of a queue.
+    '''
+    type = 'gauge'
+
+    def _new_value(self):
+        return _GaugeValue()
+
+
+class Histogram(_Metric):
+    '''
+    A distribution of observed values, like durations.
+    '''
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+        super().__init__(name, help, labelnames)
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+
+class Registry:
+    '''
+    A collection of metrics.
+
+    Metrics are identified by their names. Asking for a metric that
+    already exists returns the existing one, so different modules can
+    share a metric.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('Metric "{}" is a {}'.format(name,
+                                 metric.type))
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        '''
+        Get or create a ``Counter``.
+        '''
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        '''
+        Get or create a ``Gauge``.
+        '''
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        '''
+        Get or create a ``Histogram``.
+        '''
+        return self._get(Histogram, name, help, labelnames, buckets)
+
+    def _sorted_metrics(self):
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+    def render(self):
+        '''
+        Return the metrics in Prometheus' text exposition format.
+        '''
+        lines = []
+        for metric in self._sorted_metrics():
+            lines.extend(metric._lines())
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        '''
+        Return the metrics as a JSON-serializable dict.
+        '''
+        return {metric.name: metric._to_dict()
+                for metric in self._sorted_metrics()}
+
+
+# Default registry, which contains the metrics of the ``coba`` modules. Note
+# that metrics are per process, so work done in worker processes is not
+# included.
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+# Metrics that are updated by several modules
+DEDUP_HITS = counter(
+    'coba_dedup_hits_total',
+    'Number of contents that were not stored because they already were')
+PUT_PHASE_SECONDS = histogram(
+    'coba_put_phase_seconds',
+    'Duration of the phases of storing files. "copy" is the whole storing '
+    'of a content, including "cas_write".', ['phase'])
+ERRORS = counter('coba_errors_total', 'Number of errors', ['kind'])
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Serves ``/metrics`` in Prometheus' format and ``/metrics.json``.
+    '''
+    def do_GET(self):
+        registry = self.server.registry
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            body = registry.render().encode('utf-8')
+            content_type = _PROMETHEUS_CONTENT_TYPE
+        elif path == '/metrics.json':
+            body = json.dumps(registry.to_dict()).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address or 'local')
+
+    def log_message(self, format, *args):
+        log.debug('Metrics request from {}: {}'.format(
+                  self.address_string(), format % args))
+
+
+class _TCPMetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixMetricsServer(socketserver.ThreadingMixIn,
+                         socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        # Expected by ``BaseHTTPRequestHandler``
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class MetricsServer:
+    '''
+    HTTP server for the metrics of a registry.
+
+    The metrics are served at ``/metrics`` in Prometheus' text format and
+    at ``/metrics.json`` as JSON.
+    '''
+    def __init__(self, address, registry=REGISTRY):
+        '''
+        Constructor.
+
+        ``address`` is either ``HOST:PORT`` for a TCP socket or
+        ``unix:PATH`` for a Unix socket. An existing socket file at
+        ``PATH`` is replaced.
+
+        The server is started in a background thread.
+        '''
+        self.address = address
+        if address.startswith(UNIX_PREFIX):
+            self._socket_path = Path(address[len(UNIX_PREFIX):])
+            try:
+                self._socket_path.unlink()
+            except FileNotFoundError:
+                pass
+            self._server = _UnixMetricsServer(str(self._socket_path),
+                                              _MetricsRequestHandler)
+        else:
+            self._socket_path = None
+            host, _, port = address.rpartition(':')
+            if not host:
+                raise ValueError('Invalid metrics address "{}"'.format(
+                                 address))
+            self._server = _TCPMetricsServer((host, int(port)),
+                                             _MetricsRequestHandler)
+        self._server.registry = registry
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        log.info('Serving metrics at {}'.format(self.url))
+
+    @property
+    def url(self):
+        '''
+        The URL of the metrics (or the socket address for Unix sockets).
+        '''
+        if self._socket_path is not None:
+            return self.address
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/metrics'.format(host, port)
+
+    def close(self):
+        '''
+        Stop the server.
+        '''
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        if self._socket_path is not None:
+            try:
+                self._socket_path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+class MetricsDumper:
+    '''
+    Periodically writes the metrics of a registry to a JSON file.
+
+    The file is replaced atomically, so readers never see a partially
+    written file. It is written a last time when the dumper is closed.
+    '''
+    def __init__(self, path, interval=60, registry=REGISTRY):
+        '''
+        Constructor.
+
+        ``path`` is the ``pathlib.Path`` of the JSON file and ``interval``
+        the number of seconds between two dumps.
+
+        The dumps are written in a background thread.
+        '''
+        self.path = path
+        self._interval = interval
+        self._registry = registry
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def dump(self):
+        '''
+        Write the metrics to the file.
+        '''
+        data = {
+            'timestamp': time.time(),
+            'metrics': self._registry.to_dict(),
+        }
+        fd, temp_path = tempfile.mkstemp(dir=str(self.path.parent),
+                                         prefix=self.path.name + '.')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.replace(temp_path, str(self.path))
+        except:
+            os.unlink(temp_path)
+            raise
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.dump()
+            except Exception as e:
+                log.error('Could not write metrics to {}: {}'.format(
+                          self.path, e))
+
+    def close(self):
+        '''
+        Stop the background thread and write the metrics a last time.
+        '''
+        self._stopped.set()
+        self._thread.join()
+        self.dump()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
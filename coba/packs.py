@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import contextlib
+import fcntl
+import logging
+import os
+import struct
+import threading
+import time
+
+
+__all__ = ['PackEntry', 'PackStore']
+
+
+log = logging.getLogger(__name__)
+
+
+# Index record: binary SHA-1 hash, storage mode, offset and length in the pack
+_RECORD = struct.Struct('>20sBQQ')
+
+# Codes of the storage modes in index records
+_MODE_CODES = {
+    'none': 0,
+    'zlib': 1,
+    'lzma': 2,
+    'chunks': 3,
+}
+_MODES = {code: mode for mode, code in _MODE_CODES.items()}
+
+# Maximum size of a pack file in bytes. Once a pack is full, a new one is
+# started.
+_MAX_PACK_SIZE = 64 * 1024**2
+
+# Packs in which at least this fraction of the bytes does not belong to
+# referenced contents are compacted
+_MIN_DEAD_RATIO = 0.5
+
+
+PackEntry = collections.namedtuple('PackEntry',
+                                   ['pack', 'offset', 'length', 'mode'])
+
+
+class PackStore:
+    '''
+    Storage for small contents in pack files.
+
+    Storing each small content in a separate file wastes inodes and
+    makes lookups slow once there are millions of them. Instead, small
+    contents are appended to pack files. Each pack file ``pack-N.pack``
+    has an append-only index ``pack-N.idx`` of fixed-size records that
+    map a content's hash to its offset and length in the pack. The
+    indexes are loaded into memory when the store is opened.
+
+    Appends are serialized using a lock file, so multiple processes can
+    use the same pack store. Entries appended by other processes are
+    picked up when a lookup fails.
+
+    A content's data is synced to disk before its index record is
+    appended, and the index record is synced before ``put`` returns. A
+    content is therefore never referenced before it is stored durably.
+    An incomplete index record left behind by a crash is removed before
+    the next record is appended to that index.
+
+    Contents cannot be removed from a pack individually. Instead, a pack
+    that mostly contains unreferenced contents is compacted: its
+    referenced contents are appended to the newest pack and the pack is
+    removed, see ``compact``.
+    '''
+    def __init__(self, path, max_pack_size=_MAX_PACK_SIZE):
+        '''
+        Constructor.
+
+        ``path`` is the ``pathlib.Path`` of the directory that contains
+        the pack files. It is created if it does not exist.
+        '''
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._max_pack_size = max_pack_size
+        self._lock = threading.RLock()
+        self._entries = {}
+        # Number of the newest pack
+        self._current = 0
+        # Number of bytes of each pack's index that have been loaded
+        self._index_positions = {}
+        self._read_fds = {}
+        torn = [index_path for index_path in self.path.glob('pack-*.idx')
+                if index_path.stat().st_size % _RECORD.size]
+        if torn:
+            with self._locked():
+                for index_path in torn:
+                    self._truncate_index(index_path)
+        with self._lock:
+            self._refresh()
+
+    def _pack_path(self, number):
+        return self.path / 'pack-{:06d}.pack'.format(number)
+
+    def _index_path(self, number):
+        return self.path / 'pack-{:06d}.idx'.format(number)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        '''
+        Context manager that holds the thread lock and the lock file.
+        '''
+        with self._lock, (self.path / 'lock').open('a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def _truncate_index(self, index_path):
+        '''
+        Remove an incomplete record from the end of an index.
+
+        Must be called while holding the lock file.
+        '''
+        try:
+            size = index_path.stat().st_size
+        except FileNotFoundError:
+            return
+        excess = size % _RECORD.size
+        if excess:
+            log.warning('Removing incomplete record from {}'.format(
+                        index_path))
+            os.truncate(str(index_path), size - excess)
+
+    def _sync_directory(self):
+        '''
+        Sync the directory, so that newly created files survive a crash.
+        '''
+        fd = os.open(str(self.path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _pack_size(self, number):
+        try:
+            return self._pack_path(number).stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def _index_numbers(self):
+        '''
+        Return the sorted numbers of the packs that have an index.
+        '''
+        return sorted(int(name[len('pack-'):-len('.idx')])
+                      for name in os.listdir(str(self.path))
+                      if name.startswith('pack-') and name.endswith('.idx'))
+
+    def _refresh(self):
+        '''
+        Load index records that have been appended since the last call.
+
+        Must be called while holding the lock.
+        '''
+        numbers = self._index_numbers()
+        if not set(self._index_positions).issubset(numbers):
+            # Packs have been compacted by another process, their entries
+            # are reloaded from the remaining indexes
+            for number in set(self._index_positions).difference(numbers):
+                self._close_pack(number)
+            self._entries.clear()
+            self._index_positions.clear()
+        for number in numbers:
+            # Only the newest pack grows, older ones are loaded only once
+            if number >= self._current or number not in self._index_positions:
+                self._load_index(number)
+        if numbers:
+            self._current = max(self._current, numbers[-1])
+
+    def _load_index(self, number):
+        '''
+        Load the new records of a pack's index.
+
+        Must be called while holding the lock.
+        '''
+        position = self._index_positions.get(number, 0)
+        try:
+            with self._index_path(number).open('rb') as f:
+                f.seek(position)
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        # A record that is currently being written is ignored
+        num_records = len(data) // _RECORD.size
+        for i in range(num_records):
+            hash, code, offset, length = _RECORD.unpack_from(
+                data, i * _RECORD.size)
+            # A content that has been moved by compaction may still be
+            # listed in the index of its old pack
+            entry = self._entries.get(hash)
+            if entry is None or entry.pack <= number:
+                self._entries[hash] = PackEntry(number, offset, length,
+                                                _MODES[code])
+        self._index_positions[number] = position + num_records * _RECORD.size
+
+    def get(self, hash):
+        '''
+        Look up a content.
+
+        ``hash`` is the hex SHA-1 hash of the content.
+
+        Returns a ``PackEntry`` or ``None`` if the content is not
+        stored in a pack.
+        '''
+        key = bytes.fromhex(hash)
+        entry = self._entries.get(key)
+        # The entry's pack may have been compacted by another process
+        if entry is None or not self._index_path(entry.pack).exists():
+            with self._lock:
+                self._refresh()
+                entry = self._entries.get(key)
+        return entry
+
+    def __contains__(self, hash):
+        return self.get(hash) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def read(self, entry):
+        '''
+        Read the stored data of a content.
+
+        ``entry`` is the content's ``PackEntry``.
+
+        Returns the data as ``bytes``, in the content's storage mode.
+        '''
+        # Reading while holding the lock makes sure that the file is not
+        # closed in between because its pack is compacted
+        with self._lock:
+            try:
+                fd = self._read_fds[entry.pack]
+            except KeyError:
+                fd = os.open(str(self._pack_path(entry.pack)), os.O_RDONLY)
+                self._read_fds[entry.pack] = fd
+            data = os.pread(fd, entry.length, entry.offset)
+        if len(data) != entry.length:
+            raise IOError('Pack {} is truncated'.format(entry.pack))
+        return data
+
+    def put(self, hash, data, mode):
+        '''
+        Store a content.
+
+        ``hash`` is the hex SHA-1 hash of the content, ``data`` its
+        stored data (as ``bytes``) and ``mode`` the corresponding storage
+        mode.
+
+        Nothing happens if the content is already stored.
+        '''
+        key = bytes.fromhex(hash)
+        with self._locked():
+            self._refresh()
+            if key in self._entries:
+                return
+            self._append([(key, data, mode)])
+
+    def _append(self, contents):
+        '''
+        Append contents to the newest pack.
+
+        ``contents`` is a list of ``(key, data, mode)`` tuples, where
+        ``key`` is the binary hash of a content.
+
+        Must be called while holding the lock file.
+        '''
+        self._truncate_index(self._index_path(self._current))
+        offset = self._pack_size(self._current)
+        batch = []
+        for key, data, mode in contents:
+            if offset and offset + len(data) > self._max_pack_size:
+                self._write(batch)
+                batch = []
+                self._current += 1
+                # A crash may have left unreferenced data in the new pack
+                offset = self._pack_size(self._current)
+            batch.append((key, data, mode, offset))
+            offset += len(data)
+        self._write(batch)
+
+    def _write(self, batch):
+        '''
+        Write contents and their index records to the newest pack.
+
+        ``batch`` is a list of ``(key, data, mode, offset)`` tuples.
+
+        Must be called while holding the lock file.
+        '''
+        if not batch:
+            return
+        index_path = self._index_path(self._current)
+        pack_path = self._pack_path(self._current)
+        is_new_pack = not (index_path.exists() and pack_path.exists())
+        # The data is synced before its index records are written, so a
+        # crash can at most leave unreferenced data in the pack
+        with pack_path.open('ab') as pack:
+            for _, data, _, _ in batch:
+                pack.write(data)
+            pack.flush()
+            os.fsync(pack.fileno())
+        records = b''.join(_RECORD.pack(key, _MODE_CODES[mode], offset,
+                                        len(data))
+                           for key, data, mode, offset in batch)
+        # The records are synced before returning, since the caller may
+        # record a version that references the contents
+        with index_path.open('ab') as index:
+            index.write(records)
+            index.flush()
+            os.fsync(index.fileno())
+        if is_new_pack:
+            self._sync_directory()
+        self._index_positions[self._current] = (
+            self._index_positions.get(self._current, 0) + len(records))
+        for key, data, mode, offset in batch:
+            self._entries[key] = PackEntry(self._current, offset, len(data),
+                                           mode)
+
+    def get_packs(self):
+        '''
+        Return the numbers of the packs, oldest first.
+        '''
+        with self._lock:
+            self._refresh()
+            return sorted(self._index_positions)
+
+    def compact(self, number, find_referenced, min_age=0,
+                min_dead_ratio=_MIN_DEAD_RATIO):
+        '''
+        Remove unreferenced contents from a pack.
+
+        ``number`` is the number of the pack. ``find_referenced`` is
+        called with a list of the hex hashes of the pack's contents and
+        returns the set of those that are still referenced.
+
+        If at least ``min_dead_ratio`` of the pack's bytes do not belong
+        to referenced contents then the referenced contents are appended
+        to the newest pack and the pack is removed. Packs that have been
+        modified less than ``min_age`` seconds ago are left alone, since
+        they may contain new contents that are not referenced yet.
+
+        Returns the number of removed contents.
+        '''
+        with self._locked():
+            self._refresh()
+            if number not in self._index_positions:
+                return 0
+            size = self._pack_size(number)
+            try:
+                mtime = self._pack_path(number).stat().st_mtime
+            except FileNotFoundError:
+                mtime = 0
+            if time.time() - mtime < min_age:
+                return 0
+            entries = {key: entry for key, entry in self._entries.items()
+                       if entry.pack == number}
+            referenced = find_referenced([key.hex() for key in entries])
+            live = [(key, entry) for key, entry in entries.items()
+                    if key.hex() in referenced]
+            # Besides unreferenced contents, a pack can contain copies of
+            # moved contents and data left behind by a crash
+            dead_size = size - sum(entry.length for _, entry in live)
+            if not dead_size or dead_size < min_dead_ratio * size:
+                return 0
+            contents = [(key, self.read(entry), entry.mode)
+                        for key, entry in live]
+            if number == self._current:
+                # Pack numbers are never reused, since other processes may
+                # have loaded the index of the removed pack. The index of
+                # the new pack is therefore created even if it stays empty.
+                self._current += 1
+                self._index_path(self._current).touch()
+            self._append(contents)
+            self._remove_pack(number)
+        num_removed = len(entries) - len(live)
+        log.debug('Compacted pack {}, removed {} contents'.format(
+                  number, num_removed))
+        return num_removed
+
+    def _remove_pack(self, number):
+        '''
+        Remove a pack and the entries that are still stored in it.
+
+        Must be called while holding the lock file.
+        '''
+        # The index is removed first, so that entries never refer to a
+        # pack that has been removed
+        self._index_path(number).unlink()
+        self._close_pack(number)
+        self._pack_path(number).unlink()
+        self._sync_directory()
+        del self._index_positions[number]
+        for key in [key for key, entry in self._entries.items()
+                    if entry.pack == number]:
+            del self._entries[key]
+
+    def _close_pack(self, number):
+        '''
+        Close a pack file that has been opened for reading.
+
+        Must be called while holding the lock.
+        '''
+        fd = self._read_fds.pop(number, None)
+        if fd is not None:
+            os.close(fd)
+
+    def close(self):
+        '''
+        Close open pack files.
+        '''
+        with self._lock:
+            for fd in self._read_fds.values():
+                os.close(fd)
+            self._read_fds.clear()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import cProfile
+import collections
+import contextlib
+import logging
+import sys
+import threading
+
+
+__all__ = ['profile', 'PROFILERS', 'SamplingProfiler']
+
+
+log = logging.getLogger(__name__)
+
+
+# Supported profilers, see ``profile``
+PROFILERS = ['sampling', 'cprofile']
+
+# Default number of seconds between two samples of the sampling profiler
+SAMPLING_INTERVAL = 0.005
+
+
+class SamplingProfiler:
+    '''
+    Profiler that periodically samples the stacks of all threads.
+
+    In contrast to ``cProfile``, which only profiles the thread in which
+    it is enabled and slows it down considerably, the sampling profiler
+    covers all threads at a low, constant overhead. The result is a
+    statistical picture of where time is spent.
+
+    The samples are written in the "collapsed stacks" format, one line
+    per distinct stack with its number of samples, which can be turned
+    into a flame graph (for example using ``flamegraph.pl`` or
+    https://www.speedscope.app).
+    '''
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        '''
+        Constructor.
+
+        ``interval`` is the number of seconds between two samples.
+        '''
+        self.interval = interval
+        self._counts = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        '''
+        Start sampling in a background thread.
+        '''
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stop sampling.
+        '''
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            self.sample(exclude=own_id)
+
+    def sample(self, exclude=None):
+        '''
+        Record the current stacks of all threads.
+
+        The stack of the thread with the ident ``exclude`` is skipped.
+        '''
+        names = {thread.ident: thread.name
+                 for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == exclude:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name,
+                             code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            self._counts[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        '''
+        Write the samples as collapsed stacks.
+
+        ``path`` is a ``pathlib.Path``.
+        '''
+        with path.open('w', encoding='utf-8') as f:
+            for stack, count in self._counts.most_common():
+                f.write('{} {:d}\n'.format(stack, count))
+
+
+@contextlib.contextmanager
+def profile(path, profiler='sampling'):
+    '''
+    Context manager that profiles the code it runs.
+
+    ``path`` is the ``pathlib.Path`` of the file to which the profile is
+    written when the context is left.
+
+    ``profiler`` is one of ``PROFILERS``. ``'sampling'`` uses a
+    ``SamplingProfiler`` and covers all threads. ``'cprofile'`` uses
+    Python's deterministic ``cProfile`` and only covers the current
+    thread. Its output can be read using the ``pstats`` module.
+    '''
+    if profiler == 'sampling':
+        sampler = SamplingProfiler()
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            sampler.write(path)
+    elif profiler == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(str(path))
+    else:
+        raise ValueError('Invalid profiler "{}"'.format(profiler))
+    log.info('Profile written to {}'.format(path))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import datetime
+
+from .utils import parse_duration
+
+
+__all__ = ['RetentionPolicy']
+
+
+class RetentionPolicy:
+    '''
+    Rules for deciding which versions of a file are kept.
+
+    A version is removed by pruning if any of the policy's rules says
+    so, except for the latest version of each file, which is always
+    kept. A policy without rules keeps all versions.
+    '''
+    def __init__(self, keep_last=None, max_age=None, thinning=None):
+        '''
+        Constructor.
+
+        ``keep_last`` is the maximum number of versions of each file.
+        Older versions are removed. If it is ``None`` then the number of
+        versions is not limited.
+
+        ``max_age`` is a ``datetime.timedelta``. Versions older than that
+        are removed. If it is ``None`` then versions do not expire.
+
+        ``thinning`` is a list of pairs of ``datetime.timedelta``
+        instances. A pair ``(after, every)`` means that of the versions
+        of a file that are older than ``after`` only the newest version
+        in each interval of length ``every`` is kept. If multiple rules
+        apply to a version then the one with the largest ``after`` is
+        used. For example, ``[(1 hour, 1 hour), (1 day, 1 day)]`` thins
+        out versions older than an hour to hourly ones and versions
+        older than a day to daily ones. Intervals are aligned to the
+        Unix epoch (in UTC).
+        '''
+        if keep_last is not None and keep_last < 1:
+            raise ValueError('At least one version must be kept')
+        if max_age is not None and max_age <= datetime.timedelta():
+            raise ValueError('Maximum age must be positive')
+        thinning = sorted(thinning or [])
+        for after, every in thinning:
+            if every < datetime.timedelta(seconds=1):
+                raise ValueError('Thinning interval must be at least a second')
+        self.keep_last = keep_last
+        self.max_age = max_age
+        self.thinning = thinning
+
+    @classmethod
+    def from_dict(cls, d):
+        '''
+        Create a policy from a dict as found in a configuration file.
+
+        Durations are given as strings for ``coba.utils.parse_duration``.
+        ``thinning`` is a list of dicts with keys ``after`` and
+        ``every``.
+        '''
+        max_age = d.get('max_age')
+        if max_age is not None:
+            max_age = parse_duration(str(max_age))
+        thinning = [(parse_duration(str(rule['after'])),
+                     parse_duration(str(rule['every'])))
+                    for rule in d.get('thinning') or []]
+        keep_last = d.get('keep_last')
+        if keep_last is not None:
+            keep_last = int(keep_last)
+        return cls(keep_last, max_age, thinning)
+
+    def __eq__(self, other):
+        if not isinstance(other, RetentionPolicy):
+            return NotImplemented
+        return ((self.keep_last, self.max_age, self.thinning)
+                == (other.keep_last, other.max_age, other.thinning))
+
+    def __repr__(self):
+        return '<{} keep_last={} max_age={} thinning={}>'.format(
+               self.__class__.__name__, self.keep_last, self.max_age,
+               self.thinning)
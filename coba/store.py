@@ -20,28 +20,207 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import collections
+import concurrent.futures
 import contextlib
 import datetime
+import functools
 import json
 import logging
 import os
 from pathlib import Path
-import shutil
-import tempfile
+import threading
+import time
 
-import hashfs
-from sqlalchemy import Column, create_engine, DateTime, Integer, types, Unicode
+from sqlalchemy import (and_, bindparam, case, Column, create_engine, DateTime,
+                        event, ForeignKey, func, Index, inspect, Integer,
+                        LargeBinary, MetaData, select, Table, text,
+                        type_coerce, types, Unicode)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
+from . import metrics, tracing
+from .cas import COMPRESSION_MODES, ContentStore, hash_file
+from .copying import copy_file
 from .utils import make_path_absolute
+from .walking import walk_files
 
 
-__all__ = ['Store', 'Version']
+__all__ = ['PathStatistics', 'Statistics', 'Store', 'Version']
 
 
 log = logging.getLogger(__name__)
 
+_STORED_VERSIONS = metrics.counter('coba_stored_versions_total',
+                                   'Number of recorded versions')
+_HASH_SECONDS = metrics.PUT_PHASE_SECONDS.labels('hash')
+_DB_COMMIT_SECONDS = metrics.PUT_PHASE_SECONDS.labels('db_commit')
+
+
+# Version of the database schema, which is stored in SQLite's ``user_version``.
+# Stores with an older schema are migrated when they are opened, see
+# ``Store._migrate``.
+_SCHEMA_VERSION = 2
+
+# Number of rows that are copied at once when migrating a table
+_MIGRATION_BATCH_SIZE = 10000
+
+# Origin of the integer timestamps in the database
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# Seconds that a database connection waits for a lock that is held by another
+# connection before giving up
+_BUSY_TIMEOUT_SECONDS = 30
+
+# Maximum number of bytes of the database that SQLite maps into memory
+_MMAP_SIZE = 256 * 1024**2
+
+# File system timestamps have a limited resolution, so a file can be modified
+# without changing its timestamps if that happens shortly after a previous
+# modification. Fingerprints of files whose timestamps are that close to the
+# time at which the fingerprint was taken are therefore not trusted.
+_RACY_FINGERPRINT_NS = 2 * 10**9
+
+# Maximum number of bound parameters in a single SQLite statement
+_MAX_SQL_PARAMETERS = 500
+
+# Default number of threads used for restoring a directory tree
+_RESTORE_WORKERS = 4
+
+# Default number of processes and batch size used for taking a snapshot
+_SNAPSHOT_WORKERS = 4
+_SNAPSHOT_BATCH_SIZE = 1000
+
+# Minimum time for which a content must have been unreferenced before it is
+# removed by garbage collection. A file whose content is already stored is
+# recorded without storing the content again, so a content that has just been
+# found in the store must not be removed before the new version referencing
+# it is recorded.
+_GC_GRACE_PERIOD = datetime.timedelta(hours=1)
+
+# Versions that are removed by pruning. The conditions of the outer query are
+# filled in according to the retention policy, see ``Store.prune``.
+_PRUNE_CANDIDATES_SQL = '''
+SELECT id, hash, path_id, size FROM (
+    SELECT id, hash, path_id, size, stored_at, interval,
+           ROW_NUMBER() OVER (
+               PARTITION BY path_id ORDER BY stored_at DESC
+           ) AS rank,
+           ROW_NUMBER() OVER (
+               PARTITION BY path_id, interval,
+                            stored_at / (interval * 1000000)
+               ORDER BY stored_at DESC
+           ) AS interval_rank
+    FROM (SELECT id, path_id, hash, size, stored_at, {interval} AS interval
+          FROM versions)
+)
+WHERE rank > 1 AND ({too_many} OR {expired} OR {thinned})
+'''
+
+# Decrements the reference counts of the contents of pruned versions
+_RELEASE_PRUNED_SQL = '''
+UPDATE blobs SET
+    refcount = refcount - (SELECT count FROM pruned_hashes
+                           WHERE pruned_hashes.hash = blobs.hash),
+    released_at = CASE
+        WHEN refcount = (SELECT count FROM pruned_hashes
+                         WHERE pruned_hashes.hash = blobs.hash)
+        THEN :now ELSE released_at END
+WHERE hash IN (SELECT hash FROM pruned_hashes)
+'''
+
+# Updates the statistics for the removal of pruned versions
+_COUNT_PRUNED_SQL = [
+    '''
+    UPDATE path_statistics SET
+        versions = versions - (
+            SELECT count FROM pruned_paths
+            WHERE pruned_paths.path_id = path_statistics.path_id),
+        size = size - (SELECT size FROM pruned_paths
+                       WHERE pruned_paths.path_id = path_statistics.path_id)
+    WHERE path_id IN (SELECT path_id FROM pruned_paths)
+    ''',
+    '''
+    UPDATE statistics SET
+        versions = versions - (SELECT COUNT(*) FROM pruned_versions),
+        size = size - (SELECT COALESCE(SUM(size), 0) FROM pruned_versions)
+    ''',
+]
+
+# Recomputes all statistics from scratch
+_RECOUNT_STATISTICS_SQL = [
+    'DELETE FROM statistics',
+    '''
+    INSERT INTO statistics (id, versions, size, contents, stored_size)
+    SELECT 1, (SELECT COUNT(*) FROM versions),
+           (SELECT COALESCE(SUM(size), 0) FROM versions),
+           (SELECT COUNT(*) FROM blobs),
+           (SELECT COALESCE(SUM(stored_size), 0) FROM blobs)
+    ''',
+    'DELETE FROM path_statistics',
+    '''
+    INSERT INTO path_statistics (path_id, versions, size)
+    SELECT path_id, COUNT(*), SUM(size) FROM versions GROUP BY path_id
+    ''',
+]
+
+
+Statistics = collections.namedtuple('Statistics', [
+    'versions', 'size', 'contents', 'stored_size', 'top_paths'])
+Statistics.__doc__ = '''
+Statistics of a store.
+
+``versions`` is the number of stored versions and ``size`` their total
+size in bytes. ``contents`` is the number of distinct stored contents
+(including the chunks of chunked contents) and ``stored_size`` the
+number of bytes they occupy in the store. ``top_paths`` is a list of
+``PathStatistics`` for the files whose versions are largest in total.
+'''
+
+PathStatistics = collections.namedtuple('PathStatistics',
+                                        ['path', 'versions', 'size'])
+PathStatistics.__doc__ = '''
+Statistics of the versions of a file: their number and total size.
+'''
+
+
+def _on_connect(dbapi_connection, connection_record):
+    '''
+    Configure a new SQLite connection.
+    '''
+    # Disable the transaction handling of the ``sqlite3`` module, transactions
+    # are started explicitly in ``_on_begin``.
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    try:
+        # In WAL mode readers and the writer do not block each other
+        cursor.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode, NORMAL is still safe against corruption but does not
+        # sync on every commit
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA mmap_size={:d}'.format(_MMAP_SIZE))
+        cursor.execute('PRAGMA busy_timeout={:d}'.format(
+                       _BUSY_TIMEOUT_SECONDS * 1000))
+    finally:
+        cursor.close()
+
+
+def _on_begin(connection):
+    '''
+    Start a transaction.
+
+    Write transactions acquire the database's write lock immediately.
+    Otherwise SQLite would only try to acquire it at the first write
+    and fail without waiting for the busy timeout if another connection
+    had written in the meantime.
+    '''
+    if connection.get_execution_options().get('coba_write'):
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+    else:
+        connection.exec_driver_sql('BEGIN')
+
 
 class _PathType(types.TypeDecorator):
     '''
@@ -51,6 +230,9 @@ class _PathType(types.TypeDecorator):
     '''
     impl = Unicode
 
+    # Allows SQLAlchemy to cache compiled statements that use this type
+    cache_ok = True
+
     def process_bind_param(self, value, dialect):
         assert isinstance(value, Path)
         return str(value)
@@ -62,9 +244,86 @@ class _PathType(types.TypeDecorator):
         return self.__class__(self.impl.length)
 
 
+class _HashType(types.TypeDecorator):
+    '''
+    SQLAlchemy column type for SHA-1 hashes.
+
+    The hashes are hex strings in Python and are stored as their 20
+    bytes.
+    '''
+    impl = LargeBinary
+
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return bytes.fromhex(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return bytes(value).hex()
+
+
+def _to_timestamp(dt):
+    '''
+    Convert a ``datetime.datetime`` into microseconds since the epoch.
+
+    Naive instances are interpreted as UTC.
+    '''
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (dt - _EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _from_timestamp(timestamp):
+    '''
+    Convert microseconds since the epoch into a naive UTC
+    ``datetime.datetime``.
+    '''
+    return _EPOCH + datetime.timedelta(microseconds=timestamp)
+
+
+class _TimestampType(types.TypeDecorator):
+    '''
+    SQLAlchemy column type for points in time.
+
+    The points are naive UTC ``datetime.datetime`` instances in Python
+    and are stored as integer microseconds since the epoch, which are
+    smaller and faster to compare than date strings.
+    '''
+    impl = Integer
+
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return _to_timestamp(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return _from_timestamp(value)
+
+
 _Base = declarative_base()
 
 
+class _Path(_Base):
+    '''
+    Internal ORM representation of a file path.
+
+    Each path is stored once and referenced by its ID, which keeps the
+    tables that contain a row per version small.
+    '''
+    __tablename__ = 'paths'
+
+    id = Column(Integer, primary_key=True)
+    path = Column(_PathType, nullable=False, unique=True)
+
+
 class _Version(_Base):
     '''
     Internal ORM representation of a file version.
@@ -72,31 +331,223 @@ class _Version(_Base):
     __tablename__ = 'versions'
 
     id = Column(Integer, primary_key=True)
-    path = Column(_PathType, nullable=False)
-    hash = Column(Unicode(40), nullable=False)
-    stored_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    path_id = Column(Integer, ForeignKey(_Path.id), nullable=False)
+    # Unlike paths, hashes are not interned: a file's versions usually
+    # differ in content, so most hashes occur only once. The 20 bytes of a
+    # hash would only shrink to the few bytes of an ID, and restoring or
+    # collecting garbage would need another join.
+    hash = Column(_HashType, nullable=False)
+    stored_at = Column(_TimestampType, nullable=False)
+    # Size of the content in bytes
+    size = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        # Finding the versions of a file in a time range is a seek in this
+        # index. It contains the rowid (``id``), so it also covers sorting
+        # versions with the same timestamp.
+        Index('ix_versions_path_id_stored_at', 'path_id', 'stored_at'),
+        Index('ix_versions_hash', 'hash'),
+    )
 
     def __repr__(self):
-        return '<{} id={} path="{}" hash="{}">'.format(self.__class__.__name__,
-                                                       self.id, self.path,
-                                                       self.hash)
+        return '<{} id={} path_id={} hash="{}">'.format(
+               self.__class__.__name__, self.id, self.path_id, self.hash)
+
+
+class _Fingerprint(_Base):
+    '''
+    Internal ORM representation of a file's metadata at the time when its
+    latest version was stored.
+
+    Used to detect unchanged files without reading them.
+    '''
+    __tablename__ = 'fingerprints'
+
+    path = Column(_PathType, primary_key=True)
+    device = Column(Integer, nullable=False)
+    inode = Column(Integer, nullable=False)
+    size = Column(Integer, nullable=False)
+    mtime_ns = Column(Integer, nullable=False)
+    ctime_ns = Column(Integer, nullable=False)
+    hash = Column(_HashType, nullable=False)
+    # Time at which the file's metadata was read
+    taken_ns = Column(Integer, nullable=False)
+
+    def matches(self, stat):
+        '''
+        Check if the fingerprint matches a file's current metadata.
+
+        ``stat`` is the ``os.stat_result`` of the file.
+        '''
+        if (self.device, self.inode, self.size, self.mtime_ns,
+                self.ctime_ns) != (stat.st_dev, stat.st_ino, stat.st_size,
+                                   stat.st_mtime_ns, stat.st_ctime_ns):
+            return False
+        latest_change_ns = max(self.mtime_ns, self.ctime_ns)
+        return latest_change_ns < self.taken_ns - _RACY_FINGERPRINT_NS
+
+
+class _Blob(_Base):
+    '''
+    Internal ORM representation of a stored content's reference count.
+
+    A content is referenced by each version that has it as its content
+    and by each chunked content that it is a chunk of. Contents whose
+    reference count has dropped to zero are removed by garbage
+    collection.
+    '''
+    __tablename__ = 'blobs'
+
+    hash = Column(_HashType, primary_key=True)
+    refcount = Column(Integer, nullable=False)
+    # Time at which the reference count dropped to zero
+    released_at = Column(_TimestampType, index=True)
+    # Size of the content and number of bytes it occupies in the store
+    size = Column(Integer, nullable=False, default=0)
+    stored_size = Column(Integer, nullable=False, default=0)
+
+
+class _Statistics(_Base):
+    '''
+    Internal ORM representation of the statistics of the whole store.
+
+    The table has a single row. Its counters are updated together with
+    the tables they describe, so that reading them is cheap.
+    '''
+    __tablename__ = 'statistics'
+
+    id = Column(Integer, primary_key=True)
+    versions = Column(Integer, nullable=False, default=0)
+    size = Column(Integer, nullable=False, default=0)
+    contents = Column(Integer, nullable=False, default=0)
+    stored_size = Column(Integer, nullable=False, default=0)
+
+
+class _PathStatistics(_Base):
+    '''
+    Internal ORM representation of the statistics of a file's versions.
+    '''
+    __tablename__ = 'path_statistics'
+
+    path_id = Column(Integer, ForeignKey(_Path.id), primary_key=True)
+    versions = Column(Integer, nullable=False)
+    size = Column(Integer, nullable=False, index=True)
+
+
+# Tables of schema version 1 as far as they are needed for migrating them,
+# see ``Store._migrate_to_2``. They are renamed before the migration.
+_V1_METADATA = MetaData()
+_V1_VERSIONS = Table(
+    'versions_v1', _V1_METADATA,
+    Column('id', Integer, primary_key=True),
+    Column('path', Unicode),
+    Column('hash', Unicode(40)),
+    Column('stored_at', DateTime),
+    Column('size', Integer),
+)
+_V1_FINGERPRINTS = Table(
+    'fingerprints_v1', _V1_METADATA,
+    Column('path', Unicode, primary_key=True),
+    Column('device', Integer),
+    Column('inode', Integer),
+    Column('size', Integer),
+    Column('mtime_ns', Integer),
+    Column('ctime_ns', Integer),
+    Column('hash', Unicode(40)),
+    Column('taken_ns', Integer),
+)
+_V1_BLOBS = Table(
+    'blobs_v1', _V1_METADATA,
+    Column('hash', Unicode(40), primary_key=True),
+    Column('refcount', Integer),
+    Column('released_at', DateTime),
+    Column('size', Integer),
+    Column('stored_size', Integer),
+)
+
+
+def _fingerprint_row(path, stat, hash, taken_ns):
+    '''
+    Create a row for the fingerprints table.
+    '''
+    return {
+        'path': path,
+        'device': stat.st_dev,
+        'inode': stat.st_ino,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'ctime_ns': stat.st_ctime_ns,
+        'hash': hash,
+        'taken_ns': taken_ns,
+    }
+
+
+# Content stores opened by snapshot worker processes, indexed by their
+# configuration
+_process_content_stores = {}
+
+
+def _snapshot_files(cas_config, paths):
+    '''
+    Store the contents of files unless they are already stored.
+
+    Runs in a worker process of ``Store.snapshot``. ``cas_config`` is a
+    tuple of the arguments for ``ContentStore``. Each worker process
+    opens the content store once.
+
+    Files that cannot be read are skipped and logged.
+
+    Returns a list of rows for the fingerprints table.
+    '''
+    try:
+        cas = _process_content_stores[cas_config]
+    except KeyError:
+        cas = _process_content_stores[cas_config] = ContentStore(*cas_config)
+    rows = []
+    for path in paths:
+        taken_ns = int(time.time() * 10**9)
+        try:
+            stat = os.stat(str(path))
+            # Hashes the file while reading it, so that each file is only
+            # read once even if its content is new
+            hash = cas.put(path)
+        except OSError as e:
+            log.error('Could not store {}: {}'.format(path, e))
+            continue
+        rows.append(_fingerprint_row(path, stat, hash, taken_ns))
+    return rows
+
+
+# Values of a version, as selected from the database
+_VersionRow = collections.namedtuple('_VersionRow', [
+    'id', 'path', 'hash', 'stored_at', 'size'])
 
 
 class Version:
     '''
     A version of a file.
+
+    A lightweight record with the attributes ``id``, ``path``, ``hash``,
+    ``stored_at`` (a ``datetime.datetime`` in UTC) and ``size`` (in
+    bytes). It does not keep a database session open.
     '''
+    __slots__ = ('id', 'path', 'hash', 'stored_at', 'size', '_store')
+
     def __init__(self, _version, store):
         '''
         Private constructor.
+
+        ``_version`` is a ``_Version`` or a row of the versions table.
         '''
-        self._version = _version
+        self.id = _version.id
+        self.path = _version.path
+        self.hash = _version.hash
+        self.stored_at = _version.stored_at
+        self.size = _version.size
         self._store = store
 
-    def __getattr__(self, attr):
-        if attr.startswith('_'):
-            raise AttributeError(attr)
-        return getattr(self._version, attr)
+    def _key(self):
+        return (self.id, self.path, self.hash, self.stored_at, self.size)
 
     def restore(self, target_path=None, force=False):
         '''
@@ -119,16 +570,15 @@ class Version:
                 target_path = target_path / self.path.name
         else:
             target_path = Path(self.path)
-        return self._store._restore(self._version, target_path, force)
+        return self._store._restore(self, target_path, force)
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             return False
-        self_dict = {k: v for k, v in self._version.__dict__.items()
-                     if not k.startswith('_')}
-        other_dict = {k: v for k, v in other._version.__dict__.items()
-                      if not k.startswith('_')}
-        return self_dict == other_dict
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
 
     def __repr__(self):
         return ('<{cls} id={id} path={path} '
@@ -140,18 +590,50 @@ class Version:
 class Store:
     '''
     An on-disk store for file versions.
+
+    Once opened, a store can be used from multiple threads. It can also
+    be opened by multiple processes at the same time: the database is
+    used in SQLite's WAL mode, so reading (for example listing versions
+    of a file) never blocks and is never blocked by writing (storing new
+    versions). Writes are serialized, both within the process and via
+    SQLite's write lock across processes.
     '''
-    def __init__(self, path):
+    def __init__(self, path, compression='none', chunking=False,
+                 pack_threshold=0, throttle=None):
         '''
         Constructor.
 
         ``path`` is the base directory of the file store. If it doesn't
         exist it is created.
+
+        ``compression`` is the compression mode for new contents, one of
+        ``coba.cas.COMPRESSION_MODES``.
+
+        If ``chunking`` is true then large files are stored in chunks, so
+        that versions of a large file share the space of their common
+        content.
+
+        Contents smaller than ``pack_threshold`` bytes are stored in pack
+        files instead of separate files.
+
+        ``throttle`` is an optional ``coba.throttle.Throttle`` that
+        limits the rate at which files are read when they are stored.
         '''
+        if compression not in COMPRESSION_MODES:
+            raise ValueError('Invalid compression mode "{}"'.format(
+                             compression))
         self.path = make_path_absolute(path)
+        self.compression = compression
+        self.chunking = chunking
+        self.pack_threshold = pack_threshold
+        self.throttle = throttle
         self._cas = None
         self._engine = None
         self._Session = None
+        # Serializes write transactions. SQLite only supports a single writer,
+        # and waiting for a Python lock is cheaper than running into SQLite's
+        # busy timeout.
+        self._write_lock = threading.Lock()
 
     def __enter__(self):
         if not self.path.exists():
@@ -160,13 +642,27 @@ class Store:
         elif not self.path.is_dir():
             raise FileExistsError('{} exists but is not a directory'.format(
                                   self.path))
-        self._cas = hashfs.HashFS(str(self.path / 'content'), depth=4,
-                                  width=1, algorithm='sha1')
+        self._cas = ContentStore(self.path / 'content', self.compression,
+                                 self.chunking, self.pack_threshold,
+                                 self.throttle)
         self._init_db()
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self._close_db()
+        if self._cas:
+            self._cas.close()
+
+    def __getstate__(self):
+        # Only the configuration of a store is pickled. Like a new instance,
+        # an unpickled store needs to be opened before it can be used.
+        return {'path': self.path, 'compression': self.compression,
+                'chunking': self.chunking,
+                'pack_threshold': self.pack_threshold,
+                'throttle': self.throttle}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
 
     def _init_db(self):
         '''
@@ -174,10 +670,282 @@ class Store:
         '''
         log.debug('Initializing database')
         url = 'sqlite:///' + str(self.path / 'coba.sqlite')
-        self._engine = create_engine(url)
-        _Base.metadata.create_all(self._engine, checkfirst=True)
+        self._engine = create_engine(url, poolclass=QueuePool, connect_args={
+            'check_same_thread': False,
+            'timeout': _BUSY_TIMEOUT_SECONDS,
+        })
+        event.listen(self._engine, 'connect', _on_connect)
+        event.listen(self._engine, 'begin', _on_begin)
+        with self._engine.connect() as connection:
+            schema_version = connection.exec_driver_sql(
+                'PRAGMA user_version').scalar()
+        if schema_version != _SCHEMA_VERSION:
+            with self._write_scope() as connection:
+                migrated = self._migrate(connection)
+            if migrated:
+                self._vacuum()
         self._Session = sessionmaker(bind=self._engine)
 
+    def _vacuum(self):
+        '''
+        Rebuild the database file to release unused space.
+
+        Failures are logged, since the store can be used without it.
+        '''
+        log.info('Compacting database')
+        with self._write_lock, self._engine.connect() as connection:
+            # VACUUM cannot run in a transaction, so it bypasses SQLAlchemy's
+            # transaction handling (see ``_on_connect``)
+            cursor = connection.connection.cursor()
+            try:
+                cursor.execute('VACUUM')
+            except Exception as e:
+                log.warning('Could not compact database: {}'.format(e))
+            finally:
+                cursor.close()
+
+    def _migrate(self, connection):
+        '''
+        Create or migrate the database schema.
+
+        Must be called in a write transaction, so that only one process
+        migrates a store.
+
+        Returns ``True`` if an existing store was migrated.
+        '''
+        schema_version = connection.exec_driver_sql(
+            'PRAGMA user_version').scalar()
+        if schema_version == _SCHEMA_VERSION:
+            # Another process has been faster
+            return False
+        if schema_version > _SCHEMA_VERSION:
+            raise ValueError('The store at {} has been created by a newer '
+                             'version of coba'.format(self.path))
+        is_new = not inspect(connection).has_table(_Version.__tablename__)
+        if is_new:
+            _Base.metadata.create_all(connection)
+            connection.execute(_Statistics.__table__.insert(), {'id': 1})
+        else:
+            for version in range(schema_version, _SCHEMA_VERSION):
+                log.info('Migrating store to schema version {}'.format(
+                         version + 1))
+                getattr(self, '_migrate_to_{:d}'.format(version + 1))(
+                    connection)
+            if schema_version < 1:
+                # Reference counts and sizes were introduced in version 1.
+                # They are computed using the current schema, so that the
+                # code for it is not duplicated for older schemas.
+                self._count_references(connection)
+        connection.exec_driver_sql('PRAGMA user_version={:d}'.format(
+                                   _SCHEMA_VERSION))
+        return not is_new
+
+    def _migrate_to_1(self, connection):
+        '''
+        Migrate a store to schema version 1.
+
+        Adds the columns and tables for reference counts and sizes of
+        contents, sizes of versions, and the statistics. Their values
+        are computed after the migration to the current schema, see
+        ``_migrate``.
+        '''
+        connection.exec_driver_sql(
+            'CREATE INDEX IF NOT EXISTS ix_versions_path_stored_at '
+            + 'ON versions (path, stored_at)')
+        connection.exec_driver_sql(
+            'CREATE TABLE IF NOT EXISTS fingerprints (path VARCHAR NOT NULL, '
+            + 'device INTEGER NOT NULL, inode INTEGER NOT NULL, '
+            + 'size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+            + 'ctime_ns INTEGER NOT NULL, hash VARCHAR(40) NOT NULL, '
+            + 'taken_ns INTEGER NOT NULL, PRIMARY KEY (path))')
+        connection.exec_driver_sql(
+            'CREATE TABLE IF NOT EXISTS blobs (hash VARCHAR(40) NOT NULL, '
+            + 'refcount INTEGER NOT NULL, released_at DATETIME, '
+            + 'PRIMARY KEY (hash))')
+        for table, columns in [('versions', ['size']),
+                               ('blobs', ['size', 'stored_size'])]:
+            existing = {column['name'] for column in
+                        inspect(connection).get_columns(table)}
+            for column in columns:
+                if column not in existing:
+                    connection.exec_driver_sql(
+                        'ALTER TABLE {} ADD COLUMN {} INTEGER NOT NULL '
+                        'DEFAULT 0'.format(table, column))
+
+    def _migrate_to_2(self, connection):
+        '''
+        Migrate a store to schema version 2.
+
+        Paths are moved into a separate table, and hashes and timestamps
+        are stored as binary and integer values. The tables are renamed,
+        recreated using the new schema and copied in batches. The
+        statistics are recomputed.
+        '''
+        for table in ['versions', 'fingerprints', 'blobs']:
+            connection.exec_driver_sql(
+                'ALTER TABLE {0} RENAME TO {0}_v1'.format(table))
+        # The statistics are recomputed, and the indexes of the old tables
+        # would clash with those of the new ones
+        for table in ['statistics', 'path_statistics']:
+            connection.exec_driver_sql('DROP TABLE IF EXISTS ' + table)
+        for index in ['ix_versions_path_stored_at', 'ix_blobs_released_at']:
+            connection.exec_driver_sql('DROP INDEX IF EXISTS ' + index)
+        _Base.metadata.create_all(connection)
+
+        paths = _Path.__table__
+        connection.execute(paths.insert().from_select(
+            ['path'], select(_V1_VERSIONS.c.path).distinct()))
+
+        def copy(query, key, table, convert):
+            last = None
+            while True:
+                batch = query
+                if last is not None:
+                    batch = batch.where(key > last)
+                rows = connection.execute(
+                    batch.order_by(key).limit(_MIGRATION_BATCH_SIZE)).all()
+                if not rows:
+                    return
+                connection.execute(table.insert(),
+                                   [convert(row) for row in rows])
+                last = rows[-1]._mapping[key.name]
+
+        old = _V1_VERSIONS
+        copy(select(old, paths.c.id.label('path_id'))
+             .select_from(old.join(paths, paths.c.path == old.c.path)),
+             old.c.id, _Version.__table__,
+             lambda row: {'id': row.id, 'path_id': row.path_id,
+                          'hash': row.hash, 'stored_at': row.stored_at,
+                          'size': row.size})
+        old = _V1_FINGERPRINTS
+        copy(select(old), old.c.path, _Fingerprint.__table__,
+             lambda row: dict(row._mapping, path=Path(row.path)))
+        old = _V1_BLOBS
+        copy(select(old), old.c.hash, _Blob.__table__,
+             lambda row: dict(row._mapping))
+        for table in ['versions', 'fingerprints', 'blobs']:
+            connection.exec_driver_sql('DROP TABLE {}_v1'.format(table))
+        connection.execute(_Statistics.__table__.insert(), {'id': 1})
+        for sql in _RECOUNT_STATISTICS_SQL:
+            connection.exec_driver_sql(sql)
+
+    def _count_references(self, connection):
+        '''
+        Compute the reference counts and sizes of contents, the sizes of
+        versions, and the statistics from scratch.
+
+        Reference counts are only computed if no content has one, yet.
+        '''
+        blobs = _Blob.__table__
+        versions = _Version.__table__
+        if not connection.execute(select(func.count())
+                                  .select_from(blobs)).scalar():
+            counts = collections.Counter({
+                hash: count for hash, count in connection.execute(
+                    select(versions.c.hash, func.count())
+                    .group_by(versions.c.hash))})
+            if counts:
+                log.info('Counting references to {} contents'.format(
+                         len(counts)))
+                self._add_references(connection, counts, {})
+        rows = []
+        for hash, in connection.execute(select(blobs.c.hash)):
+            try:
+                rows.append({'b_hash': hash,
+                             'b_size': self._cas.get_size(hash),
+                             'b_stored_size': self._cas.get_stored_size(hash)})
+            except FileNotFoundError:
+                log.warning('Content {} is missing'.format(hash))
+        if rows:
+            connection.execute(
+                blobs.update()
+                .where(blobs.c.hash == bindparam('b_hash'))
+                .values(size=bindparam('b_size'),
+                        stored_size=bindparam('b_stored_size')),
+                rows)
+        connection.exec_driver_sql(
+            'UPDATE versions SET size = COALESCE((SELECT size FROM blobs '
+            + 'WHERE blobs.hash = versions.hash), 0)')
+        for sql in _RECOUNT_STATISTICS_SQL:
+            connection.exec_driver_sql(sql)
+
+    def _add_references(self, connection, counts, sizes):
+        '''
+        Increment the reference counts of contents.
+
+        ``counts`` maps content hashes to the number of new references.
+        ``sizes`` maps them to their sizes, which are recorded for
+        contents that are referenced for the first time. The chunks of
+        a chunked content are referenced once the content itself is
+        referenced for the first time.
+
+        Raises a ``FileNotFoundError`` if an unreferenced content has
+        been removed by garbage collection in the meantime.
+        '''
+        blobs = _Blob.__table__
+        hashes = list(counts)
+        refcounts = {}
+        for i in range(0, len(hashes), _MAX_SQL_PARAMETERS):
+            chunk = hashes[i:i + _MAX_SQL_PARAMETERS]
+            for hash, refcount in connection.execute(
+                    select(blobs.c.hash, blobs.c.refcount)
+                    .where(blobs.c.hash.in_(chunk))):
+                refcounts[hash] = refcount
+        for hash in hashes:
+            if not refcounts.get(hash) and not self._cas.exists(hash):
+                raise FileNotFoundError(
+                    'Content "{}" has been removed by garbage collection'
+                    .format(hash))
+        known = [hash for hash in hashes if hash in refcounts]
+        if known:
+            connection.execute(
+                blobs.update()
+                .where(blobs.c.hash == bindparam('b_hash'))
+                .values(refcount=blobs.c.refcount + bindparam('b_count'),
+                        released_at=None),
+                [{'b_hash': hash, 'b_count': counts[hash]}
+                 for hash in known])
+        new = [hash for hash in hashes if hash not in refcounts]
+        if new:
+            rows = [{'hash': hash, 'refcount': counts[hash],
+                     'size': sizes.get(hash, 0),
+                     'stored_size': self._cas.get_stored_size(hash)}
+                    for hash in new]
+            connection.execute(blobs.insert(), rows)
+            statistics = _Statistics.__table__
+            connection.execute(statistics.update().values(
+                contents=statistics.c.contents + len(rows),
+                stored_size=statistics.c.stored_size
+                + sum(row['stored_size'] for row in rows)))
+            chunk_counts = collections.Counter()
+            chunk_sizes = {}
+            for hash in new:
+                for chunk_hash, size in self._cas.get_chunks(hash) or []:
+                    chunk_counts[chunk_hash] += 1
+                    chunk_sizes[chunk_hash] = size
+            if chunk_counts:
+                self._add_references(connection, chunk_counts, chunk_sizes)
+
+    def _release_references(self, connection, counts, now):
+        '''
+        Decrement the reference counts of contents.
+
+        ``counts`` maps content hashes to the number of removed
+        references. ``now`` is the time at which contents whose
+        reference count drops to zero are released.
+        '''
+        blobs = _Blob.__table__
+        connection.execute(
+            blobs.update()
+            .where(blobs.c.hash == bindparam('b_hash'))
+            .values(refcount=blobs.c.refcount - bindparam('b_count'),
+                    released_at=case(
+                        (blobs.c.refcount == bindparam('b_count'),
+                         bindparam('b_now', type_=_TimestampType())),
+                        else_=blobs.c.released_at)),
+            [{'b_hash': hash, 'b_count': count, 'b_now': now}
+             for hash, count in counts.items()])
+
     def _close_db(self):
         '''
         Dispose the database engine.
@@ -187,6 +955,20 @@ class Store:
             self._engine.dispose()
             self._engine = None
 
+    @contextlib.contextmanager
+    def _write_scope(self):
+        '''
+        Context manager for a write transaction.
+
+        Provides a SQLAlchemy connection in which a write transaction has
+        been started. The transaction is committed when the context
+        manager exits and rolled back in case of an exception.
+        '''
+        with self._write_lock, self._engine.connect() as connection:
+            connection = connection.execution_options(coba_write=True)
+            with connection.begin():
+                yield connection
+
     @contextlib.contextmanager
     def _session_scope(self):
         '''
@@ -204,46 +986,502 @@ class Store:
         finally:
             session.close()
 
+    def _get_fingerprints(self, paths):
+        '''
+        Get the fingerprints of files.
+
+        Returns a dict that maps the paths for which a fingerprint exists
+        to their ``_Fingerprint``.
+        '''
+        fingerprints = {}
+        with self._session_scope() as session:
+            for i in range(0, len(paths), _MAX_SQL_PARAMETERS):
+                chunk = paths[i:i + _MAX_SQL_PARAMETERS]
+                query = session.query(_Fingerprint) \
+                               .filter(_Fingerprint.path.in_(chunk))
+                for fingerprint in query:
+                    session.expunge(fingerprint)
+                    fingerprints[fingerprint.path] = fingerprint
+        return fingerprints
+
+    def _store_content(self, path, fingerprint):
+        '''
+        Store the content of a file unless it is unchanged.
+
+        ``path`` is the absolute path of the file.
+
+        ``fingerprint`` is the file's ``_Fingerprint`` or ``None``.
+
+        Returns ``None`` if the file has not changed since its latest
+        version was stored. Otherwise the content is stored if necessary
+        and a row for the fingerprints table is returned.
+        '''
+        taken_ns = int(time.time() * 10**9)
+        stat = os.stat(str(path))
+        if fingerprint is not None:
+            if fingerprint.matches(stat):
+                log.debug('{} is unchanged'.format(path))
+                return None
+            if stat.st_size == fingerprint.size:
+                # The file may have been rewritten with identical content. In
+                # that case, hashing it avoids copying it.
+                with _HASH_SECONDS.time(), tracing.span('store.hash'):
+                    hash = hash_file(path, self._cas.throttle)
+                if hash == fingerprint.hash and self._cas.exists(hash):
+                    log.debug('Content of {} is unchanged'.format(path))
+                    metrics.DEDUP_HITS.inc()
+                    return _fingerprint_row(path, stat, hash, taken_ns)
+        hash = self._cas.put(path)
+        return _fingerprint_row(path, stat, hash, taken_ns)
+
+    def _record_versions(self, connection, fingerprint_rows, stored_at):
+        '''
+        Record new versions and update the corresponding fingerprints.
+
+        The reference counts of the versions' contents and the
+        statistics are updated.
+
+        Returns the result of the insert into the versions table.
+        '''
+        path_ids = self._intern_paths(
+            connection, [row['path'] for row in fingerprint_rows])
+        version_rows = [{'path_id': path_ids[row['path']],
+                         'hash': row['hash'], 'stored_at': stored_at,
+                         'size': row['size']}
+                        for row in fingerprint_rows]
+        self._add_references(
+            connection,
+            collections.Counter(row['hash'] for row in fingerprint_rows),
+            {row['hash']: row['size'] for row in fingerprint_rows})
+        statistics = _Statistics.__table__
+        connection.execute(statistics.update().values(
+            versions=statistics.c.versions + len(version_rows),
+            size=statistics.c.size + sum(row['size'] for row in version_rows)))
+        path_rows = collections.OrderedDict()
+        for row in version_rows:
+            path_row = path_rows.setdefault(row['path_id'], {
+                'path_id': row['path_id'], 'versions': 0, 'size': 0})
+            path_row['versions'] += 1
+            path_row['size'] += row['size']
+        path_statistics = _PathStatistics.__table__
+        insert = sqlite_insert(path_statistics)
+        connection.execute(insert.on_conflict_do_update(
+            index_elements=['path_id'],
+            set_={
+                'versions': path_statistics.c.versions
+                + insert.excluded.versions,
+                'size': path_statistics.c.size + insert.excluded.size,
+            }), list(path_rows.values()))
+        result = connection.execute(_Version.__table__.insert(), version_rows)
+        connection.execute(
+            _Fingerprint.__table__.insert().prefix_with('OR REPLACE'),
+            fingerprint_rows)
+        return result
+
+    def _intern_paths(self, connection, paths):
+        '''
+        Get the IDs of paths, adding the paths that are not known yet.
+
+        Returns a dict that maps the paths to their IDs.
+        '''
+        table = _Path.__table__
+        paths = list(collections.OrderedDict.fromkeys(paths))
+        path_ids = {}
+
+        def load(paths):
+            for i in range(0, len(paths), _MAX_SQL_PARAMETERS):
+                chunk = paths[i:i + _MAX_SQL_PARAMETERS]
+                for id, path in connection.execute(
+                        select(table.c.id, table.c.path)
+                        .where(table.c.path.in_(chunk))):
+                    path_ids[path] = id
+
+        load(paths)
+        new = [path for path in paths if path not in path_ids]
+        if new:
+            connection.execute(table.insert(), [{'path': path}
+                                                for path in new])
+            load(new)
+        return path_ids
+
+    def _get_latest_version(self, path):
+        '''
+        Get the latest stored version of a file.
+        '''
+        versions = self.get_versions(path, limit=1, reverse=True)
+        with contextlib.closing(versions):
+            return next(versions, None)
+
     def put(self, path):
         '''
         Put a file into the store.
 
         ``path`` is the file to be put into the store.
 
+        If the file's metadata shows that it has not changed since its
+        latest version was stored then no new version is created and the
+        latest version is returned instead. If the file has changed but
+        its content is that of the latest version then a new version is
+        recorded without copying the content again.
+
         Returns a ``Version``.
         '''
         path = make_path_absolute(path)
-        # First make a temporary copy in case the original file is modified
-        # while we're trying to put it into the store
-        temp_copy = tempfile.NamedTemporaryFile(dir=str(self.path), delete=False)
-        log.debug('Created temporary file {}'.format(temp_copy.name))
-        try:
-            temp_copy.close()
-            shutil.copy2(str(path), temp_copy.name, follow_symlinks=False)
-            log.debug('Created temporary copy {} of {}'.format(temp_copy.name, path))
-            address = self._cas.put(temp_copy.name)
-            log.debug('Stored content of {} in CAS at {}'.format(path,
-                      address.abspath))
-            with self._session_scope() as session:
-                _version = _Version(path=path, hash=address.id)
-                session.add(_version)
-                session.commit()
-                log.debug('Stored new version of {} in row {}'.format(
-                          path, _version.id))
-                return Version(_version, self)
-        finally:
-            os.unlink(temp_copy.name)
-            log.debug('Removed temporary file {}'.format(temp_copy.name))
+        stored_at = datetime.datetime.utcnow()
+        with tracing.span('store.fingerprints'):
+            fingerprint = self._get_fingerprints([path]).get(path)
+        row = self._store_content(path, fingerprint)
+        if row is None:
+            return self._get_latest_version(path)
+        with _DB_COMMIT_SECONDS.time(), tracing.span('store.db_commit'), \
+                self._write_scope() as connection:
+            result = self._record_versions(connection, [row], stored_at)
+            id = result.inserted_primary_key[0]
+        _STORED_VERSIONS.inc()
+        log.debug('Stored new version of {} in row {}'.format(path, id))
+        return Version(_VersionRow(id, path, row['hash'], stored_at,
+                                   row['size']), self)
 
-    def _restore(self, _version, path, force):
+    def put_many(self, paths):
+        '''
+        Put multiple files into the store.
+
+        ``paths`` is an iterable of the files to be put into the store.
+
+        In contrast to calling ``put`` for each file, the new versions
+        are recorded using a single database transaction. Files that
+        cannot be read (for example because they have been removed in
+        the meantime) are skipped and logged, as are files that have not
+        changed since their latest version was stored.
+
+        Returns a list of the absolute paths of the stored files.
+        '''
+        paths = [make_path_absolute(path) for path in paths]
+        stored_at = datetime.datetime.utcnow()
+        with tracing.span('store.fingerprints', files=len(paths)):
+            fingerprints = self._get_fingerprints(paths)
+        rows = []
+        for path in paths:
+            try:
+                row = self._store_content(path, fingerprints.get(path))
+            except OSError as e:
+                log.error('Could not store {}: {}'.format(path, e))
+                metrics.ERRORS.labels('store').inc()
+                continue
+            if row is not None:
+                rows.append(row)
+        if rows:
+            with _DB_COMMIT_SECONDS.time(), \
+                    tracing.span('store.db_commit', versions=len(rows)), \
+                    self._write_scope() as connection:
+                self._record_versions(connection, rows, stored_at)
+            _STORED_VERSIONS.inc(len(rows))
+            log.debug('Stored {} new versions in a single transaction'.format(
+                      len(rows)))
+        return [row['path'] for row in rows]
+
+    def find_changed_files(self, directory, config=None,
+                           batch_size=_SNAPSHOT_BATCH_SIZE, recursive=True):
+        '''
+        Find the files in a directory tree that have changed since their
+        latest version was stored.
+
+        ``directory`` is the absolute path of the directory. Its tree is
+        walked in parallel using ``coba.walking.walk_files``.
+
+        If ``config`` is given then it is a ``coba.config.Config``
+        instance, and files and directories that are ignored according
+        to it are skipped.
+
+        A file has changed if it has no version in the store yet or if
+        its metadata (size, timestamps, inode, ...) differs from the
+        fingerprint that was taken when its latest version was stored.
+        The fingerprints are looked up in batches of ``batch_size``
+        files.
+
+        If ``recursive`` is false then only the files directly in
+        ``directory`` are checked.
+
+        Note that the modification time of a directory only changes when
+        entries are added, removed or renamed, not when a file in it is
+        modified. Unchanged directories can therefore not be skipped,
+        every file's metadata is checked.
+
+        Yields lists of at most ``batch_size`` paths.
+        '''
+        directory = make_path_absolute(directory)
+        is_directory_ignored = config.is_directory_ignored if config else None
+        batch = []
+
+        def changed(batch):
+            fingerprints = self._get_fingerprints([path for path, _ in batch])
+            return [path for path, stat in batch
+                    if path not in fingerprints
+                    or not fingerprints[path].matches(stat)]
+
+        for path, stat in walk_files(directory, is_directory_ignored,
+                                     recursive=recursive):
+            if config and config.is_file_ignored(path, size=stat.st_size):
+                continue
+            batch.append((path, stat))
+            if len(batch) == batch_size:
+                yield changed(batch)
+                batch = []
+        if batch:
+            yield changed(batch)
+
+    def snapshot(self, directory, config=None, workers=_SNAPSHOT_WORKERS,
+                 batch_size=_SNAPSHOT_BATCH_SIZE):
+        '''
+        Store all files in a directory tree.
+
+        ``directory`` is the path of the directory. Its tree is walked
+        in parallel using ``coba.walking.walk_files``.
+
+        If ``config`` is given then it is a ``coba.config.Config``
+        instance, and files and directories that are ignored according
+        to it are skipped.
+
+        Files whose fingerprint shows that they have not changed since
+        their latest version was stored are skipped. The other files are
+        read once by a pool of ``workers`` processes, which hash them and
+        only keep a file's content if it is not stored yet. The new
+        versions are committed in transactions of up to ``batch_size``
+        files. Only a bounded number of batches is processed at the same
+        time, so the memory usage does not depend on the size of the
+        tree. The limits of the store's throttle are divided between the
+        workers.
+
+        Returns the number of stored files.
+        '''
+        directory = make_path_absolute(directory)
+        cas_config = (self._cas.path, self.compression, self.chunking,
+                      self.pack_threshold, self._cas.throttle.split(workers))
+        # Maps the futures of running batches to their storage times
+        pending = {}
+
+        def record(futures):
+            num_recorded = 0
+            for future in futures:
+                stored_at, rows = pending.pop(future), future.result()
+                if rows:
+                    with _DB_COMMIT_SECONDS.time(), \
+                            tracing.span('store.db_commit',
+                                         versions=len(rows)), \
+                            self._write_scope() as connection:
+                        self._record_versions(connection, rows, stored_at)
+                    _STORED_VERSIONS.inc(len(rows))
+                    num_recorded += len(rows)
+            return num_recorded
+
+        num_stored = 0
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            for paths in self.find_changed_files(directory, config,
+                                                 batch_size):
+                if not paths:
+                    continue
+                future = executor.submit(_snapshot_files, cas_config, paths)
+                pending[future] = datetime.datetime.utcnow()
+                if len(pending) >= 2 * workers:
+                    done, _ = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    num_stored += record(done)
+            num_stored += record(list(pending))
+        log.debug('Stored {} files of {} in snapshot'.format(num_stored,
+                  directory))
+        return num_stored
+
+    def prune(self, policy, now=None):
+        '''
+        Remove old versions according to a retention policy.
+
+        ``policy`` is a ``coba.retention.RetentionPolicy``. ``now`` is
+        the time (in UTC) as a ``datetime.datetime`` relative to which
+        the ages of the versions are computed. It defaults to the
+        current time.
+
+        The versions are removed using set-based SQL statements in a
+        single transaction, and the reference counts of their contents
+        and the statistics are updated. The contents themselves are
+        removed later by ``collect_garbage``.
+
+        Returns the number of removed versions.
+        '''
+        now = now or datetime.datetime.utcnow()
+        params = {}
+        if policy.keep_last is None:
+            too_many = '0'
+        else:
+            too_many = 'rank > :keep_last'
+            params['keep_last'] = policy.keep_last
+        if policy.max_age is None:
+            expired = '0'
+        else:
+            expired = 'stored_at < :expires'
+            params['expires'] = _to_timestamp(now - policy.max_age)
+        if policy.thinning:
+            # The rule with the largest age comes first so that it wins
+            cases = []
+            for i, (after, every) in enumerate(reversed(policy.thinning)):
+                cases.append('WHEN stored_at < :thin_{0:d} '
+                             'THEN :every_{0:d}'.format(i))
+                params['thin_{:d}'.format(i)] = _to_timestamp(now - after)
+                params['every_{:d}'.format(i)] = int(every.total_seconds())
+            interval = 'CASE {} END'.format(' '.join(cases))
+            thinned = 'interval IS NOT NULL AND interval_rank > 1'
+        else:
+            interval = 'NULL'
+            thinned = '0'
+        candidates = text('INSERT INTO pruned_versions ' +
+                          _PRUNE_CANDIDATES_SQL.format(interval=interval,
+                                                       too_many=too_many,
+                                                       expired=expired,
+                                                       thinned=thinned))
+        with self._write_scope() as connection:
+            connection.exec_driver_sql(
+                'CREATE TEMP TABLE pruned_versions (id INTEGER PRIMARY KEY, '
+                + 'hash BLOB NOT NULL, path_id INTEGER NOT NULL, '
+                + 'size INTEGER NOT NULL)')
+            connection.exec_driver_sql(
+                'CREATE TEMP TABLE pruned_hashes '
+                + '(hash BLOB PRIMARY KEY, count INTEGER NOT NULL)')
+            connection.exec_driver_sql(
+                'CREATE TEMP TABLE pruned_paths (path_id INTEGER PRIMARY KEY, '
+                + 'count INTEGER NOT NULL, size INTEGER NOT NULL)')
+            try:
+                connection.execute(candidates.bindparams(**params))
+                connection.exec_driver_sql(
+                    'INSERT INTO pruned_hashes SELECT hash, COUNT(*) '
+                    + 'FROM pruned_versions GROUP BY hash')
+                connection.exec_driver_sql(
+                    'INSERT INTO pruned_paths SELECT path_id, COUNT(*), '
+                    + 'SUM(size) FROM pruned_versions GROUP BY path_id')
+                connection.execute(text(_RELEASE_PRUNED_SQL).bindparams(
+                                   now=_to_timestamp(
+                                       datetime.datetime.utcnow())))
+                for sql in _COUNT_PRUNED_SQL:
+                    connection.exec_driver_sql(sql)
+                num_pruned = connection.exec_driver_sql(
+                    'DELETE FROM versions WHERE id IN '
+                    + '(SELECT id FROM pruned_versions)').rowcount
+            finally:
+                for table in ['pruned_versions', 'pruned_hashes',
+                              'pruned_paths']:
+                    connection.exec_driver_sql('DROP TABLE ' + table)
+        log.debug('Pruned {} versions'.format(num_pruned))
+        return num_pruned
+
+    def collect_garbage(self, grace_period=_GC_GRACE_PERIOD):
+        '''
+        Remove contents that are no longer referenced.
+
+        Only contents whose reference count has been zero for at least
+        ``grace_period`` (a ``datetime.timedelta``) are removed. The
+        contents are removed in batches, each in its own transaction.
+        Removing a chunked content releases its chunks, which are
+        removed once their grace period has passed, too.
+
+        Contents in pack files are removed by compacting their packs
+        once most of a pack's data is unreferenced, see
+        ``coba.packs.PackStore.compact``. Until then the statistics do
+        not include them, although they still occupy space on disk.
+
+        Returns the number of removed contents.
+        '''
+        blobs = _Blob.__table__
+        num_removed = 0
+        while True:
+            now = datetime.datetime.utcnow()
+            with self._write_scope() as connection:
+                stored_sizes = {hash: stored_size for hash, stored_size in
+                                connection.execute(
+                                    select(blobs.c.hash, blobs.c.stored_size)
+                                    .where(blobs.c.refcount == 0)
+                                    .where(blobs.c.released_at
+                                           <= now - grace_period)
+                                    .limit(_MAX_SQL_PARAMETERS))}
+                if not stored_sizes:
+                    break
+                hashes = list(stored_sizes)
+                chunk_counts = collections.Counter()
+                for hash in hashes:
+                    chunk_counts.update(chunk_hash for chunk_hash, _ in
+                                        self._cas.get_chunks(hash) or [])
+                connection.execute(blobs.delete()
+                                   .where(blobs.c.hash.in_(hashes)))
+                statistics = _Statistics.__table__
+                connection.execute(statistics.update().values(
+                    contents=statistics.c.contents - len(hashes),
+                    stored_size=statistics.c.stored_size
+                    - sum(stored_sizes.values())))
+                if chunk_counts:
+                    self._release_references(connection, chunk_counts, now)
+                # The contents are removed while the transaction is still
+                # open, so that they cannot be referenced again in between
+                for hash in hashes:
+                    if self._cas.remove(hash):
+                        num_removed += 1
+        # Contents without a row are unreferenced. Packs that have been
+        # modified during the grace period are skipped, since they may
+        # contain new contents whose versions have not been recorded yet.
+        for pack in self._cas.get_packs():
+            with self._write_scope() as connection:
+                num_removed += self._cas.compact_pack(
+                    pack, functools.partial(self._find_contents, connection),
+                    grace_period.total_seconds())
+        log.debug('Removed {} unreferenced contents'.format(num_removed))
+        return num_removed
+
+    def _find_contents(self, connection, hashes):
+        '''
+        Find the contents that are recorded in the database.
+
+        Returns the set of those of the given hashes that have a row in
+        the blobs table.
+        '''
+        blobs = _Blob.__table__
+        found = set()
+        for i in range(0, len(hashes), _MAX_SQL_PARAMETERS):
+            chunk = hashes[i:i + _MAX_SQL_PARAMETERS]
+            found.update(hash for hash, in connection.execute(
+                select(blobs.c.hash).where(blobs.c.hash.in_(chunk))))
+        return found
+
+    def get_statistics(self, top=10):
+        '''
+        Get statistics of the store.
+
+        The statistics are maintained while versions are stored and
+        removed, so getting them is fast even for large stores.
+
+        ``top`` is the number of files that are listed in the result's
+        ``top_paths``.
+
+        Returns an instance of ``Statistics``.
+        '''
+        with self._session_scope() as session:
+            statistics = session.query(_Statistics).one()
+            top_paths = [PathStatistics(*row) for row in
+                         session.query(_Path.path, _PathStatistics.versions,
+                                       _PathStatistics.size)
+                                .join(_Path,
+                                      _Path.id == _PathStatistics.path_id)
+                                .order_by(_PathStatistics.size.desc(),
+                                          _Path.path)
+                                .limit(top)]
+            return Statistics(statistics.versions, statistics.size,
+                              statistics.contents, statistics.stored_size,
+                              top_paths)
+
+    def _restore(self, version, path, force):
         '''
         Restore a file to a previous version.
 
         Not intended to be called directly. Use ``Version.restore``
         instead.
 
-        ``_version`` is an instance of ``_Version`` that describes the
-        file to be restored.
+        ``version`` is the ``Version`` to be restored.
 
         ``path`` is the path at which the file is to be restored. Parent
         directories are created as necessary.
@@ -256,27 +1494,57 @@ class Store:
         '''
         if path.exists() and not force:
             raise FileExistsError('"{}" already exists'.format(path))
-        address = self._cas.get(_version.hash)
-        if not address:
-            raise ValueError('Content "{}" not found'.format(_version.hash))
+        if not self._cas.exists(version.hash):
+            raise ValueError('Content "{}" not found'.format(version.hash))
         try:
             path.parent.mkdir(parents=True)
         except FileExistsError:
             pass
-        shutil.copyfile(address.abspath, str(path))
+        strategy = self._cas.copy_to(version.hash, path)
+        log.debug('Restored {} using {}'.format(path, strategy))
         return path
 
-    def get_versions(self, path):
+    def get_versions(self, path, since=None, until=None, limit=None,
+                     reverse=False):
         '''
         Get the stored versions of a file.
 
         Yields an instance of ``Version`` for each stored version of the
-        given file.
+        given file, oldest first (newest first if ``reverse`` is true).
+
+        ``since`` and ``until`` are optional ``datetime.datetime``
+        objects in UTC. If given, only versions stored at or after
+        ``since`` and at or before ``until`` are yielded. At most
+        ``limit`` versions are yielded if it is given.
+
+        The versions are streamed from the database, so the memory usage
+        does not depend on the number of versions. The database
+        connection is held until the generator is exhausted or closed.
         '''
         path = make_path_absolute(path)
-        with self._session_scope() as session:
-            for _version in session.query(_Version).filter_by(path=path):
-                yield Version(_version, self)
+        versions = _Version.__table__
+        paths = _Path.__table__
+        query = select(versions.c.id, paths.c.path, versions.c.hash,
+                       versions.c.stored_at, versions.c.size) \
+            .select_from(versions.join(paths,
+                                       paths.c.id == versions.c.path_id)) \
+            .where(paths.c.path == path)
+        if since is not None:
+            query = query.where(versions.c.stored_at >= since)
+        if until is not None:
+            query = query.where(versions.c.stored_at <= until)
+        if reverse:
+            query = query.order_by(versions.c.stored_at.desc(),
+                                   versions.c.id.desc())
+        else:
+            query = query.order_by(versions.c.stored_at, versions.c.id)
+        if limit is not None:
+            query = query.limit(limit)
+        with self._engine.connect() as connection:
+            result = connection.execution_options(stream_results=True) \
+                               .execute(query)
+            for row in result:
+                yield Version(row, self)
 
     def get_version_at(self, path, at):
         '''
@@ -290,14 +1558,110 @@ class Store:
         ``Version`` instance, or ``None`` if no version before that
         moment is available.
         '''
-        path = make_path_absolute(path)
-        with self._session_scope() as session:
-            _version = session.query(_Version) \
-                              .filter(_Version.path == path) \
-                              .filter(_Version.stored_at <= at) \
-                              .order_by(_Version.stored_at.desc()) \
-                              .first()
-            if not _version:
-                return None
-            return Version(_version, self)
+        versions = self.get_versions(path, until=at, limit=1, reverse=True)
+        with contextlib.closing(versions):
+            return next(versions, None)
+
+    def get_versions_at(self, directory, at):
+        '''
+        Get the stored versions of all files in a directory tree at a
+        certain point in time.
+
+        ``directory`` is the path of the directory.
+
+        ``at`` is a ``datetime.datetime`` object.
+
+        Returns a list containing, for each file below ``directory`` that
+        has a version before ``at``, the latest such version as a
+        ``Version`` instance. The list is sorted by path.
+        '''
+        directory = make_path_absolute(directory)
+        prefix = str(directory).rstrip(os.sep) + os.sep
+        # All paths starting with ``prefix`` sort before ``upper_bound``.
+        # Unlike ``LIKE``, the range comparison is case-sensitive and can
+        # use the index on the paths.
+        upper_bound = prefix[:-1] + chr(ord(os.sep) + 1)
+        versions = _Version.__table__
+        paths = _Path.__table__
+        path_column = type_coerce(paths.c.path, Unicode)
+        with_paths = versions.join(paths, paths.c.id == versions.c.path_id)
+        latest = select(versions.c.path_id,
+                        func.max(versions.c.stored_at).label('stored_at')) \
+            .select_from(with_paths) \
+            .where(path_column >= prefix) \
+            .where(path_column < upper_bound) \
+            .where(versions.c.stored_at <= at) \
+            .group_by(versions.c.path_id) \
+            .subquery()
+        query = select(versions.c.id, paths.c.path, versions.c.hash,
+                       versions.c.stored_at, versions.c.size) \
+            .select_from(with_paths.join(latest, and_(
+                versions.c.path_id == latest.c.path_id,
+                versions.c.stored_at == latest.c.stored_at))) \
+            .order_by(versions.c.id)
+        # If several versions of a file share the same timestamp then the
+        # one that was inserted last wins
+        result = {}
+        with self._engine.connect() as connection:
+            for row in connection.execute(query):
+                result[row.path] = Version(row, self)
+        return [result[path] for path in sorted(result)]
+
+    def restore_tree(self, directory, at, target=None, force=False,
+                     workers=_RESTORE_WORKERS):
+        '''
+        Restore all files in a directory tree to a point in time.
+
+        ``directory`` is the path of the directory.
+
+        ``at`` is a ``datetime.datetime`` object. For each file below
+        ``directory``, the latest version before ``at`` is restored.
+
+        If ``target`` is given then the files are restored below that
+        directory (keeping their paths relative to ``directory``).
+        Otherwise they are restored at their original locations.
+
+        If ``force`` is false and any of the files to be restored already
+        exists then a ``FileExistsError`` is raised before any file is
+        restored. If ``force`` is true then existing files are replaced.
+
+        ``workers`` is the number of threads used for restoring.
+
+        Each distinct content is read from the store only once: the
+        other files with the same content are copied from the first
+        restored file.
+
+        Returns a list of the paths of the restored files.
+        '''
+        directory = make_path_absolute(directory)
+        if target is not None:
+            target = make_path_absolute(target)
+        groups = collections.OrderedDict()
+        for version in self.get_versions_at(directory, at):
+            if target is None:
+                path = version.path
+            else:
+                path = target / version.path.relative_to(directory)
+            groups.setdefault(version.hash, []).append((version, path))
+        if not force:
+            for group in groups.values():
+                for version, path in group:
+                    if path.exists():
+                        raise FileExistsError('"{}" already exists'.format(
+                                              path))
+
+        def restore_group(group):
+            version, first_path = group[0]
+            self._restore(version, first_path, force=True)
+            for version, path in group[1:]:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                copy_file(first_path, path)
+            return [path for version, path in group]
 
+        restored = []
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for paths in executor.map(restore_group, groups.values()):
+                restored.extend(paths)
+        log.debug('Restored {} files of {} with {} distinct contents'.format(
+                  len(restored), directory, len(groups)))
+        return sorted(restored)
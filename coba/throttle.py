@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import platform
+import threading
+import time
+
+
+__all__ = ['IO_CLASSES', 'set_io_priority', 'Throttle', 'TokenBucket']
+
+
+log = logging.getLogger(__name__)
+
+
+# Supported I/O scheduling classes, see ``ioprio_set(2)``
+IO_CLASSES = {
+    'none': 0,
+    'realtime': 1,
+    'best-effort': 2,
+    'idle': 3,
+}
+
+# Number of the ``ioprio_set`` system call on different architectures
+_IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282,
+}
+
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+# Seconds between two checks of the system load
+_LOAD_CHECK_INTERVAL_SECONDS = 1
+
+
+def set_io_priority(io_class, level=4):
+    '''
+    Set the I/O priority of the calling thread.
+
+    ``io_class`` is one of the keys of ``IO_CLASSES``. ``level`` is the
+    priority within the class (0 is highest, 7 lowest) and is ignored
+    for the ``idle`` class.
+
+    Only supported on Linux. Returns ``True`` if the priority was set.
+    '''
+    number = _IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if number is None or not platform.system() == 'Linux':
+        log.warning('Setting the I/O priority is not supported on this '
+                    + 'platform')
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if io_class == 'idle':
+        level = 0
+    priority = (IO_CLASSES[io_class] << _IOPRIO_CLASS_SHIFT) | level
+    # A "who" of 0 is the calling thread
+    if libc.syscall(number, _IOPRIO_WHO_PROCESS, 0, priority) != 0:
+        errno = ctypes.get_errno()
+        log.warning('Could not set I/O priority: {}'.format(
+                    os.strerror(errno)))
+        return False
+    return True
+
+
+class TokenBucket:
+    '''
+    Rate limiter based on a token bucket.
+
+    Tokens are added to the bucket at a constant rate, up to the bucket's
+    capacity. Consuming more tokens than are available blocks until the
+    missing tokens have been added. The bucket is thread-safe: threads
+    that consume tokens at the same time wait for their own share, so
+    the rate applies to all threads together.
+    '''
+    def __init__(self, rate, capacity=None):
+        '''
+        Constructor.
+
+        ``rate`` is the number of tokens added per second.
+
+        ``capacity`` is the maximum number of tokens in the bucket, which
+        limits bursts. It defaults to ``rate``.
+        '''
+        if rate <= 0:
+            raise ValueError('Rate must be positive')
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        '''
+        Take tokens from the bucket, waiting if necessary.
+
+        ``amount`` can be larger than the bucket's capacity.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # The tokens are reserved immediately, so that waiting threads
+            # queue up behind each other
+            self._tokens -= amount
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Throttle:
+    '''
+    Throttling of background work.
+
+    A throttle limits the number of files and bytes that are processed
+    per second, pauses while the system load is too high, and lowers the
+    CPU and I/O priority of the threads that do the work.
+
+    The limits are shared by all threads that use the same throttle.
+    Throttles are pickled by their settings, so each process has its own
+    limits.
+    '''
+    def __init__(self, bytes_per_second=0, files_per_second=0, max_load=0,
+                 nice=0, io_class='none'):
+        '''
+        Constructor.
+
+        ``bytes_per_second`` and ``files_per_second`` are the maximum
+        rates, ``0`` means unlimited.
+
+        If ``max_load`` is positive then work pauses while the system's
+        one-minute load average is above it.
+
+        ``nice`` is added to the niceness of each thread that uses the
+        throttle, and the thread's I/O scheduling class is set to
+        ``io_class`` (one of ``IO_CLASSES``) unless it is ``'none'``. On
+        Linux, both only affect the thread itself, not the whole process.
+        '''
+        if io_class not in IO_CLASSES:
+            raise ValueError('Invalid I/O class "{}"'.format(io_class))
+        self.bytes_per_second = bytes_per_second
+        self.files_per_second = files_per_second
+        self.max_load = max_load
+        self.nice = nice
+        self.io_class = io_class
+        self._bytes = None
+        if bytes_per_second:
+            self._bytes = TokenBucket(bytes_per_second)
+        self._files = None
+        if files_per_second:
+            self._files = TokenBucket(files_per_second)
+        self._next_load_check = 0
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {
+            'bytes_per_second': self.bytes_per_second,
+            'files_per_second': self.files_per_second,
+            'max_load': self.max_load,
+            'nice': self.nice,
+            'io_class': self.io_class,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __eq__(self, other):
+        if not isinstance(other, Throttle):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
+
+    def __hash__(self):
+        return hash(tuple(sorted(self.__getstate__().items())))
+
+    def split(self, num_workers):
+        '''
+        Create a throttle for one of several independent workers.
+
+        Returns a new throttle whose rates are the rates of this one
+        divided by ``num_workers``, so that workers which do not share
+        a throttle (for example because they run in separate processes)
+        together stay within this throttle's limits.
+        '''
+        return Throttle(self.bytes_per_second / num_workers,
+                        self.files_per_second / num_workers, self.max_load,
+                        self.nice, self.io_class)
+
+    def _set_priorities(self):
+        '''
+        Lower the priorities of the calling thread, once per thread.
+        '''
+        if getattr(self._local, 'prioritized', False):
+            return
+        self._local.prioritized = True
+        if self.nice:
+            os.nice(self.nice)
+        if self.io_class != 'none':
+            set_io_priority(self.io_class)
+
+    def _wait_for_load(self):
+        '''
+        Wait while the system load is too high.
+        '''
+        if not self.max_load or time.monotonic() < self._next_load_check:
+            return
+        paused = False
+        while os.getloadavg()[0] > self.max_load:
+            if not paused:
+                log.info('Pausing while the load is above {}'.format(
+                         self.max_load))
+                paused = True
+            time.sleep(_LOAD_CHECK_INTERVAL_SECONDS)
+        if paused:
+            log.info('Resuming')
+        self._next_load_check = (time.monotonic()
+                                 + _LOAD_CHECK_INTERVAL_SECONDS)
+
+    def start_file(self):
+        '''
+        Wait until the processing of another file is allowed.
+        '''
+        self._set_priorities()
+        self._wait_for_load()
+        if self._files:
+            self._files.consume(1)
+
+    def process_bytes(self, num_bytes):
+        '''
+        Wait until the processing of more bytes is allowed.
+
+        Should be called after a block of ``num_bytes`` bytes has been
+        processed.
+        '''
+        self._wait_for_load()
+        if self._bytes:
+            self._bytes.consume(num_bytes)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import json
+import os
+import threading
+import time
+
+
+__all__ = ['span', 'Tracer', 'TRACER']
+
+
+# Maximum number of recorded spans. Once it is reached the oldest spans are
+# discarded, so that tracing a long-running watcher needs bounded memory.
+MAX_SPANS = 1000000
+
+
+class _NullSpan:
+    '''
+    Span that is used while tracing is disabled.
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer, name, args):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        end = time.perf_counter()
+        self._tracer._record(self._name, self._start, end, self._args)
+
+
+class Tracer:
+    '''
+    Records the durations of named spans of code.
+
+    Spans are only recorded while the tracer is enabled, otherwise
+    ``span`` returns a shared no-op context manager. The recorded spans
+    can be exported in the Chrome trace event format, which can be
+    viewed in ``chrome://tracing`` or https://ui.perfetto.dev.
+    '''
+    def __init__(self, max_spans=MAX_SPANS):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._spans = collections.deque(maxlen=max_spans)
+        self._thread_names = {}
+        self._origin = time.perf_counter()
+
+    def enable(self):
+        '''
+        Start recording spans.
+        '''
+        self.enabled = True
+
+    def disable(self):
+        '''
+        Stop recording spans.
+        '''
+        self.enabled = False
+
+    def clear(self):
+        '''
+        Discard the recorded spans.
+        '''
+        with self._lock:
+            self._spans.clear()
+            self._thread_names.clear()
+
+    def span(self, name, **args):
+        '''
+        Return a context manager that records a span.
+
+        ``name`` is the name of the span. Additional keyword arguments
+        are shown as the span's arguments in the trace.
+        '''
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def _record(self, name, start, end, args):
+        thread = threading.current_thread()
+        with self._lock:
+            self._spans.append((name, start, end, thread.ident, args))
+            self._thread_names[thread.ident] = thread.name
+
+    def __len__(self):
+        return len(self._spans)
+
+    def to_dict(self):
+        '''
+        Return the recorded spans in the Chrome trace event format.
+        '''
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self._spans)
+            thread_names = dict(self._thread_names)
+        events = [{
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': pid,
+            'tid': tid,
+            'args': {'name': thread_name},
+        } for tid, thread_name in sorted(thread_names.items())]
+        for name, start, end, tid, args in spans:
+            event = {
+                'name': name,
+                'cat': name.partition('.')[0],
+                'ph': 'X',
+                'ts': (start - self._origin) * 10**6,
+                'dur': (end - start) * 10**6,
+                'pid': pid,
+                'tid': tid,
+            }
+            if args:
+                event['args'] = {key: str(value)
+                                 for key, value in args.items()}
+            events.append(event)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        '''
+        Write the recorded spans to a Chrome trace JSON file.
+
+        ``path`` is a ``pathlib.Path``.
+        '''
+        with path.open('w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f)
+
+
+# Default tracer, which is used by the ``coba`` modules. Note that spans
+# are per process, so work done in worker processes is not included.
+TRACER = Tracer()
+
+span = TRACER.span
@@ -117,3 +117,54 @@ def parse_file_size(s):
         return number
     exponent = _FILE_SIZE_UNIT_EXPONENTS[unit.lower()]
     return number * 1024**exponent
+
+
+_FILE_SIZE_UNITS = ['B', 'KiB', 'MiB', 'GiB', 'TiB']
+
+
+def format_file_size(size):
+    '''
+    Format a file size for humans.
+
+    ``size`` is the size in bytes. Returns a string with the size in the
+    largest binary unit that keeps the number at least 1.
+    '''
+    for unit in _FILE_SIZE_UNITS[:-1]:
+        if abs(size) < 1024:
+            break
+        size /= 1024
+    else:
+        unit = _FILE_SIZE_UNITS[-1]
+    if unit == 'B':
+        return '{:d} B'.format(size)
+    return '{:.1f} {}'.format(size, unit)
+
+
+_DURATION_RE = re.compile(r'^\s*(?P<number>\d+)\s*(?P<unit>[SsMmHhDdWw])?\s*$')
+
+_DURATION_UNIT_SECONDS = {
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+    'w': 7 * 24 * 60 * 60,
+}
+
+
+def parse_duration(s):
+    '''
+    Parse a duration from a string.
+
+    ``s`` is a string that contains an integer followed by an optional
+    unit. Supported units are ``s``, ``m``, ``h``, ``d``, and ``w`` (in
+    upper or lower case), representing seconds, minutes, hours, days,
+    and weeks. Without a unit the number is in seconds.
+
+    Returns the parsed duration as a ``datetime.timedelta``.
+    '''
+    match = _DURATION_RE.match(s)
+    if not match:
+        raise ValueError('Invalid duration "{}"'.format(s.strip()))
+    number = int(match.group('number'))
+    unit = (match.group('unit') or 's').lower()
+    return datetime.timedelta(seconds=number * _DURATION_UNIT_SECONDS[unit])
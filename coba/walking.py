@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import concurrent.futures
+import logging
+import os
+from pathlib import Path
+
+
+__all__ = ['walk_files']
+
+
+log = logging.getLogger(__name__)
+
+
+# Default number of threads that scan directories in parallel
+_WALK_WORKERS = 8
+
+
+def _scan_directory(path):
+    '''
+    Scan a single directory.
+
+    Returns a tuple ``(files, directories)``. ``files`` is a list of
+    ``(path, stat)`` tuples for the regular files in the directory and
+    ``directories`` is a list of the paths of its subdirectories.
+    Symbolic links are not followed. Entries that cannot be read are
+    skipped and logged.
+    '''
+    files = []
+    directories = []
+    try:
+        # Consuming the iterator completely closes it
+        entries = list(os.scandir(path))
+    except OSError as e:
+        log.error('Could not scan {}: {}'.format(path, e))
+        return files, directories
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                files.append((entry.path, entry.stat(follow_symlinks=False)))
+        except OSError as e:
+            log.error('Could not scan {}: {}'.format(entry.path, e))
+    return files, directories
+
+
+def walk_files(directory, is_directory_ignored=None, workers=_WALK_WORKERS,
+               recursive=True):
+    '''
+    Walk a directory tree in parallel.
+
+    ``directory`` is the ``pathlib.Path`` of the tree's root directory.
+
+    Directories are scanned using ``os.scandir`` by a pool of ``workers``
+    threads. Most of the time of a scan is spent in system calls, during
+    which other threads can run, so scanning directories in parallel
+    helps on file systems with a high latency (for example network file
+    systems) and on storage that can serve multiple requests at once.
+
+    If ``is_directory_ignored`` is given then it is a callable that
+    receives the path of a directory as a string. Directories for which
+    it returns true are not scanned.
+
+    If ``recursive`` is false then only ``directory`` itself is scanned.
+
+    Yields a tuple ``(path, stat)`` for each regular file in the tree,
+    where ``path`` is a ``pathlib.Path`` and ``stat`` is the file's
+    ``os.stat_result``. The order of the files is not defined.
+    '''
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(_scan_directory, str(directory))}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                files, directories = future.result()
+                if not recursive:
+                    directories = []
+                for path in directories:
+                    if is_directory_ignored and is_directory_ignored(path):
+                        log.debug('Skipping ignored directory {}'.format(
+                                  path))
+                        continue
+                    pending.add(executor.submit(_scan_directory, path))
+                for path, stat in files:
+                    yield Path(path), stat
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import functools
+import logging
+import os
+import types
+
+from watchdog.events import (generate_sub_created_events,
+                             generate_sub_moved_events)
+import watchdog.observers
+from watchdog.observers.api import BaseObserver
+
+try:
+    from watchdog.observers.inotify import InotifyEmitter
+    from watchdog.observers.inotify_buffer import InotifyBuffer
+    from watchdog.observers.inotify_c import Inotify
+except Exception:  # pragma: no cover
+    # inotify is only available on Linux
+    Inotify = None
+
+
+__all__ = ['create_observer']
+
+
+log = logging.getLogger(__name__)
+
+
+def create_observer(config):
+    '''
+    Create an observer that does not watch ignored directories.
+
+    ``config`` is a ``coba.config.Config`` instance. Directories that are
+    ignored according to it are not watched, neither when a watch is
+    scheduled nor when they are created later on. This keeps the number
+    of inotify watches (limited by ``fs.inotify.max_user_watches``) and
+    the number of discarded events low.
+
+    Note that a directory that was ignored when it was created stays
+    unwatched if it is later renamed to a name that is not ignored.
+
+    On platforms without inotify a standard ``watchdog`` observer is
+    returned, which watches all directories.
+    '''
+    if Inotify is None:  # pragma: no cover
+        return watchdog.observers.Observer()
+    if not _can_prune():  # pragma: no cover
+        log.warning('Unsupported version of watchdog, ignored directories '
+                    'are watched')
+        return watchdog.observers.Observer()
+    emitter_class = functools.partial(
+        _PruningInotifyEmitter,
+        is_directory_ignored=config.is_directory_ignored)
+    return BaseObserver(emitter_class)
+
+
+def _with_globals(function, **names):
+    '''
+    Copy a function and replace some of the global names it uses.
+
+    Watchdog's inotify classes create their helpers and walk directories
+    via global names. Replacing these names lets the original methods
+    use the pruning variants, with all the arguments that the installed
+    version of watchdog passes.
+    '''
+    copy = types.FunctionType(function.__code__,
+                              dict(function.__globals__, **names),
+                              function.__name__, function.__defaults__,
+                              function.__closure__)
+    copy.__kwdefaults__ = function.__kwdefaults__
+    return copy
+
+
+def _can_prune():
+    '''
+    Check whether watchdog creates its inotify helpers and walks
+    directories via the expected names.
+    '''
+    buffer_names = InotifyBuffer.__init__.__code__.co_names
+    emitter_names = InotifyEmitter.on_thread_start.__code__.co_names
+    queue_names = InotifyEmitter.queue_events.__code__.co_names
+    return ('Inotify' in buffer_names and 'InotifyBuffer' in emitter_names
+            and 'os' in Inotify._add_dir_watch.__code__.co_names
+            and 'os' in Inotify.read_events.__code__.co_names
+            and 'generate_sub_created_events' in queue_names
+            and 'generate_sub_moved_events' in queue_names
+            and 'os' in generate_sub_created_events.__code__.co_names
+            and 'os' in generate_sub_moved_events.__code__.co_names)
+
+
+if Inotify is not None:
+
+    class _PruningOs:
+        '''
+        Stand-in for the ``os`` module whose ``walk`` skips ignored
+        directories.
+
+        Watchdog walks directory trees when watches are added and when
+        directories are created or moved into the watched tree. Replacing
+        ``os`` in the corresponding functions keeps it from walking
+        ignored trees.
+        '''
+        def __init__(self, is_directory_ignored):
+            self._is_directory_ignored = is_directory_ignored
+
+        def __getattr__(self, name):
+            return getattr(os, name)
+
+        def _is_ignored(self, path):
+            return self._is_directory_ignored(os.fsdecode(path))
+
+        def walk(self, top, *args, **kwargs):
+            if self._is_ignored(top):
+                return
+            for root, dirnames, filenames in os.walk(top, *args, **kwargs):
+                # Modifying ``dirnames`` in place prunes the walk
+                dirnames[:] = [name for name in dirnames if not
+                               self._is_ignored(os.path.join(root, name))]
+                yield root, dirnames, filenames
+
+    class _PruningInotify(Inotify):
+        '''
+        Inotify wrapper that does not watch ignored directories.
+
+        Ignored directories get no watches and are not walked, neither
+        when the watch is started nor when they are created later on.
+        '''
+        def __init__(self, path, *args, is_directory_ignored, **kwargs):
+            # Needs to be set before the base constructor adds the watches
+            self._is_directory_ignored = is_directory_ignored
+            pruning_os = _PruningOs(is_directory_ignored)
+            self._add_dir_watch_pruned = _with_globals(Inotify._add_dir_watch,
+                                                       os=pruning_os)
+            self._read_events_pruned = _with_globals(Inotify.read_events,
+                                                     os=pruning_os)
+            super().__init__(path, *args, **kwargs)
+
+        def _add_dir_watch(self, *args, **kwargs):
+            return self._add_dir_watch_pruned(self, *args, **kwargs)
+
+        def read_events(self, *args, **kwargs):
+            events = self._read_events_pruned(self, *args, **kwargs)
+            # Events that are simulated for a new ignored directory carry
+            # its invalid watch descriptor
+            return [event for event in events if event.wd != -1]
+
+        def _add_watch(self, path, mask):
+            if self._is_directory_ignored(os.fsdecode(path)):
+                # -1 is the invalid watch descriptor, no events are ever
+                # read for it
+                self._wd_for_path[path] = -1
+                log.debug('Not watching ignored directory {}'.format(
+                          os.fsdecode(path)))
+                return -1
+            return super()._add_watch(path, mask)
+
+    class _PruningInotifyBuffer(InotifyBuffer):
+        '''
+        Inotify event buffer that uses ``_PruningInotify``.
+        '''
+        def __init__(self, path, *args, is_directory_ignored, **kwargs):
+            inotify_class = functools.partial(
+                _PruningInotify, is_directory_ignored=is_directory_ignored)
+            init = _with_globals(InotifyBuffer.__init__,
+                                 Inotify=inotify_class)
+            init(self, path, *args, **kwargs)
+
+    class _PruningInotifyEmitter(InotifyEmitter):
+        '''
+        Inotify event emitter that does not watch ignored directories.
+        '''
+        def __init__(self, *args, is_directory_ignored, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._is_directory_ignored = is_directory_ignored
+            pruning_os = _PruningOs(is_directory_ignored)
+            self._queue_events_pruned = _with_globals(
+                InotifyEmitter.queue_events,
+                generate_sub_created_events=_with_globals(
+                    generate_sub_created_events, os=pruning_os),
+                generate_sub_moved_events=_with_globals(
+                    generate_sub_moved_events, os=pruning_os))
+
+        def queue_events(self, *args, **kwargs):
+            # Events for the contents of directories that are moved into
+            # the watched tree are generated by walking them
+            self._queue_events_pruned(self, *args, **kwargs)
+
+        def on_thread_start(self):
+            buffer_class = functools.partial(
+                _PruningInotifyBuffer,
+                is_directory_ignored=self._is_directory_ignored)
+            on_thread_start = _with_globals(InotifyEmitter.on_thread_start,
+                                            InotifyBuffer=buffer_class)
+            on_thread_start(self)
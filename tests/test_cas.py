@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import os
+from unittest import mock
+
+import pytest
+
+from coba.cas import COMPRESSION_MODES, ContentStore, hash_file
+from coba.throttle import Throttle
+
+
+@pytest.fixture
+def cas(temp_dir):
+    return ContentStore(temp_dir / 'content')
+
+
+class TestContentStore:
+
+    def test_put(self, temp_dir, cas):
+        '''
+        Store the content of a file.
+        '''
+        content = b'foobar' * 1000
+        test_file = temp_dir / 'test.txt'
+        test_file.write_bytes(content)
+        hash = cas.put(test_file)
+        assert hash == hashlib.sha1(content).hexdigest()
+        path = cas.get_path(hash)
+        assert path == (temp_dir / 'content' / hash[0] / hash[1] / hash[2]
+                        / hash[3] / hash[4:])
+        assert path.read_bytes() == content
+        assert cas.exists(hash)
+        assert not list(cas._staging_path.iterdir())
+
+    def test_put_large_file(self, temp_dir, cas):
+        '''
+        Store a file that is larger than the read buffer.
+        '''
+        content = bytes(range(256)) * 10000
+        test_file = temp_dir / 'test.bin'
+        test_file.write_bytes(content)
+        hash = cas.put(test_file)
+        assert hash == hashlib.sha1(content).hexdigest()
+        assert cas.get_path(hash).read_bytes() == content
+
+    @mock.patch('coba.cas.reflink', return_value=False)
+    def test_put_without_reflinks(self, reflink, temp_dir, cas):
+        '''
+        Store a file on a file system without reflink support.
+        '''
+        content = b'foobar' * 1000
+        test_file = temp_dir / 'test.txt'
+        test_file.write_bytes(content)
+        hash = cas.put(test_file)
+        assert hash == hashlib.sha1(content).hexdigest()
+        assert cas.get_path(hash).read_bytes() == content
+        assert cas.copy_strategies == {'buffered': 1}
+
+    def test_put_existing_content(self, temp_dir, cas):
+        '''
+        Store a content that is already stored.
+        '''
+        test_file = temp_dir / 'test.txt'
+        test_file.write_text('foobar')
+        hash = cas.put(test_file)
+        mtime = cas.get_path(hash).stat().st_mtime_ns
+        other_file = temp_dir / 'other.txt'
+        other_file.write_text('foobar')
+        with mock.patch('os.replace') as replace:
+            assert cas.put(other_file) == hash
+            assert not replace.called
+        assert cas.get_path(hash).stat().st_mtime_ns == mtime
+        assert not list(cas._staging_path.iterdir())
+
+    def test_put_missing_file(self, temp_dir, cas):
+        '''
+        Store a file that does not exist.
+        '''
+        with pytest.raises(FileNotFoundError):
+            cas.put(temp_dir / 'missing')
+        assert not list(cas._staging_path.iterdir())
+
+    def test_get_path_of_missing_content(self, cas):
+        '''
+        Get the path of a content that is not stored.
+        '''
+        hash = hashlib.sha1(b'foo').hexdigest()
+        assert cas.get_path(hash) is None
+        assert not cas.exists(hash)
+
+    def test_copy_to(self, temp_dir, cas):
+        '''
+        Copy a stored content into a file.
+        '''
+        test_file = temp_dir / 'test.txt'
+        test_file.write_text('foobar')
+        hash = cas.put(test_file)
+        target = temp_dir / 'target.txt'
+        target.write_text('something longer')
+        cas.copy_to(hash, target)
+        assert target.read_text() == 'foobar'
+
+    def test_copy_to_missing_content(self, temp_dir, cas):
+        '''
+        Copy a content that is not stored.
+        '''
+        with pytest.raises(FileNotFoundError):
+            cas.copy_to(hashlib.sha1(b'foo').hexdigest(), temp_dir / 'x')
+
+    def test_invalid_compression_mode(self, temp_dir):
+        '''
+        Create a storage with an invalid compression mode.
+        '''
+        with pytest.raises(ValueError):
+            ContentStore(temp_dir / 'content', 'foobar')
+
+
+@pytest.mark.parametrize('mode', ['zlib', 'lzma'])
+class TestCompression:
+
+    def test_compressible_content(self, temp_dir, mode):
+        '''
+        Compressible contents are stored compressed.
+        '''
+        cas = ContentStore(temp_dir / 'content', mode)
+        content = b'hello world\n' * 200000
+        test_file = temp_dir / 'test.txt'
+        test_file.write_bytes(content)
+        hash = cas.put(test_file)
+        assert hash == hashlib.sha1(content).hexdigest()
+        path = cas.get_path(hash)
+        assert path.name != hash[4:]
+        assert path.stat().st_size < len(content) / 10
+        target = temp_dir / 'target.txt'
+        cas.copy_to(hash, target)
+        assert target.read_bytes() == content
+
+    def test_incompressible_content(self, temp_dir, mode):
+        '''
+        Incompressible contents are stored uncompressed.
+        '''
+        cas = ContentStore(temp_dir / 'content', mode)
+        content = os.urandom(100000)
+        test_file = temp_dir / 'test.bin'
+        test_file.write_bytes(content)
+        hash = cas.put(test_file)
+        path = cas.get_path(hash)
+        assert path.name == hash[4:]
+        assert path.read_bytes() == content
+
+    def test_empty_content(self, temp_dir, mode):
+        '''
+        Store an empty file.
+        '''
+        cas = ContentStore(temp_dir / 'content', mode)
+        test_file = temp_dir / 'empty'
+        test_file.touch()
+        hash = cas.put(test_file)
+        target = temp_dir / 'target'
+        cas.copy_to(hash, target)
+        assert target.read_bytes() == b''
+
+    def test_deduplication_across_modes(self, temp_dir, mode):
+        '''
+        Contents are deduplicated independently of their compression.
+        '''
+        test_file = temp_dir / 'test.txt'
+        test_file.write_text('foo' * 10000)
+        hash = ContentStore(temp_dir / 'content').put(test_file)
+        cas = ContentStore(temp_dir / 'content', mode)
+        assert cas.put(test_file) == hash
+        files = [p for p in (temp_dir / 'content').rglob('*') if p.is_file()]
+        assert files == [cas.get_path(hash)]
+        assert cas.get_path(hash).name == hash[4:]
+
+
+class TestChunking:
+
+    @pytest.mark.parametrize('compression', COMPRESSION_MODES)
+    def test_large_file(self, temp_dir, compression):
+        '''
+        Large files are stored in chunks.
+        '''
+        cas = ContentStore(temp_dir / 'content', compression, chunking=True)
+        content = os.urandom(1024**2) + b'text' * 300000
+        test_file = temp_dir / 'test.bin'
+        test_file.write_bytes(content)
+        hash = cas.put(test_file)
+        assert hash == hashlib.sha1(content).hexdigest()
+        assert cas.get_path(hash).name.endswith('.chunks')
+        target = temp_dir / 'target.bin'
+        cas.copy_to(hash, target)
+        assert target.read_bytes() == content
+
+    def test_modified_large_file(self, temp_dir):
+        '''
+        Storing a modified large file only stores the changed chunks.
+        '''
+        def stored_size():
+            return sum(p.stat().st_size for p in cas.path.rglob('*')
+                       if p.is_file())
+
+        cas = ContentStore(temp_dir / 'content', chunking=True)
+        content = os.urandom(4 * 1024**2)
+        test_file = temp_dir / 'test.bin'
+        test_file.write_bytes(content)
+        cas.put(test_file)
+        size = stored_size()
+        modified = content[:2000000] + b'modified' + content[2000000:]
+        test_file.write_bytes(modified)
+        hash = cas.put(test_file)
+        assert stored_size() - size < 1024**2
+        target = temp_dir / 'target.bin'
+        cas.copy_to(hash, target)
+        assert target.read_bytes() == modified
+
+    def test_small_file(self, temp_dir):
+        '''
+        Small files are not stored in chunks.
+        '''
+        cas = ContentStore(temp_dir / 'content', chunking=True)
+        test_file = temp_dir / 'test.txt'
+        test_file.write_text('foobar')
+        hash = cas.put(test_file)
+        assert cas.get_path(hash).name == hash[4:]
+
+
+class TestRemove:
+
+    def test_remove(self, temp_dir, cas):
+        '''
+        Contents in separate files can be removed.
+        '''
+        test_file = temp_dir / 'test.txt'
+        test_file.write_text('foobar')
+        hash = cas.put(test_file)
+        assert cas.remove(hash)
+        assert not cas.exists(hash)
+        assert not cas.remove(hash)
+
+    def test_packed_contents_are_kept(self, temp_dir):
+        '''
+        Contents in pack files are not removed.
+        '''
+        cas = ContentStore(temp_dir / 'content', pack_threshold=1024)
+        test_file = temp_dir / 'test.txt'
+        test_file.write_text('foobar')
+        hash = cas.put(test_file)
+        assert not cas.remove(hash)
+        assert cas.exists(hash)
+
+    @pytest.mark.parametrize('pack_threshold', [0, 1024**2])
+    def test_get_chunks(self, temp_dir, pack_threshold):
+        '''
+        The chunks of a chunked content can be listed.
+        '''
+        cas = ContentStore(temp_dir / 'content', chunking=True,
+                           pack_threshold=pack_threshold)
+        content = os.urandom(2 * 1024**2)
+        test_file = temp_dir / 'test.bin'
+        test_file.write_bytes(content)
+        hash = cas.put(test_file)
+        chunks = cas.get_chunks(hash)
+        assert len(chunks) > 1
+        assert all(cas.get_chunks(chunk) is None for chunk, _ in chunks)
+        assert sum(size for _, size in chunks) == len(content)
+        target = temp_dir / 'target.bin'
+        with target.open('wb') as f:
+            for chunk, _ in chunks:
+                cas._write_content(chunk, f)
+        assert target.read_bytes() == content
+
+    @pytest.mark.parametrize('compression', COMPRESSION_MODES)
+    @pytest.mark.parametrize('pack_threshold', [0, 1024**2])
+    def test_sizes(self, temp_dir, compression, pack_threshold):
+        '''
+        The size of a content and its size in the store.
+        '''
+        cas = ContentStore(temp_dir / 'content', compression,
+                           pack_threshold=pack_threshold)
+        test_file = temp_dir / 'test.txt'
+        test_file.write_bytes(b'foobar' * 1000)
+        hash = cas.put(test_file)
+        assert cas.get_size(hash) == 6000
+        stored_size = cas.get_stored_size(hash)
+        if compression == 'none':
+            assert stored_size == 6000
+        else:
+            assert stored_size < 6000
+        with pytest.raises(FileNotFoundError):
+            cas.get_size('0' * 40)
+
+
+class TestPacks:
+
+    @pytest.mark.parametrize('compression', COMPRESSION_MODES)
+    def test_small_file(self, temp_dir, compression):
+        '''
+        Small files are stored in pack files.
+        '''
+        cas = ContentStore(temp_dir / 'content', compression,
+                           pack_threshold=1024)
+        content = b'foobar' * 100
+        test_file = temp_dir / 'test.txt'
+        test_file.write_bytes(content)
+        hash = cas.put(test_file)
+        assert hash == hashlib.sha1(content).hexdigest()
+        assert cas.exists(hash)
+        assert cas.get_path(hash) is None
+        target = temp_dir / 'target.txt'
+        cas.copy_to(hash, target)
+        assert target.read_bytes() == content
+        assert not list(cas._staging_path.iterdir())
+        cas.close()
+
+    def test_large_file(self, temp_dir):
+        '''
+        Files above the threshold are stored in separate files.
+        '''
+        cas = ContentStore(temp_dir / 'content', pack_threshold=1024)
+        test_file = temp_dir / 'test.txt'
+        test_file.write_bytes(b'x' * 1024)
+        hash = cas.put(test_file)
+        assert cas.get_path(hash).read_bytes() == b'x' * 1024
+
+    def test_chunks(self, temp_dir):
+        '''
+        Small chunks of a large file are stored in pack files.
+        '''
+        cas = ContentStore(temp_dir / 'content', chunking=True,
+                           pack_threshold=1024**2)
+        content = os.urandom(2 * 1024**2)
+        test_file = temp_dir / 'test.bin'
+        test_file.write_bytes(content)
+        hash = cas.put(test_file)
+        files = [p for p in cas.path.rglob('*') if p.is_file()]
+        assert all(p.parent.name == 'packs' for p in files)
+        target = temp_dir / 'target.bin'
+        cas.copy_to(hash, target)
+        assert target.read_bytes() == content
+
+    def test_reopen(self, temp_dir):
+        '''
+        Packed contents can be read after reopening the store, even if
+        packing is disabled.
+        '''
+        cas = ContentStore(temp_dir / 'content', pack_threshold=1024)
+        test_file = temp_dir / 'test.txt'
+        test_file.write_text('foobar')
+        hash = cas.put(test_file)
+        cas.close()
+        cas = ContentStore(temp_dir / 'content')
+        assert cas.exists(hash)
+        target = temp_dir / 'target.txt'
+        cas.copy_to(hash, target)
+        assert target.read_text() == 'foobar'
+
+
+class TestThrottle:
+
+    @pytest.mark.parametrize('kwargs', [
+        {},
+        {'compression': 'zlib'},
+        {'chunking': True},
+        {'pack_threshold': 4 * 1024**2},
+    ])
+    def test_put_is_throttled(self, temp_dir, kwargs):
+        '''
+        Storing a file accounts for the file and all of its bytes.
+        '''
+        throttle = mock.Mock(spec=Throttle)
+        cas = ContentStore(temp_dir / 'content', throttle=throttle, **kwargs)
+        content = b'foobar' * 500000
+        test_file = temp_dir / 'test.txt'
+        test_file.write_bytes(content)
+        cas.put(test_file)
+        throttle.start_file.assert_called_once_with()
+        num_bytes = sum(c[0][0] for c in
+                        throttle.process_bytes.call_args_list)
+        assert num_bytes == len(content)
+
+    def test_hash_file(self, temp_dir):
+        '''
+        Hashing a file can be throttled.
+        '''
+        throttle = mock.Mock(spec=Throttle)
+        test_file = temp_dir / 'test.txt'
+        test_file.write_bytes(b'foobar')
+        assert hash_file(test_file, throttle) == hash_file(test_file)
+        throttle.process_bytes.assert_called_once_with(6)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import io
+import os
+
+import pytest
+
+from coba.chunking import Chunker
+
+
+def split(chunker, data):
+    return list(chunker.chunks(io.BytesIO(data)))
+
+
+class TestChunker:
+
+    def test_chunk_sizes(self):
+        '''
+        Chunks respect the minimum and maximum size.
+        '''
+        chunker = Chunker(1024, 4096, 16384)
+        data = os.urandom(500000)
+        chunks = split(chunker, data)
+        assert b''.join(chunks) == data
+        for chunk in chunks[:-1]:
+            assert 1024 <= len(chunk) <= 16384
+        average = len(data) / len(chunks)
+        assert 2048 < average < 8192
+
+    def test_uniform_data(self):
+        '''
+        Data without boundaries is split at the maximum chunk size.
+        '''
+        chunker = Chunker(1024, 4096, 16384)
+        chunks = split(chunker, b'\0' * 40000)
+        assert [len(c) for c in chunks] == [16384, 16384, 7232]
+
+    def test_small_and_empty_data(self):
+        '''
+        Split data that is smaller than the minimum chunk size.
+        '''
+        chunker = Chunker(1024, 4096, 16384)
+        assert split(chunker, b'foo') == [b'foo']
+        assert split(chunker, b'') == []
+
+    def test_insertion_only_changes_nearby_chunks(self):
+        '''
+        Inserting data only changes the chunks around the insertion.
+        '''
+        chunker = Chunker(1024, 4096, 16384)
+        data = os.urandom(300000)
+        modified = data[:150000] + b'inserted' + data[150000:]
+        chunks = split(chunker, data)
+        modified_chunks = split(chunker, modified)
+        assert len(set(chunks) - set(modified_chunks)) <= 2
+
+    def test_hasher(self):
+        '''
+        A hasher is fed with all data.
+        '''
+        data = os.urandom(100000)
+        hasher = hashlib.sha1()
+        list(Chunker().chunks(io.BytesIO(data), hasher))
+        assert hasher.hexdigest() == hashlib.sha1(data).hexdigest()
+
+    def test_invalid_sizes(self):
+        '''
+        Invalid chunk sizes.
+        '''
+        with pytest.raises(ValueError):
+            Chunker(100, 50, 200)
+        with pytest.raises(ValueError):
+            Chunker(100, 1000, 2000)
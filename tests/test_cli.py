@@ -21,7 +21,9 @@
 # THE SOFTWARE.
 
 import datetime
+import json
 from pathlib import Path
+import pstats
 import tempfile
 
 from click.testing import CliRunner
@@ -94,6 +96,70 @@ class TestWatch:
     # TODO: Test backup operation once config options can be properly set
 
 
+class TestSnapshot:
+    def test_no_argument(self):
+        '''
+        Run ``snapshot`` without any arguments.
+        '''
+        check_missing_argument(['snapshot'])
+
+    def test_snapshot(self, store, temp_dir):
+        '''
+        Run ``snapshot`` on a directory.
+        '''
+        (temp_dir / 'test.txt').write_text('foo')
+        (temp_dir / '.hidden').write_text('bar')
+        config = {'store_path': str(store.path), 'ignores': ['.*']}
+        result = run(['snapshot', str(temp_dir)], config=config)
+        assert 'Stored 1 new versions' in result.stdout
+        assert len(list(store.get_versions(temp_dir / 'test.txt'))) == 1
+
+
+class TestPrune:
+    def test_prune(self, store, temp_dir):
+        '''
+        Run ``prune``.
+        '''
+        test_file = temp_dir / 'test.txt'
+        for content in ['a', 'b', 'c']:
+            test_file.write_text(content)
+            store.put(test_file)
+        config = {'store_path': str(store.path)}
+        result = run(['prune'], config=config)
+        assert 'Removed 0 old versions' in result.stdout
+        result = run(['prune', '--keep-last', '2'], config=config)
+        assert 'Removed 1 old versions' in result.stdout
+        assert len(list(store.get_versions(test_file))) == 2
+
+    def test_invalid_keep_last(self):
+        '''
+        Run ``prune`` with an invalid number of versions.
+        '''
+        assert_failure(['prune', '--keep-last', '0'])
+
+
+class TestStats:
+    def test_stats(self, store, temp_dir):
+        '''
+        Run ``stats``.
+        '''
+        config = {'store_path': str(store.path)}
+        result = run(['stats'], config=config)
+        assert 'Versions:    0\n' in result.stdout
+        assert 'Largest files' not in result.stdout
+        test_file = temp_dir / 'test.txt'
+        for content in ['a' * 2048, 'b' * 2048, 'a' * 2048]:
+            test_file.write_text(content)
+            store.put(test_file)
+        result = run(['stats', '--top', '1'], config=config)
+        assert 'Versions:    3\n' in result.stdout
+        assert 'Total size:  6.0 KiB\n' in result.stdout
+        assert 'Contents:    2\n' in result.stdout
+        assert 'Stored size: 4.0 KiB\n' in result.stdout
+        assert 'Saved:       33.3%\n' in result.stdout
+        assert '3 versions  {}\n'.format(test_file) in result.stdout
+
+
 class TestVersions:
     def test_no_argument(self):
         '''
@@ -129,6 +195,39 @@ class TestVersions:
                 result = run(['versions', 'test.txt'], config=config)
                 assert result.stdout == expected_output
 
+    def test_filters(self, store, temp_dir):
+        '''
+        Run ``versions`` with filters.
+        '''
+        test_file = temp_dir / 'test.txt'
+        versions = []
+        for i in range(3):
+            test_file.write_text(str(i))
+            versions.append(store.put(test_file))
+        config = {'store_path': str(store.path)}
+        result = run(['versions', '--limit', '2', '--reverse', '--json',
+                      str(test_file)], config=config)
+        lines = [json.loads(line) for line in result.stdout.splitlines()]
+        assert [line['id'] for line in lines] == [versions[2].id,
+                                                  versions[1].id]
+        assert lines[0] == {
+            'id': versions[2].id,
+            'path': str(test_file),
+            'hash': versions[2].hash,
+            'stored_at': versions[2].stored_at.isoformat() + '+00:00',
+            'size': 1,
+        }
+        later = utc_to_local(versions[2].stored_at
+                             + datetime.timedelta(minutes=2))
+        result = run(['versions', '--since',
+                      '{:%Y-%m-%d %H:%M:%S}'.format(later), str(test_file)],
+                     config=config)
+        assert not result.stdout
+        result = run(['versions', '--until',
+                      '{:%Y-%m-%d %H:%M:%S}'.format(later), str(test_file)],
+                     config=config)
+        assert len(result.stdout.splitlines()) == 3
+
 
 class TestRestore:
     def test_not_enough_arguments(self):
@@ -198,3 +297,65 @@ class TestRestore:
                        'already exists',
                        config=config)
 
+    def test_recursive(self, store, temp_dir):
+        '''
+        ``restore`` a directory tree.
+        '''
+        root = temp_dir / 'root'
+        (root / 'sub').mkdir(parents=True)
+        (root / 'a.txt').write_text('a')
+        (root / 'sub' / 'b.txt').write_text('b')
+        store.put_many([root / 'a.txt', root / 'sub' / 'b.txt'])
+        when = datetime.datetime.now() + datetime.timedelta(minutes=1)
+        config = {'store_path': str(store.path)}
+        target = temp_dir / 'target'
+        result = run(['restore', '--recursive', '--to', str(target),
+                      '{:%Y-%m-%d %H:%M:%S}'.format(when), str(root)],
+                     config=config)
+        assert 'Restored 2 files' in result.stdout
+        assert (target / 'a.txt').read_text() == 'a'
+        assert (target / 'sub' / 'b.txt').read_text() == 'b'
+
+    def test_recursive_no_versions(self, temp_dir):
+        '''
+        ``restore`` a directory tree without versions.
+        '''
+        assert_failure(['restore', '--recursive', '2018-01-01', str(temp_dir)],
+                       'no versions in store')
+
+
+class TestProfiling:
+    def test_profile(self, store, temp_dir):
+        '''
+        Profile a command using the sampling profiler.
+        '''
+        profile_file = temp_dir / 'profile.txt'
+        config = {'store_path': str(store.path)}
+        run(['--profile', str(profile_file), 'stats'], config=config)
+        assert profile_file.exists()
+
+    def test_cprofile(self, store, temp_dir):
+        '''
+        Profile a command using ``cProfile``.
+        '''
+        profile_file = temp_dir / 'profile.pstats'
+        config = {'store_path': str(store.path)}
+        run(['--profile', str(profile_file), '--profiler', 'cprofile',
+             'stats'], config=config)
+        stats = pstats.Stats(str(profile_file))
+        assert any(function == 'stats'
+                   for _, _, function in stats.stats)
+
+    def test_trace(self, store, temp_dir):
+        '''
+        Trace a command.
+        '''
+        (temp_dir / 'tree').mkdir()
+        (temp_dir / 'tree' / 'test.txt').write_text('foo')
+        trace_file = temp_dir / 'trace.json'
+        config = {'store_path': str(store.path)}
+        run(['--trace', str(trace_file), 'snapshot', str(temp_dir / 'tree')],
+            config=config)
+        trace = json.loads(trace_file.read_text(encoding='utf-8'))
+        names = {event['name'] for event in trace['traceEvents']}
+        assert 'store.db_commit' in names
@@ -24,6 +24,7 @@ import logging
 from pathlib import Path
 import stat
 import tempfile
+import threading
 import time
 from unittest import mock
 
@@ -32,7 +33,11 @@ from sealedmock import seal
 from watchdog.events import FileSystemEventHandler
 import watchdog.observers
 
-from coba import EventHandler
+from coba import (BackupWorkerPool, catch_up, EventHandler, FileQueue,
+                  _QUEUE_WAIT_SECONDS)
+from coba.config import Config
+from coba.journal import QueueJournal
+from coba.store import Store
 
 
 log = logging.getLogger(__name__)
@@ -207,5 +212,337 @@ class TestEventHandler:
         seal(queue)
         assert not hasattr(queue, 'register_file_modification')
 
+    def test_ignored_files(self, temp_dir, queue):
+        '''
+        Files that are ignored by the configuration are not queued.
+        '''
+        cfg = Config('x', 1024, ['*.log', 'build/'])
+        (temp_dir / 'build').mkdir()
+        with Watch(temp_dir, EventHandler(queue, cfg)):
+            (temp_dir / 'test.log').write_text('foobar')
+            (temp_dir / 'build' / 'test.txt').write_text('foobar')
+            (temp_dir / 'large.txt').write_bytes(b'x' * 2048)
+            file_path = temp_dir / 'test.txt'
+            file_path.write_text('foobar')
+        seal(queue)
+        assert queue.register_file_modification.called
+        for call in queue.register_file_modification.call_args_list:
+            assert call == mock.call(file_path)
+
     # TODO: Changing a file/directory's owner
 
+
+class TestCatchUp:
+
+    @mock.patch('coba.store._RACY_FINGERPRINT_NS', 0)
+    def test_catch_up(self, temp_dir):
+        '''
+        Files that changed since their latest version are queued.
+        '''
+        root = temp_dir / 'root'
+        root.mkdir()
+        for name in ['unchanged', 'modified', 'ignored.log']:
+            (root / name).write_text(name)
+        cfg = Config('x', 1024, ['*.log'])
+        queue = mock.Mock()
+        with Store(temp_dir / 'store') as store:
+            store.put_many([root / 'unchanged', root / 'modified'])
+            (root / 'modified').write_text('foobar')
+            (root / 'new').write_text('new')
+            assert catch_up(store, root, queue, cfg) == 2
+        seal(queue)
+        paths = {call[0][0] for call
+                 in queue.register_file_modification.call_args_list}
+        assert paths == {root / 'modified', root / 'new'}
+
+    def test_stop(self, temp_dir):
+        '''
+        Catching up stops after the current batch once it is stopped.
+        '''
+        def find_changed_files(directory, config):
+            yield [Path('a'), Path('b')]
+            yield [Path('c')]
+
+        store = mock.Mock()
+        store.find_changed_files.side_effect = find_changed_files
+        queue = mock.Mock()
+        stopped = threading.Event()
+        stopped.set()
+        assert catch_up(store, temp_dir, queue, stopped=stopped) == 2
+        seal(queue)
+        paths = [call[0][0] for call
+                 in queue.register_file_modification.call_args_list]
+        assert paths == [Path('a'), Path('b')]
+
+
+class TestFileQueue:
+
+    def test_file_is_returned_after_idle_wait(self):
+        '''
+        A file is returned once the idle wait time has passed.
+        '''
+        queue = FileQueue(idle_wait=0.2)
+        start = time.monotonic()
+        queue.register_file_modification(Path('a'))
+        assert next(queue) == Path('a')
+        assert time.monotonic() - start >= 0.2
+        assert len(queue) == 0
+
+    def test_repeated_modifications(self):
+        '''
+        A file that is modified repeatedly is only returned once.
+        '''
+        queue = FileQueue(idle_wait=0.2)
+        for i in range(5):
+            queue.register_file_modification(Path('a'))
+            time.sleep(0.1)
+        start = time.monotonic()
+        assert queue.get_due_paths() == [Path('a')]
+        assert time.monotonic() - start >= 0.05
+        assert queue.get_due_paths(timeout=0.3) == []
+
+    def test_continuous_modifications(self):
+        '''
+        A file that is modified continuously is returned after the
+        maximum wait time.
+        '''
+        queue = FileQueue(idle_wait=0.2, max_wait=0.5)
+        stop = threading.Event()
+
+        def modify():
+            while not stop.is_set():
+                queue.register_file_modification(Path('a'))
+                time.sleep(0.05)
+
+        start = time.monotonic()
+        thread = threading.Thread(target=modify)
+        thread.start()
+        try:
+            assert queue.get_due_paths(timeout=2) == [Path('a')]
+            assert 0.5 <= time.monotonic() - start < 1
+        finally:
+            stop.set()
+            thread.join()
+
+    def test_due_paths_are_returned_in_one_batch(self):
+        '''
+        All due files are returned at once, oldest first.
+        '''
+        queue = FileQueue(idle_wait=0.1)
+        paths = [Path(str(i)) for i in range(100)]
+        for path in paths:
+            queue.register_file_modification(path)
+        time.sleep(0.2)
+        assert queue.get_due_paths() == paths
+
+    def test_queue_wait_metric(self):
+        '''
+        The time from the first event until a file is due is observed.
+        '''
+        queue = FileQueue(idle_wait=0.1)
+        count, sum = _QUEUE_WAIT_SECONDS.count, _QUEUE_WAIT_SECONDS.sum
+        queue.register_file_modification(Path('a'))
+        time.sleep(0.1)
+        queue.register_file_modification(Path('a'))
+        assert queue.get_due_paths() == [Path('a')]
+        assert _QUEUE_WAIT_SECONDS.count == count + 1
+        assert _QUEUE_WAIT_SECONDS.sum - sum >= 0.2
+
+    def test_timeout(self):
+        '''
+        Waiting for due files with a timeout.
+        '''
+        queue = FileQueue(idle_wait=10)
+        assert queue.get_due_paths(timeout=0.1) == []
+        queue.register_file_modification(Path('a'))
+        assert queue.get_due_paths(timeout=0.1) == []
+        assert len(queue) == 1
+
+    def test_repeated_modifications_do_not_grow_the_heap(self):
+        '''
+        Modifying a pending file only updates its deadline.
+        '''
+        queue = FileQueue(idle_wait=0.1)
+        for i in range(1000):
+            queue.register_file_modification(Path('a'))
+        assert len(queue._heap) == 1
+        assert queue.get_due_paths() == [Path('a')]
+
+    def test_event_storm(self):
+        '''
+        A directory with an event storm is rescanned.
+        '''
+        rescan = mock.Mock(return_value=[Path('storm/x'), Path('storm/y')])
+        queue = FileQueue(idle_wait=0.1, rescan=rescan, storm_threshold=10)
+        queue.register_file_modification(Path('other/a'))
+        for i in range(1000):
+            queue.register_file_modification(Path('storm/{}'.format(i)))
+        assert len(queue) == 2
+        assert len(queue._heap) <= 12
+        time.sleep(0.2)
+        due = queue.get_due_paths()
+        rescan.assert_called_once_with(Path('storm'))
+        assert sorted(due) == [Path('other/a'), Path('storm/x'),
+                               Path('storm/y')]
+        assert queue.get_due_paths(timeout=0.2) == []
+
+    def test_no_event_storm_without_rescan(self):
+        '''
+        Event storms are not detected without a rescan callback.
+        '''
+        queue = FileQueue(idle_wait=0.1, storm_threshold=10)
+        paths = [Path('dir/{}'.format(i)) for i in range(100)]
+        for path in paths:
+            queue.register_file_modification(path)
+        time.sleep(0.2)
+        assert queue.get_due_paths() == paths
+
+    def test_journal(self, temp_dir):
+        '''
+        Pending files are restored from the journal.
+        '''
+        journal_path = temp_dir / 'queue.journal'
+        with QueueJournal(journal_path) as journal:
+            queue = FileQueue(idle_wait=0.1, journal=journal)
+            for name in ['a', 'b', 'c']:
+                queue.register_file_modification(Path(name))
+            time.sleep(0.2)
+            assert queue.get_due_paths() == [Path('a'), Path('b'), Path('c')]
+            queue.mark_done([Path('a')])
+            # A file that is modified again stays in the journal
+            queue.register_file_modification(Path('b'))
+            queue.mark_done([Path('b')])
+        with QueueJournal(journal_path) as journal:
+            queue = FileQueue(idle_wait=0.1, journal=journal)
+            assert len(queue) == 2
+            time.sleep(0.2)
+            assert queue.get_due_paths() == [Path('b'), Path('c')]
+
+    def test_waiting_consumer_is_woken_up(self):
+        '''
+        A consumer waiting on an empty queue is woken up by new files.
+        '''
+        queue = FileQueue(idle_wait=0.1)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(next(queue)))
+        thread.start()
+        time.sleep(0.1)
+        queue.register_file_modification(Path('a'))
+        thread.join(2)
+        assert result == [Path('a')]
+
+
+class TestBackupWorkerPool:
+
+    @pytest.mark.parametrize('worker_type', ['thread', 'process'])
+    def test_backup(self, temp_dir, worker_type):
+        '''
+        Back up files using thread and process workers.
+        '''
+        paths = []
+        for i in range(10):
+            path = temp_dir / 'test{}.txt'.format(i)
+            path.write_text(str(i) * 1000)
+            paths.append(path)
+        with Store(temp_dir / 'store', compression='zlib') as store:
+            with BackupWorkerPool(store, 3, worker_type) as pool:
+                for path in paths:
+                    pool.submit(path)
+            for path in paths:
+                assert len(list(store.get_versions(path))) == 1
+        # Process workers use the store's configuration
+        assert list((temp_dir / 'store').rglob('*.zlib'))
+
+    def test_same_path_is_not_backed_up_concurrently(self, temp_dir):
+        '''
+        A file is not backed up by two workers at the same time.
+        '''
+        release = threading.Event()
+        running = []
+        calls = []
+
+        def put_many(paths):
+            for path in paths:
+                assert path not in running
+                running.append(path)
+            calls.append(paths)
+            release.wait()
+            for path in paths:
+                running.remove(path)
+
+        store = mock.Mock()
+        store.put_many.side_effect = put_many
+        path = temp_dir / 'test.txt'
+        with BackupWorkerPool(store, 4) as pool:
+            pool.submit(path)
+            pool.submit(path)
+            pool.submit(path)
+            time.sleep(0.2)
+            assert calls == [[path]]
+            release.set()
+        # Multiple submissions during a running backup are merged
+        assert calls == [[path], [path]]
+
+    def test_batch_size(self):
+        '''
+        Files are backed up in batches of the maximum batch size.
+        '''
+        store = mock.Mock()
+        paths = [Path(str(i)) for i in range(7)]
+        with BackupWorkerPool(store, 1, batch_size=3, batch_delay=10) as pool:
+            for path in paths:
+                pool.submit(path)
+        assert store.put_many.call_args_list == [
+            mock.call(paths[:3]),
+            mock.call(paths[3:6]),
+            mock.call(paths[6:]),
+        ]
+
+    def test_batch_delay(self):
+        '''
+        Incomplete batches are started after the maximum batch delay.
+        '''
+        store = mock.Mock()
+        with BackupWorkerPool(store, 1, batch_size=10,
+                              batch_delay=0.2) as pool:
+            pool.submit(Path('a'))
+            pool.submit(Path('b'))
+            time.sleep(0.1)
+            assert not store.put_many.called
+            time.sleep(0.3)
+            store.put_many.assert_called_once_with([Path('a'), Path('b')])
+
+    def test_failing_backup(self, temp_dir):
+        '''
+        A failing backup does not stop the pool.
+        '''
+        test_file = temp_dir / 'test.txt'
+        test_file.touch()
+        with Store(temp_dir / 'store') as store:
+            with BackupWorkerPool(store, 2) as pool:
+                pool.submit(temp_dir / 'does-not-exist')
+                pool.submit(test_file)
+            assert len(list(store.get_versions(test_file))) == 1
+
+    def test_on_done(self):
+        '''
+        The callback is called with the files of finished batches.
+        '''
+        store = mock.Mock()
+        on_done = mock.Mock()
+        with BackupWorkerPool(store, 1, batch_size=2,
+                              on_done=on_done) as pool:
+            pool.submit(Path('a'))
+            pool.submit(Path('b'))
+        on_done.assert_called_once_with([Path('a'), Path('b')])
+        store.put_many.side_effect = OSError()
+        with BackupWorkerPool(store, 1, on_done=on_done) as pool:
+            pool.submit(Path('c'))
+        on_done.assert_called_once_with([Path('a'), Path('b')])
+
+    def test_invalid_worker_type(self):
+        '''
+        Create a pool with an invalid worker type.
+        '''
+        with pytest.raises(ValueError):
+            BackupWorkerPool(mock.Mock(), 1, 'foobar')
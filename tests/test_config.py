@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
+import datetime
 from pathlib import Path
 
+import pathspec
 import pytest
 
 from coba.config import Config, DEFAULT_CONFIG
+from coba.retention import RetentionPolicy
 
 
 class TestConfig:
@@ -16,6 +19,42 @@ class TestConfig:
         assert cfg.is_file_ignored(Path('x.foo'))
         assert not cfg.is_file_ignored(Path('x.bar'))
 
+    @pytest.mark.parametrize('ignores', [
+        ['*.foo'],
+        ['.*'],
+        ['*.foo', '!keep.foo'],
+        ['!keep.foo', '*.foo'],
+        ['/x/y', 'z/**/*.bar'],
+        ['# comment', '', 'y'],
+    ])
+    def test_is_file_ignored_like_pathspec(self, ignores):
+        '''
+        Compiled ignore patterns match like ``pathspec``.
+        '''
+        spec = pathspec.PathSpec.from_lines('gitwildmatch', ignores)
+        cfg = Config('x', 1, ignores)
+        for path in ['x.foo', 'keep.foo', 'a/keep.foo', '.x', 'a/.x/b',
+                     'x/y', 'a/x/y', 'x/y/z', 'z/a/b/c.bar', 'z/c.bar',
+                     'c.bar', 'y', 'a/y/b', '/a/b/y']:
+            assert cfg.is_file_ignored(Path(path)) == spec.match_file(path)
+
+    def test_is_directory_ignored(self):
+        '''
+        Ignore directories and their content.
+        '''
+        cfg = Config('x', 1, ['build/', '.*', '!.keep', 'x.foo'])
+        assert cfg.is_directory_ignored(Path('/a/build'))
+        assert cfg.is_directory_ignored(Path('/a/build/sub'))
+        assert cfg.is_directory_ignored(Path('a/.git'))
+        assert cfg.is_directory_ignored(Path('x.foo'))
+        assert not cfg.is_directory_ignored(Path('a/b'))
+        assert not cfg.is_directory_ignored(Path('a/.keep'))
+        assert not cfg.is_directory_ignored(Path('/'))
+        assert cfg.is_file_ignored(Path('/a/build/x.txt'))
+        assert cfg.is_file_ignored(Path('a/.git/x/.keep'))
+        assert not cfg.is_file_ignored(Path('a/build'))
+        assert not cfg.is_file_ignored(Path('a/.keep'))
+
     def test_is_file_ignored_by_size(self, temp_dir):
         '''
         Ignore a file by its size.
@@ -32,6 +71,8 @@ class TestConfig:
         assert not cfg.is_file_ignored(equal_file)
         assert cfg.is_file_ignored(larger_file)
         assert not cfg.is_file_ignored(missing_file)
+        assert cfg.is_file_ignored(missing_file, size=11)
+        assert not cfg.is_file_ignored(larger_file, size=10)
 
     def test_from_file_defaults(self, temp_dir):
         '''
@@ -57,6 +98,99 @@ class TestConfig:
         assert cfg.max_file_size == DEFAULT_CONFIG.max_file_size
         assert cfg.ignores == ['a', 'b']
 
+        cfg_file.write_text('workers: 7\nworker_type: process\n')
+        cfg = Config.from_file(cfg_file)
+        assert cfg.store_path == DEFAULT_CONFIG.store_path
+        assert cfg.workers == 7
+        assert cfg.worker_type == 'process'
+        assert cfg.batch_size == DEFAULT_CONFIG.batch_size
+
+        cfg_file.write_text('batch_size: 3\nbatch_delay: 0.25\n')
+        cfg = Config.from_file(cfg_file)
+        assert cfg.workers == DEFAULT_CONFIG.workers
+        assert cfg.batch_size == 3
+        assert cfg.batch_delay == 0.25
+
+        cfg_file.write_text('compression: lzma\n')
+        cfg = Config.from_file(cfg_file)
+        assert cfg.batch_size == DEFAULT_CONFIG.batch_size
+        assert cfg.compression == 'lzma'
+        assert cfg.chunking == DEFAULT_CONFIG.chunking
+
+        cfg_file.write_text('chunking: true\n')
+        cfg = Config.from_file(cfg_file)
+        assert cfg.compression == DEFAULT_CONFIG.compression
+        assert cfg.chunking is True
+        assert cfg.pack_threshold == DEFAULT_CONFIG.pack_threshold
+
+        cfg_file.write_text('pack_threshold: 8 k\n')
+        cfg = Config.from_file(cfg_file)
+        assert cfg.chunking == DEFAULT_CONFIG.chunking
+        assert cfg.pack_threshold == 8192
+        assert cfg.persistent_queue == DEFAULT_CONFIG.persistent_queue
+
+        cfg_file.write_text('persistent_queue: false\n')
+        cfg = Config.from_file(cfg_file)
+        assert cfg.pack_threshold == DEFAULT_CONFIG.pack_threshold
+        assert cfg.persistent_queue is False
+        assert cfg.max_bytes_per_second == DEFAULT_CONFIG.max_bytes_per_second
+
+        cfg_file.write_text('max_bytes_per_second: 2 m\n'
+                            + 'max_files_per_second: 50\nmax_load: 1.5\n'
+                            + 'nice: 10\nio_class: idle\n')
+        cfg = Config.from_file(cfg_file)
+        assert cfg.persistent_queue == DEFAULT_CONFIG.persistent_queue
+        assert cfg.max_bytes_per_second == 2 * 1024**2
+        assert cfg.max_files_per_second == 50
+        assert cfg.max_load == 1.5
+        assert cfg.nice == 10
+        assert cfg.io_class == 'idle'
+        assert cfg.retention == DEFAULT_CONFIG.retention
+
+        cfg_file.write_text('retention:\n  keep_last: 3\n'
+                            + 'prune_interval: 10 m\n')
+        cfg = Config.from_file(cfg_file)
+        assert cfg.io_class == DEFAULT_CONFIG.io_class
+        assert cfg.retention == RetentionPolicy(keep_last=3)
+        assert cfg.prune_interval == datetime.timedelta(minutes=10)
+        assert cfg.metrics_address == DEFAULT_CONFIG.metrics_address
+
+        cfg_file.write_text('metrics_address: localhost:9100\n'
+                            + 'metrics_file: metrics.json\n'
+                            + 'metrics_interval: 5\n')
+        cfg = Config.from_file(cfg_file)
+        assert cfg.prune_interval == DEFAULT_CONFIG.prune_interval
+        assert cfg.metrics_address == 'localhost:9100'
+        assert cfg.metrics_file == Path('metrics.json')
+        assert cfg.metrics_interval == 5
+
+    def test_invalid_workers(self):
+        '''
+        Invalid worker settings.
+        '''
+        with pytest.raises(ValueError):
+            Config('x', 1, [], workers=0)
+        with pytest.raises(ValueError):
+            Config('x', 1, [], worker_type='foobar')
+        with pytest.raises(ValueError):
+            Config('x', 1, [], batch_size=0)
+        with pytest.raises(ValueError):
+            Config('x', 1, [], batch_delay=-1)
+        with pytest.raises(ValueError):
+            Config('x', 1, [], compression='foobar')
+        with pytest.raises(ValueError):
+            Config('x', 1, [], pack_threshold=-1)
+        with pytest.raises(ValueError):
+            Config('x', 1, [], max_bytes_per_second=-1)
+        with pytest.raises(ValueError):
+            Config('x', 1, [], max_files_per_second=-1)
+        with pytest.raises(ValueError):
+            Config('x', 1, [], max_load=-1)
+        with pytest.raises(ValueError):
+            Config('x', 1, [], io_class='foobar')
+        with pytest.raises(ValueError):
+            Config('x', 1, [], metrics_interval=0)
+
     def test_from_file_missing_file(self):
         '''
         Load configuration from a missing file.
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import errno
+import os
+from unittest import mock
+
+import pytest
+
+from coba import copying
+from coba.copying import (BUFFERED, COPY_FILE_RANGE, copy_file, REFLINK,
+                          SENDFILE)
+
+
+@pytest.fixture(autouse=True)
+def reset_unsupported():
+    copying._unsupported.clear()
+    yield
+    copying._unsupported.clear()
+
+
+def unsupported(*args, **kwargs):
+    raise OSError(errno.EXDEV, 'Not supported')
+
+
+CONTENT = bytes(range(256)) * 1000
+
+
+@pytest.fixture
+def source(temp_dir):
+    path = temp_dir / 'source'
+    path.write_bytes(CONTENT)
+    return path
+
+
+class TestCopyFile:
+
+    def test_copy(self, temp_dir, source):
+        '''
+        Copy a file using the best available strategy.
+        '''
+        target = temp_dir / 'target'
+        strategy = copy_file(source, target)
+        assert strategy in [REFLINK, COPY_FILE_RANGE, SENDFILE, BUFFERED]
+        assert target.read_bytes() == CONTENT
+
+    def test_overwrite(self, temp_dir, source):
+        '''
+        Copy a file to an existing file.
+        '''
+        target = temp_dir / 'target'
+        target.write_bytes(b'x' * (len(CONTENT) + 100))
+        copy_file(source, target)
+        assert target.read_bytes() == CONTENT
+
+    @mock.patch('fcntl.ioctl', unsupported)
+    def test_copy_file_range_fallback(self, temp_dir, source):
+        '''
+        ``copy_file_range`` is used if reflinks are not supported.
+        '''
+        if not hasattr(os, 'copy_file_range'):
+            pytest.skip('os.copy_file_range is not available')
+        target = temp_dir / 'target'
+        assert copy_file(source, target) == COPY_FILE_RANGE
+        assert target.read_bytes() == CONTENT
+
+    @mock.patch('fcntl.ioctl', unsupported)
+    @mock.patch('os.copy_file_range', unsupported, create=True)
+    def test_sendfile_fallback(self, temp_dir, source):
+        '''
+        ``sendfile`` is used if ``copy_file_range`` is not supported.
+        '''
+        target = temp_dir / 'target'
+        assert copy_file(source, target) == SENDFILE
+        assert target.read_bytes() == CONTENT
+
+    @mock.patch('fcntl.ioctl', unsupported)
+    @mock.patch('os.copy_file_range', unsupported, create=True)
+    @mock.patch('os.sendfile', unsupported)
+    def test_buffered_fallback(self, temp_dir, source):
+        '''
+        A buffered copy is used if no other strategy is supported.
+        '''
+        target = temp_dir / 'target'
+        assert copy_file(source, target) == BUFFERED
+        assert target.read_bytes() == CONTENT
+
+    def test_unsupported_strategies_are_remembered(self, temp_dir, source):
+        '''
+        Unsupported strategies are not tried again.
+        '''
+        ioctl = mock.Mock(side_effect=unsupported)
+        with mock.patch('fcntl.ioctl', ioctl):
+            copy_file(source, temp_dir / 'target1')
+            copy_file(source, temp_dir / 'target2')
+        assert ioctl.call_count == 1
+
+    def test_other_errors_are_raised(self, temp_dir, source):
+        '''
+        Errors other than missing support are not swallowed.
+        '''
+        def fail(*args):
+            raise OSError(errno.EIO, 'I/O error')
+        with mock.patch('fcntl.ioctl', fail):
+            with pytest.raises(OSError):
+                copy_file(source, temp_dir / 'target')
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from pathlib import Path
+from unittest import mock
+
+from coba.journal import QueueJournal
+
+
+class TestQueueJournal:
+
+    def test_add_and_done(self, temp_dir):
+        '''
+        Pending files are restored when the journal is reopened.
+        '''
+        path = temp_dir / 'queue.journal'
+        with QueueJournal(path) as journal:
+            assert journal.pending == []
+            journal.add(Path('a'))
+            journal.add(Path('b\nc'))
+            journal.add(Path('a'))
+            journal.add(Path('d'))
+            journal.done([Path('d'), Path('e')])
+            assert journal.pending == [Path('a'), Path('b\nc')]
+        with QueueJournal(path) as journal:
+            assert journal.pending == [Path('a'), Path('b\nc')]
+        # The journal is compacted when it is opened
+        assert len(path.read_text().splitlines()) == 2
+
+    def test_background_flush(self, temp_dir):
+        '''
+        Entries are written to disk in the background.
+        '''
+        path = temp_dir / 'queue.journal'
+        journal = QueueJournal(path, flush_interval=0.1)
+        journal.open()
+        try:
+            with mock.patch('os.fsync') as fsync:
+                journal.add(Path('a'))
+                journal.add(Path('b'))
+                assert path.read_text() == ''
+                journal._closed.wait(0.5)
+                assert fsync.call_count == 1
+            assert QueueJournal(path).pending == []
+            reopened = QueueJournal(path)
+            reopened._read()
+            assert list(reopened._pending) == [Path('a'), Path('b')]
+        finally:
+            journal.close()
+
+    def test_incomplete_entry(self, temp_dir):
+        '''
+        A partially written entry at the end of the journal is ignored.
+        '''
+        path = temp_dir / 'queue.journal'
+        path.write_text('+"a"\n+"b"\n-"a"\n+"c')
+        with QueueJournal(path) as journal:
+            assert journal.pending == [Path('b')]
+
+    @mock.patch('coba.journal._MIN_COMPACTION_ENTRIES', 10)
+    def test_compaction(self, temp_dir):
+        '''
+        The journal is compacted once it contains many done files.
+        '''
+        path = temp_dir / 'queue.journal'
+        with QueueJournal(path) as journal:
+            for i in range(20):
+                journal.add(Path(str(i)))
+                journal.done([Path(str(i))])
+            journal.add(Path('x'))
+            journal.flush()
+            assert path.read_text() == '+"x"\n'
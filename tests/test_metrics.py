@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import http.client
+import json
+import socket
+import urllib.request
+
+import pytest
+
+from coba.metrics import MetricsDumper, MetricsServer, Registry
+
+
+@pytest.fixture
+def registry():
+    registry = Registry()
+    registry.counter('test_events_total', 'Number of events').inc(3)
+    registry.gauge('test_queue_size', 'Size of the queue').set(2)
+    registry.histogram('test_seconds', 'Durations', ['phase'],
+                       buckets=(1, 10)).labels('copy').observe(5)
+    return registry
+
+
+class TestRegistry:
+
+    def test_render(self, registry):
+        '''
+        Metrics are rendered in Prometheus' text format.
+        '''
+        lines = registry.render().splitlines()
+        assert '# TYPE test_events_total counter' in lines
+        assert 'test_events_total 3' in lines
+        assert '# TYPE test_queue_size gauge' in lines
+        assert 'test_queue_size 2' in lines
+        assert '# TYPE test_seconds histogram' in lines
+        assert 'test_seconds_bucket{phase="copy",le="1.0"} 0' in lines
+        assert 'test_seconds_bucket{phase="copy",le="10.0"} 1' in lines
+        assert 'test_seconds_bucket{phase="copy",le="+Inf"} 1' in lines
+        assert 'test_seconds_sum{phase="copy"} 5' in lines
+        assert 'test_seconds_count{phase="copy"} 1' in lines
+
+    def test_to_dict(self, registry):
+        '''
+        Metrics can be converted to JSON.
+        '''
+        data = json.loads(json.dumps(registry.to_dict()))
+        assert data['test_events_total']['samples'] == [
+            {'labels': {}, 'value': 3}]
+        sample = data['test_seconds']['samples'][0]
+        assert sample['labels'] == {'phase': 'copy'}
+        assert sample['count'] == 1
+        assert sample['buckets'] == {'1.0': 0, '10.0': 1, '+Inf': 1}
+
+    def test_get_or_create(self, registry):
+        '''
+        Asking for an existing metric returns it.
+        '''
+        counter = registry.counter('test_events_total', 'Number of events')
+        assert counter.value == 3
+        with pytest.raises(ValueError):
+            registry.gauge('test_events_total', 'Number of events')
+
+    def test_labels(self, registry):
+        '''
+        Metrics with labels have a value per combination of labels.
+        '''
+        counter = registry.counter('test_errors_total', 'Errors', ['kind'])
+        counter.labels('store').inc()
+        counter.labels('store').inc()
+        counter.labels('rescan').inc()
+        lines = registry.render().splitlines()
+        assert 'test_errors_total{kind="store"} 2' in lines
+        assert 'test_errors_total{kind="rescan"} 1' in lines
+        with pytest.raises(ValueError):
+            counter.labels()
+        with pytest.raises(AttributeError):
+            counter.inc()
+
+    def test_gauge_function(self, registry):
+        '''
+        A gauge's value can be computed when it is collected.
+        '''
+        items = [1, 2, 3]
+        registry.gauge('test_items', 'Items').set_function(lambda: len(items))
+        assert 'test_items 3' in registry.render().splitlines()
+        items.pop()
+        assert 'test_items 2' in registry.render().splitlines()
+
+    def test_histogram_time(self, registry):
+        '''
+        Durations can be observed using a context manager.
+        '''
+        histogram = registry.histogram('test_durations', 'Durations')
+        with histogram.time():
+            pass
+        assert histogram.count == 1
+        assert 0 <= histogram.sum < 1
+
+
+class TestMetricsServer:
+
+    def test_tcp(self, registry):
+        '''
+        Metrics are served via TCP.
+        '''
+        with MetricsServer('127.0.0.1:0', registry) as server:
+            with urllib.request.urlopen(server.url) as response:
+                assert response.headers['Content-Type'].startswith(
+                    'text/plain')
+                text = response.read().decode('utf-8')
+            assert 'test_events_total 3' in text.splitlines()
+            with urllib.request.urlopen(server.url + '.json') as response:
+                data = json.loads(response.read().decode('utf-8'))
+            assert data['test_queue_size']['samples'][0]['value'] == 2
+
+    def test_invalid_address(self, registry):
+        '''
+        Addresses without a host are rejected.
+        '''
+        with pytest.raises(ValueError):
+            MetricsServer('8080', registry)
+
+    def test_unix_socket(self, registry, temp_dir):
+        '''
+        Metrics are served via a Unix socket.
+        '''
+        socket_path = temp_dir / 'metrics.sock'
+        with MetricsServer('unix:' + str(socket_path), registry):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(str(socket_path))
+            connection = http.client.HTTPConnection('localhost')
+            connection.sock = sock
+            connection.request('GET', '/metrics')
+            response = connection.getresponse()
+            assert response.status == 200
+            text = response.read().decode('utf-8')
+            connection.close()
+            assert 'test_events_total 3' in text.splitlines()
+        assert not socket_path.exists()
+
+
+class TestMetricsDumper:
+
+    def test_dump(self, registry, temp_dir):
+        '''
+        Metrics are written to a JSON file.
+        '''
+        path = temp_dir / 'metrics.json'
+        with MetricsDumper(path, interval=0.01, registry=registry):
+            registry.counter('test_events_total', 'Number of events').inc()
+        data = json.loads(path.read_text(encoding='utf-8'))
+        assert data['metrics']['test_events_total']['samples'][0][
+            'value'] == 4
+        assert 'timestamp' in data
+        assert [p.name for p in temp_dir.iterdir()] == ['metrics.json']
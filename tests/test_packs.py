@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import os
+from unittest import mock
+
+from coba.packs import PackStore
+
+
+def _hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class TestPackStore:
+
+    def test_put_and_read(self, temp_dir):
+        '''
+        Store and read contents.
+        '''
+        packs = PackStore(temp_dir / 'packs')
+        contents = [b'foo', b'bar', b'']
+        for content in contents:
+            packs.put(_hash(content), content, 'none')
+        assert len(packs) == 3
+        for content in contents:
+            entry = packs.get(_hash(content))
+            assert entry.mode == 'none'
+            assert packs.read(entry) == content
+        assert _hash(b'baz') not in packs
+        packs.close()
+
+    def test_put_existing_content(self, temp_dir):
+        '''
+        Storing an existing content does not append it again.
+        '''
+        packs = PackStore(temp_dir / 'packs')
+        packs.put(_hash(b'foo'), b'foo', 'none')
+        packs.put(_hash(b'foo'), b'foo', 'none')
+        assert (temp_dir / 'packs' / 'pack-000000.pack').read_bytes() == b'foo'
+
+    def test_rotation(self, temp_dir):
+        '''
+        A new pack is started once a pack is full.
+        '''
+        packs = PackStore(temp_dir / 'packs', max_pack_size=5)
+        for content in [b'foo', b'bar', b'baz']:
+            packs.put(_hash(content), content, 'zlib')
+        assert packs.get(_hash(b'foo')).pack == 0
+        assert packs.get(_hash(b'baz')).pack == 2
+        assert packs.read(packs.get(_hash(b'bar'))) == b'bar'
+
+    def test_concurrent_stores(self, temp_dir):
+        '''
+        Contents stored via another instance are found.
+        '''
+        packs1 = PackStore(temp_dir / 'packs', max_pack_size=5)
+        packs2 = PackStore(temp_dir / 'packs', max_pack_size=5)
+        packs1.put(_hash(b'foo'), b'foo', 'none')
+        packs2.put(_hash(b'bar'), b'bar', 'none')
+        packs1.put(_hash(b'baz'), b'baz', 'none')
+        for packs in [packs1, packs2]:
+            for content in [b'foo', b'bar', b'baz']:
+                assert packs.read(packs.get(_hash(content))) == content
+        assert PackStore(temp_dir / 'packs').get(_hash(b'baz')).pack == 2
+
+    def test_incomplete_index_record(self, temp_dir):
+        '''
+        An incomplete index record at the end of an index is ignored.
+        '''
+        packs = PackStore(temp_dir / 'packs')
+        packs.put(_hash(b'foo'), b'foo', 'none')
+        with (temp_dir / 'packs' / 'pack-000000.idx').open('ab') as f:
+            f.write(b'\x00' * 10)
+        packs = PackStore(temp_dir / 'packs')
+        assert len(packs) == 1
+        assert packs.read(packs.get(_hash(b'foo'))) == b'foo'
+
+    def test_torn_index_record(self, temp_dir):
+        '''
+        A torn index record does not corrupt later records.
+        '''
+        packs = PackStore(temp_dir / 'packs')
+        packs.put(_hash(b'foo'), b'foo', 'none')
+        with (temp_dir / 'packs' / 'pack-000000.idx').open('ab') as f:
+            f.write(b'\xff' * 10)
+        packs.put(_hash(b'bar'), b'bar', 'none')
+        packs = PackStore(temp_dir / 'packs')
+        packs.put(_hash(b'baz'), b'baz', 'none')
+        packs = PackStore(temp_dir / 'packs')
+        assert len(packs) == 3
+        for content in [b'foo', b'bar', b'baz']:
+            assert packs.read(packs.get(_hash(content))) == content
+
+    def test_unreferenced_data_in_new_pack(self, temp_dir):
+        '''
+        Data left in a new pack by a crash is skipped.
+        '''
+        packs = PackStore(temp_dir / 'packs', max_pack_size=5)
+        packs.put(_hash(b'foo'), b'foo', 'none')
+        (temp_dir / 'packs' / 'pack-000001.pack').write_bytes(b'xx')
+        packs.put(_hash(b'bar'), b'bar', 'none')
+        entry = packs.get(_hash(b'bar'))
+        assert (entry.pack, entry.offset) == (1, 2)
+        assert PackStore(temp_dir / 'packs').read(entry) == b'bar'
+
+    def test_put_is_durable(self, temp_dir):
+        '''
+        The data and the index record are synced before put returns.
+        '''
+        packs = PackStore(temp_dir / 'packs')
+        with mock.patch('coba.packs.os.fsync', wraps=os.fsync) as fsync:
+            packs.put(_hash(b'foo'), b'foo', 'none')
+            # Pack, index and the directory of the new files
+            assert fsync.call_count == 3
+            packs.put(_hash(b'bar'), b'bar', 'none')
+            assert fsync.call_count == 5
+
+    def test_compact(self, temp_dir):
+        '''
+        Compacting a pack keeps only its referenced contents.
+        '''
+        packs = PackStore(temp_dir / 'packs', max_pack_size=6)
+        for content in [b'foo', b'bar', b'baz', b'qux']:
+            packs.put(_hash(content), content, 'none')
+        other = PackStore(temp_dir / 'packs')
+        assert other.read(other.get(_hash(b'foo'))) == b'foo'
+        referenced = {_hash(b'foo'), _hash(b'baz')}
+        assert packs.get_packs() == [0, 1]
+        assert packs.compact(0, referenced.intersection) == 1
+        # The referenced content has been moved to a new pack
+        assert packs.compact(2, referenced.intersection) == 0
+        assert packs.compact(1, referenced.intersection) == 1
+        assert not (temp_dir / 'packs' / 'pack-000000.pack').exists()
+        assert not (temp_dir / 'packs' / 'pack-000001.pack').exists()
+        for store in [packs, other]:
+            assert store.get(_hash(b'bar')) is None
+            assert store.get(_hash(b'qux')) is None
+            for content in [b'foo', b'baz']:
+                assert store.read(store.get(_hash(content))) == content
+        assert PackStore(temp_dir / 'packs').get_packs() == [2]
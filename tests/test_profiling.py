@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import pstats
+import threading
+import time
+
+import pytest
+
+from coba.profiling import profile, SamplingProfiler
+
+
+def _busy(stopped):
+    while not stopped.is_set():
+        time.sleep(0.001)
+
+
+def _work():
+    return sum(range(1000))
+
+
+class TestSamplingProfiler:
+
+    def test_samples_all_threads(self, temp_dir):
+        '''
+        The stacks of all threads are sampled.
+        '''
+        stopped = threading.Event()
+        thread = threading.Thread(target=_busy, args=(stopped,),
+                                  name='busy-thread')
+        thread.start()
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        time.sleep(0.1)
+        profiler.stop()
+        stopped.set()
+        thread.join()
+        path = temp_dir / 'profile.txt'
+        profiler.write(path)
+        lines = path.read_text(encoding='utf-8').splitlines()
+        assert any(line.startswith('busy-thread;') and '_busy' in line
+                   for line in lines)
+        for line in lines:
+            stack, _, count = line.rpartition(' ')
+            assert int(count) > 0
+
+
+class TestProfile:
+
+    def test_cprofile(self, temp_dir):
+        '''
+        Profile using ``cProfile``.
+        '''
+        path = temp_dir / 'profile.pstats'
+        with profile(path, 'cprofile'):
+            _work()
+        stats = pstats.Stats(str(path))
+        assert any(function == '_work' for _, _, function in stats.stats)
+
+    def test_invalid_profiler(self, temp_dir):
+        '''
+        Use an invalid profiler.
+        '''
+        with pytest.raises(ValueError):
+            with profile(temp_dir / 'profile', 'foobar'):
+                pass
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import datetime
+
+import pytest
+
+from coba.retention import RetentionPolicy
+
+
+class TestRetentionPolicy:
+
+    def test_from_dict(self):
+        '''
+        Create a policy from a configuration dict.
+        '''
+        policy = RetentionPolicy.from_dict({
+            'keep_last': 10,
+            'max_age': '30 d',
+            'thinning': [
+                {'after': '1 w', 'every': '1 d'},
+                {'after': '1 d', 'every': '1 h'},
+            ],
+        })
+        assert policy.keep_last == 10
+        assert policy.max_age == datetime.timedelta(days=30)
+        assert policy.thinning == [
+            (datetime.timedelta(days=1), datetime.timedelta(hours=1)),
+            (datetime.timedelta(weeks=1), datetime.timedelta(days=1)),
+        ]
+        assert RetentionPolicy.from_dict({}) == RetentionPolicy()
+
+    def test_invalid(self):
+        '''
+        Invalid policies.
+        '''
+        with pytest.raises(ValueError):
+            RetentionPolicy(keep_last=0)
+        with pytest.raises(ValueError):
+            RetentionPolicy(max_age=datetime.timedelta())
+        with pytest.raises(ValueError):
+            RetentionPolicy(thinning=[(datetime.timedelta(hours=1),
+                                       datetime.timedelta())])
+        with pytest.raises(ValueError):
+            RetentionPolicy.from_dict({'max_age': 'forever'})
@@ -21,14 +21,21 @@
 # THE SOFTWARE.
 
 import datetime
+import hashlib
+import os
 from pathlib import Path
+import sqlite3
 import time
+from types import SimpleNamespace
 from unittest import mock
 
 import pytest
 from sealedmock import seal
 
-from coba.store import Store, Version
+from coba.cas import ContentStore
+from coba.config import Config, DEFAULT_CONFIG
+from coba.retention import RetentionPolicy
+from coba.store import PathStatistics, Statistics, Store, Version
 
 from .conftest import working_dir
 
@@ -79,6 +86,33 @@ class TestStore:
             versions = store.get_versions(test_file)
             assert list(versions) == [version]
 
+    def test_database_uses_wal_mode(self, store):
+        '''
+        The database is used in WAL mode.
+        '''
+        with store._engine.connect() as connection:
+            mode = connection.exec_driver_sql('PRAGMA journal_mode').scalar()
+        assert mode == 'wal'
+
+    def test_reading_does_not_block_writing(self, temp_dir):
+        '''
+        A store can be written while another store reads from it.
+        '''
+        test_file = temp_dir / 'test.txt'
+        test_file.touch()
+        store_path = temp_dir / 'store'
+        with Store(store_path) as writer, Store(store_path) as reader:
+            for i in range(3):
+                writer.put(test_file)
+            # Keep a read transaction open
+            versions = reader.get_versions(test_file)
+            next(versions)
+            start = time.time()
+            writer.put(test_file)
+            assert time.time() - start < 1
+            assert len(list(versions)) == 2
+            assert len(list(reader.get_versions(test_file))) == 4
+
     def test_put_existing_file(self, temp_dir):
         '''
         Put an existing file into the store.
@@ -124,6 +158,92 @@ class TestStore:
             with pytest.raises(IsADirectoryError):
                 store.put(subdir_path)
 
+    def test_put_many(self, temp_dir, store):
+        '''
+        Put multiple files into the store at once.
+        '''
+        paths = []
+        for i in range(5):
+            path = temp_dir / 'test{}.txt'.format(i)
+            path.write_text(str(i))
+            paths.append(path)
+        missing = temp_dir / 'missing'
+        assert store.put_many(paths + [missing]) == paths
+        for i, path in enumerate(paths):
+            versions = list(store.get_versions(path))
+            assert len(versions) == 1
+            path.unlink()
+            versions[0].restore()
+            assert path.read_text() == str(i)
+        assert list(store.get_versions(missing)) == []
+
+    def test_put_many_relative_paths(self, temp_dir, store):
+        '''
+        Put multiple files into the store using relative paths.
+        '''
+        (temp_dir / 'test.txt').touch()
+        with working_dir(temp_dir):
+            assert store.put_many([Path('test.txt')]) == [temp_dir / 'test.txt']
+
+    @mock.patch('coba.store._RACY_FINGERPRINT_NS', 0)
+    def test_put_unchanged_file(self, temp_dir, store):
+        '''
+        Put a file that has not changed since its last version.
+        '''
+        test_file = temp_dir / 'test.txt'
+        test_file.write_text('foo')
+        version = store.put(test_file)
+        with mock.patch.object(store._cas, 'put') as put, \
+                mock.patch('coba.store.hash_file') as hash_file:
+            assert store.put(test_file) == version
+            assert store.put_many([test_file]) == []
+            assert not put.called
+            assert not hash_file.called
+        assert list(store.get_versions(test_file)) == [version]
+
+    @mock.patch('coba.store._RACY_FINGERPRINT_NS', 0)
+    def test_put_file_with_unchanged_content(self, temp_dir, store):
+        '''
+        Put a file that has been rewritten with identical content.
+        '''
+        test_file = temp_dir / 'test.txt'
+        test_file.write_text('foo')
+        version1 = store.put(test_file)
+        time.sleep(0.01)
+        test_file.write_text('foo')
+        with mock.patch.object(store._cas, 'put') as put:
+            version2 = store.put(test_file)
+            assert not put.called
+        assert version2.hash == version1.hash
+        assert list(store.get_versions(test_file)) == [version1, version2]
+
+    @mock.patch('coba.store._RACY_FINGERPRINT_NS', 0)
+    def test_put_file_with_changed_content_and_same_size(self, temp_dir,
+                                                         store):
+        '''
+        Put a file whose content changed but whose size did not.
+        '''
+        test_file = temp_dir / 'test.txt'
+        test_file.write_text('foo')
+        version1 = store.put(test_file)
+        time.sleep(0.01)
+        test_file.write_text('bar')
+        version2 = store.put(test_file)
+        assert version2.hash != version1.hash
+        test_file.unlink()
+        version2.restore()
+        assert test_file.read_text() == 'bar'
+
+    def test_put_recently_modified_file(self, temp_dir, store):
+        '''
+        Fingerprints of recently modified files are not trusted.
+        '''
+        test_file = temp_dir / 'test.txt'
+        test_file.write_text('foo')
+        store.put(test_file)
+        store.put(test_file)
+        assert len(list(store.get_versions(test_file))) == 2
+
     def test_get_versions(self, temp_dir):
         '''
         Get the versions of a file.
@@ -145,6 +265,30 @@ class TestStore:
         for i in range(4):
             assert versions[i].stored_at < versions[i + 1].stored_at
 
+    def test_get_versions_filters(self, temp_dir, store):
+        '''
+        Get a range of the versions of a file.
+        '''
+        test_file = temp_dir / 'test.txt'
+        versions = []
+        for i in range(5):
+            test_file.write_text(str(i))
+            versions.append(store.put(test_file))
+        times = [version.stored_at for version in versions]
+        assert list(store.get_versions(test_file, since=times[1])) \
+            == versions[1:]
+        assert list(store.get_versions(test_file, until=times[3])) \
+            == versions[:4]
+        assert list(store.get_versions(test_file, since=times[1],
+                                       until=times[3])) == versions[1:4]
+        assert list(store.get_versions(test_file, limit=2)) == versions[:2]
+        assert list(store.get_versions(test_file, reverse=True)) \
+            == versions[::-1]
+        assert list(store.get_versions(test_file, since=times[2], limit=2,
+                                       reverse=True)) == versions[:1:-1][:2]
+        later = times[-1] + datetime.timedelta(minutes=1)
+        assert list(store.get_versions(test_file, since=later)) == []
+
     def test_get_versions_of_relative_path(self, temp_dir):
         '''
         Get the versions of a file using a relative path.
@@ -180,35 +324,592 @@ class TestStore:
         assert store.get_version_at(test_file, at2) == version1
         assert store.get_version_at(test_file, at3) == version2
 
+    def _make_tree(self, root, files):
+        for name, content in files.items():
+            path = root / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(content)
+
+    def test_get_versions_at(self, temp_dir, store):
+        '''
+        Get the versions of all files in a directory tree.
+        '''
+        root = temp_dir / 'root'
+        self._make_tree(root, {'a': 'a1', 'sub/b': 'b1', 'sub/sub/c': 'c1'})
+        (temp_dir / 'root_other').write_text('other')
+        (temp_dir / 'root%').write_text('other')
+        store.put_many([root / 'a', root / 'sub/b',
+                        temp_dir / 'root_other', temp_dir / 'root%'])
+        time.sleep(1.1)
+        middle = datetime.datetime.utcnow()
+        time.sleep(0.1)
+        self._make_tree(root, {'a': 'a2', 'sub/sub/c': 'c1'})
+        store.put_many([root / 'a', root / 'sub/sub/c'])
+        at = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+
+        versions = store.get_versions_at(root, middle)
+        assert [v.path for v in versions] == [root / 'a', root / 'sub/b']
+        versions = store.get_versions_at(root, at)
+        assert [v.path for v in versions] == [root / 'a', root / 'sub/b',
+                                              root / 'sub/sub/c']
+        assert versions[0] == store.get_version_at(root / 'a', at)
+        assert store.get_versions_at(root / 'sub', at) == versions[1:]
+        assert store.get_versions_at(temp_dir / 'missing', at) == []
+
+    def test_restore_tree(self, temp_dir, store):
+        '''
+        Restore a directory tree at its original location.
+        '''
+        root = temp_dir / 'root'
+        files = {'a': 'same', 'b': 'same', 'sub/c': 'c', 'sub/sub/d': 'same'}
+        self._make_tree(root, files)
+        store.put_many(root / name for name in files)
+        at = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+        for name in files:
+            (root / name).unlink()
+        with mock.patch.object(store._cas, 'copy_to',
+                               wraps=store._cas.copy_to) as copy_to:
+            restored = store.restore_tree(root, at)
+        # Each distinct content is read from the CAS only once
+        assert copy_to.call_count == 2
+        assert restored == sorted(root / name for name in files)
+        for name, content in files.items():
+            assert (root / name).read_text() == content
+
+    def test_restore_tree_to_target(self, temp_dir, store):
+        '''
+        Restore a directory tree to a different directory.
+        '''
+        root = temp_dir / 'root'
+        files = {'a': 'a', 'sub/b': 'b'}
+        self._make_tree(root, files)
+        store.put_many(root / name for name in files)
+        at = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+        target = temp_dir / 'target'
+        restored = store.restore_tree(root, at, target=target)
+        assert restored == [target / 'a', target / 'sub/b']
+        for name, content in files.items():
+            assert (target / name).read_text() == content
+
+    def test_restore_tree_case_sensitive(self, temp_dir, store):
+        '''
+        Directories whose names differ only in case are kept apart.
+        '''
+        root = temp_dir / 'root'
+        files = {'src/Foo/a.txt': 'a', 'src/foo/b.txt': 'b'}
+        self._make_tree(root, files)
+        store.put_many(root / name for name in files)
+        at = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+        versions = store.get_versions_at(root / 'src/Foo', at)
+        assert [v.path for v in versions] == [root / 'src/Foo/a.txt']
+        target = temp_dir / 'target'
+        restored = store.restore_tree(root / 'src/Foo', at, target=target)
+        assert restored == [target / 'a.txt']
+
+    def test_restore_tree_existing_files(self, temp_dir, store):
+        '''
+        Restore a directory tree over existing files.
+        '''
+        root = temp_dir / 'root'
+        self._make_tree(root, {'a': 'a', 'b': 'b'})
+        store.put_many([root / 'a', root / 'b'])
+        at = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+        (root / 'a').unlink()
+        (root / 'b').write_text('modified')
+        with pytest.raises(FileExistsError):
+            store.restore_tree(root, at)
+        # Nothing has been restored
+        assert not (root / 'a').exists()
+        store.restore_tree(root, at, force=True)
+        assert (root / 'a').read_text() == 'a'
+        assert (root / 'b').read_text() == 'b'
+
+    @pytest.mark.parametrize('compression', ['zlib', 'lzma'])
+    def test_compression(self, temp_dir, compression):
+        '''
+        Put and restore files in a store with compression.
+        '''
+        test_file = temp_dir / 'test.txt'
+        test_file.write_text('foobar' * 10000)
+        with Store(temp_dir / 'store', compression=compression) as store:
+            version = store.put(test_file)
+            test_file.unlink()
+            version.restore()
+        assert test_file.read_text() == 'foobar' * 10000
+
+    def test_invalid_compression(self, temp_dir):
+        '''
+        Create a store with an invalid compression mode.
+        '''
+        with pytest.raises(ValueError):
+            Store(temp_dir / 'store', compression='foobar')
+
+    def test_snapshot(self, temp_dir, store):
+        '''
+        Store all files in a directory tree.
+        '''
+        root = temp_dir / 'root'
+        (root / 'sub').mkdir(parents=True)
+        (root / 'build').mkdir()
+        (root / 'a.txt').write_text('a')
+        (root / 'sub' / 'b.txt').write_text('b')
+        (root / 'sub' / 'c.log').write_text('c')
+        (root / 'build' / 'd.txt').write_text('d')
+        (root / 'large.txt').write_text('x' * 100)
+        cfg = Config('x', 10, ['*.log', 'build/'])
+        assert store.snapshot(root, cfg, workers=2, batch_size=1) == 2
+        at = datetime.datetime.utcnow()
+        assert [v.path for v in store.get_versions_at(root, at)] == [
+            root / 'a.txt', root / 'sub' / 'b.txt']
+        target = temp_dir / 'target'
+        store.restore_tree(root, at, target=target)
+        assert (target / 'a.txt').read_text() == 'a'
+        assert (target / 'sub' / 'b.txt').read_text() == 'b'
+
+    @mock.patch('coba.store._RACY_FINGERPRINT_NS', 0)
+    def test_snapshot_unchanged_files(self, temp_dir, store):
+        '''
+        Files that have not changed are skipped in a snapshot.
+        '''
+        root = temp_dir / 'root'
+        root.mkdir()
+        (root / 'a.txt').write_text('a')
+        (root / 'b.txt').write_text('b')
+        store.put(root / 'a.txt')
+        assert store.snapshot(root) == 1
+        assert store.snapshot(root) == 0
+        (root / 'b.txt').write_text('bb')
+        assert store.snapshot(root) == 1
+        assert len(list(store.get_versions(root / 'b.txt'))) == 2
+
+
+class TestPrune:
+
+    def _put_at(self, store, path, content, stored_at):
+        '''
+        Store a new version of a file with a given storage time.
+        '''
+        path.write_bytes(content)
+        row = store._store_content(path, None)
+        with store._write_scope() as connection:
+            store._record_versions(connection, [row], stored_at)
+
+    def _refcounts(self, store):
+        with store._engine.connect() as connection:
+            return {hash.hex(): refcount for hash, refcount in
+                    connection.exec_driver_sql(
+                        'SELECT hash, refcount FROM blobs')}
+
+    def test_keep_last(self, temp_dir, store):
+        '''
+        The number of versions of each file can be limited.
+        '''
+        a, b = temp_dir / 'a.txt', temp_dir / 'b.txt'
+        now = datetime.datetime.utcnow()
+        for i in range(5):
+            stored_at = now - datetime.timedelta(minutes=5 - i)
+            self._put_at(store, a, b'a%d' % i, stored_at)
+            self._put_at(store, b, b'b%d' % i, stored_at)
+        assert store.prune(RetentionPolicy(keep_last=2)) == 6
+        for path in [a, b]:
+            versions = sorted(store.get_versions(path),
+                              key=lambda v: v.stored_at)
+            assert [v.stored_at for v in versions] == [
+                now - datetime.timedelta(minutes=2),
+                now - datetime.timedelta(minutes=1)]
+
+    def test_max_age(self, temp_dir, store):
+        '''
+        Old versions expire, except for the latest one.
+        '''
+        a, b = temp_dir / 'a.txt', temp_dir / 'b.txt'
+        now = datetime.datetime.utcnow()
+        for days in [10, 5, 1]:
+            self._put_at(store, a, b'a%d' % days,
+                         now - datetime.timedelta(days=days))
+        self._put_at(store, b, b'b', now - datetime.timedelta(days=10))
+        policy = RetentionPolicy(max_age=datetime.timedelta(days=3))
+        assert store.prune(policy, now=now) == 2
+        assert [v.stored_at for v in store.get_versions(a)] == [
+            now - datetime.timedelta(days=1)]
+        assert len(list(store.get_versions(b))) == 1
+
+    def test_thinning(self, temp_dir, store):
+        '''
+        Old versions are thinned out.
+        '''
+        path = temp_dir / 'a.txt'
+        now = datetime.datetime(2018, 5, 1, 12, 0, 0)
+        minutes = [5, 10, 65, 70, 125, 24 * 60 + 5, 24 * 60 + 65,
+                   48 * 60 + 5]
+        for i, m in enumerate(minutes):
+            self._put_at(store, path, b'%d' % i,
+                         now - datetime.timedelta(minutes=m))
+        policy = RetentionPolicy(thinning=[
+            (datetime.timedelta(hours=1), datetime.timedelta(hours=1)),
+            (datetime.timedelta(days=1), datetime.timedelta(days=1)),
+        ])
+        assert store.prune(policy, now=now) == 2
+        remaining = sorted((now - v.stored_at for v in
+                            store.get_versions(path)), reverse=True)
+        assert remaining == [datetime.timedelta(minutes=m) for m in
+                             [48 * 60 + 5, 24 * 60 + 5, 125, 65, 10, 5]]
+
+    def test_no_rules(self, temp_dir, store):
+        '''
+        A policy without rules keeps all versions.
+        '''
+        path = temp_dir / 'a.txt'
+        for i in range(3):
+            self._put_at(store, path, b'%d' % i,
+                         datetime.datetime(2000, 1, i + 1))
+        assert store.prune(RetentionPolicy()) == 0
+        assert len(list(store.get_versions(path))) == 3
+
+    def test_collect_garbage(self, temp_dir, store):
+        '''
+        Contents are removed once they are no longer referenced.
+        '''
+        a, b = temp_dir / 'a.txt', temp_dir / 'b.txt'
+        now = datetime.datetime.utcnow()
+        self._put_at(store, a, b'shared', now - datetime.timedelta(hours=2))
+        self._put_at(store, b, b'shared', now - datetime.timedelta(hours=2))
+        self._put_at(store, a, b'old', now - datetime.timedelta(hours=1))
+        self._put_at(store, a, b'new', now)
+        shared, old, new = [hashlib.sha1(c).hexdigest()
+                            for c in [b'shared', b'old', b'new']]
+        assert self._refcounts(store) == {shared: 2, old: 1, new: 1}
+        assert store.prune(RetentionPolicy(keep_last=1)) == 2
+        assert self._refcounts(store) == {shared: 1, old: 0, new: 1}
+        # Recently released contents are kept for a while
+        assert store.collect_garbage() == 0
+        assert store.collect_garbage(datetime.timedelta()) == 1
+        assert self._refcounts(store) == {shared: 1, new: 1}
+        assert not store._cas.exists(old)
+        assert store._cas.exists(shared)
+
+    def test_reference_released_content(self, temp_dir, store):
+        '''
+        Released contents that are referenced again are not removed.
+        '''
+        path = temp_dir / 'a.txt'
+        now = datetime.datetime.utcnow()
+        self._put_at(store, path, b'a', now - datetime.timedelta(hours=1))
+        self._put_at(store, path, b'b', now)
+        store.prune(RetentionPolicy(keep_last=1))
+        self._put_at(store, temp_dir / 'b.txt', b'a', now)
+        assert store.collect_garbage(datetime.timedelta()) == 0
+        assert store._cas.exists(hashlib.sha1(b'a').hexdigest())
+
+    def test_collect_garbage_chunks(self, temp_dir):
+        '''
+        The chunks of removed chunked contents are removed, too.
+        '''
+        path = temp_dir / 'a.bin'
+        now = datetime.datetime.utcnow()
+        with Store(temp_dir / 'store', chunking=True) as store:
+            common = os.urandom(2 * 1024**2)
+            self._put_at(store, path, common + os.urandom(1024**2),
+                         now - datetime.timedelta(hours=1))
+            self._put_at(store, path, common + os.urandom(1024**2), now)
+            num_blobs = len(self._refcounts(store))
+            store.prune(RetentionPolicy(keep_last=1))
+            num_removed = store.collect_garbage(datetime.timedelta())
+            assert 1 < num_removed < num_blobs / 2
+            assert all(self._refcounts(store).values())
+            target = temp_dir / 'target.bin'
+            list(store.get_versions(path))[0].restore(target)
+            assert target.read_bytes() == path.read_bytes()
+
+    def test_collect_garbage_packed_contents(self, temp_dir):
+        '''
+        Contents in pack files are removed by compacting their pack.
+        '''
+        path = temp_dir / 'a.txt'
+        now = datetime.datetime.utcnow()
+        with Store(temp_dir / 'store', pack_threshold=1024) as store:
+            self._put_at(store, path, b'old', now - datetime.timedelta(hours=1))
+            self._put_at(store, path, b'new', now)
+            store.prune(RetentionPolicy(keep_last=1))
+            # The pack has just been modified
+            assert store.collect_garbage() == 0
+            assert store.collect_garbage(datetime.timedelta()) == 1
+            old, new = [hashlib.sha1(c).hexdigest()
+                        for c in [b'old', b'new']]
+            assert self._refcounts(store) == {new: 1}
+            assert not store._cas.exists(old)
+            assert store.get_statistics().stored_size == 3
+            target = temp_dir / 'target.txt'
+            list(store.get_versions(path))[0].restore(target)
+            assert target.read_bytes() == b'new'
+
+    def test_collect_garbage_default_pack_threshold(self, temp_dir):
+        '''
+        Pruned chunked contents free their space with the default pack
+        threshold.
+        '''
+        path = temp_dir / 'a.bin'
+        now = datetime.datetime.utcnow()
+        with Store(temp_dir / 'store', chunking=True,
+                   pack_threshold=DEFAULT_CONFIG.pack_threshold) as store:
+            for i in range(3):
+                self._put_at(store, path, os.urandom(2 * 1024**2),
+                             now - datetime.timedelta(hours=3 - i))
+            disk_usage = self._disk_usage(temp_dir / 'store' / 'content')
+            store.prune(RetentionPolicy(keep_last=1))
+            assert store.collect_garbage(datetime.timedelta()) > 2
+            assert all(self._refcounts(store).values())
+            assert (self._disk_usage(temp_dir / 'store' / 'content')
+                    < disk_usage / 2)
+            target = temp_dir / 'target.bin'
+            list(store.get_versions(path))[0].restore(target)
+            assert target.read_bytes() == path.read_bytes()
+
+    def _disk_usage(self, path):
+        return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+
+    def _create_old_store(self, path, schema, versions):
+        '''
+        Create a store with an old database schema.
+
+        ``schema`` is a list of SQL statements that create the tables.
+        ``versions`` is a list of ``(path, content, stored_at)`` tuples,
+        whose contents are put into the store's content store and which
+        are inserted into the versions table.
+
+        Returns the database connection.
+        '''
+        cas = ContentStore(path / 'content', 'zlib')
+        connection = sqlite3.connect(str(path / 'coba.sqlite'),
+                                     isolation_level=None)
+        for sql in schema:
+            connection.execute(sql)
+        for file_path, content, stored_at in versions:
+            file_path.write_bytes(content)
+            hash = cas.put(file_path)
+            connection.execute(
+                'INSERT INTO versions (path, hash, stored_at) '
+                + 'VALUES (?, ?, ?)',
+                (str(file_path), hash,
+                 stored_at.strftime('%Y-%m-%d %H:%M:%S.%f')))
+        cas.close()
+        return connection
+
+    def test_migrate_version_0(self, temp_dir):
+        '''
+        Reference counts, sizes and statistics are filled in for stores
+        created without them.
+        '''
+        a, b = temp_dir / 'a.txt', temp_dir / 'b.txt'
+        times = [datetime.datetime(2018, 1, 1, 12, 0, i, 123456)
+                 for i in range(3)]
+        (temp_dir / 'store').mkdir()
+        connection = self._create_old_store(temp_dir / 'store', [
+            'CREATE TABLE versions (id INTEGER NOT NULL, '
+            + 'path VARCHAR NOT NULL, hash VARCHAR(40) NOT NULL, '
+            + 'stored_at DATETIME NOT NULL, PRIMARY KEY (id))',
+        ], [(a, b'a' * 100, times[0]), (b, b'bb', times[1]),
+            (a, b'a' * 100, times[2])])
+        connection.close()
+        with Store(temp_dir / 'store') as store:
+            assert self._refcounts(store) == {
+                hashlib.sha1(b'a' * 100).hexdigest(): 2,
+                hashlib.sha1(b'bb').hexdigest(): 1,
+            }
+            statistics = store.get_statistics()
+            assert statistics[:3] == (3, 202, 2)
+            assert statistics.top_paths == [PathStatistics(a, 2, 200),
+                                            PathStatistics(b, 1, 2)]
+            versions = list(store.get_versions(a))
+            assert [v.stored_at for v in versions] == [times[0], times[2]]
+            assert [v.size for v in versions] == [100, 100]
+            assert versions[0].hash == hashlib.sha1(b'a' * 100).hexdigest()
+            assert store.get_version_at(b, times[2]).size == 2
+
+    def test_migrate_version_1(self, temp_dir):
+        '''
+        Stores with schema version 1 are migrated to the compact schema.
+        '''
+        a, b = temp_dir / 'a.txt', temp_dir / 'b.txt'
+        times = [datetime.datetime(2018, 1, 1, 12, 0, i) for i in range(3)]
+        (temp_dir / 'store').mkdir()
+        connection = self._create_old_store(temp_dir / 'store', [
+            'CREATE TABLE versions (id INTEGER NOT NULL, '
+            + 'path VARCHAR NOT NULL, hash VARCHAR(40) NOT NULL, '
+            + 'stored_at DATETIME NOT NULL, size INTEGER NOT NULL DEFAULT 0, '
+            + 'PRIMARY KEY (id))',
+            'CREATE INDEX ix_versions_path_stored_at '
+            + 'ON versions (path, stored_at)',
+            'CREATE TABLE fingerprints (path VARCHAR NOT NULL, '
+            + 'device INTEGER NOT NULL, inode INTEGER NOT NULL, '
+            + 'size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+            + 'ctime_ns INTEGER NOT NULL, hash VARCHAR(40) NOT NULL, '
+            + 'taken_ns INTEGER NOT NULL, PRIMARY KEY (path))',
+            'CREATE TABLE blobs (hash VARCHAR(40) NOT NULL, '
+            + 'refcount INTEGER NOT NULL, released_at DATETIME, '
+            + 'size INTEGER NOT NULL, stored_size INTEGER NOT NULL, '
+            + 'PRIMARY KEY (hash))',
+            'CREATE INDEX ix_blobs_released_at ON blobs (released_at)',
+            'CREATE TABLE statistics (id INTEGER NOT NULL, '
+            + 'versions INTEGER NOT NULL, size INTEGER NOT NULL, '
+            + 'contents INTEGER NOT NULL, stored_size INTEGER NOT NULL, '
+            + 'PRIMARY KEY (id))',
+            'CREATE TABLE path_statistics (path VARCHAR NOT NULL, '
+            + 'versions INTEGER NOT NULL, size INTEGER NOT NULL, '
+            + 'PRIMARY KEY (path))',
+            'CREATE INDEX ix_path_statistics_size '
+            + 'ON path_statistics (size)',
+        ], [(a, b'a0', times[0]), (b, b'b0', times[1]), (a, b'a1', times[2])])
+        stat = os.stat(str(a))
+        connection.execute(
+            'INSERT INTO fingerprints VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (str(a), stat.st_dev, stat.st_ino, stat.st_size,
+             stat.st_mtime_ns, stat.st_ctime_ns,
+             hashlib.sha1(b'a1').hexdigest(),
+             int(time.time() * 10**9) + 10**10))
+        connection.execute('UPDATE versions SET size = 2')
+        connection.execute(
+            'INSERT INTO blobs SELECT hash, 1, NULL, 2, 10 FROM versions')
+        connection.execute(
+            'INSERT INTO blobs VALUES (?, 0, ?, 5, 10)',
+            (hashlib.sha1(b'old').hexdigest(), '2018-01-01 00:00:00.000000'))
+        connection.execute('INSERT INTO statistics VALUES (1, 3, 6, 4, 40)')
+        connection.execute('PRAGMA user_version=1')
+        connection.close()
+        with Store(temp_dir / 'store') as store:
+            assert store.get_statistics() == Statistics(3, 6, 4, 40, [
+                PathStatistics(a, 2, 4),
+                PathStatistics(b, 1, 2),
+            ])
+            assert [(v.stored_at, v.hash) for v in store.get_versions(a)] == [
+                (times[0], hashlib.sha1(b'a0').hexdigest()),
+                (times[2], hashlib.sha1(b'a1').hexdigest()),
+            ]
+            assert self._refcounts(store)[hashlib.sha1(b'old').hexdigest()] == 0
+            # The fingerprint has been migrated, too
+            assert store.put(a).stored_at == times[2]
+            with store._engine.connect() as connection:
+                assert connection.exec_driver_sql(
+                    'PRAGMA user_version').scalar() == 2
+                assert connection.exec_driver_sql(
+                    'SELECT DISTINCT typeof(hash), typeof(stored_at) '
+                    + 'FROM versions').fetchall() == [('blob', 'integer')]
+                tables = {name for name, in connection.exec_driver_sql(
+                          "SELECT name FROM sqlite_master WHERE type='table'")}
+                assert tables == {'paths', 'versions', 'fingerprints',
+                                  'blobs', 'statistics', 'path_statistics'}
+            store.collect_garbage(grace_period=datetime.timedelta(0))
+            assert hashlib.sha1(b'old').hexdigest() not in self._refcounts(
+                store)
+            assert store.get_statistics().contents == 3
+
+    def test_newer_schema(self, temp_dir):
+        '''
+        Stores created by a newer version cannot be opened.
+        '''
+        with Store(temp_dir / 'store') as store:
+            with store._write_scope() as connection:
+                connection.exec_driver_sql('PRAGMA user_version=1000')
+        with pytest.raises(ValueError):
+            with Store(temp_dir / 'store'):
+                pass
+
+
+class TestStatistics:
+
+    def test_statistics(self, temp_dir, store):
+        '''
+        Statistics are updated when versions are stored and removed.
+        '''
+        a, b = temp_dir / 'a.txt', temp_dir / 'b.txt'
+        assert store.get_statistics() == Statistics(0, 0, 0, 0, [])
+        a.write_text('a' * 10)
+        b.write_text('b' * 20)
+        store.put_many([a, b])
+        a.write_text('b' * 20)
+        store.put(a)
+        assert store.get_statistics() == Statistics(3, 50, 2, 30, [
+            PathStatistics(a, 2, 30),
+            PathStatistics(b, 1, 20),
+        ])
+        assert store.get_statistics(top=1).top_paths == [
+            PathStatistics(a, 2, 30)]
+        store.prune(RetentionPolicy(keep_last=1))
+        assert store.get_statistics() == Statistics(2, 40, 2, 30, [
+            PathStatistics(a, 1, 20),
+            PathStatistics(b, 1, 20),
+        ])
+        store.collect_garbage(datetime.timedelta())
+        assert store.get_statistics() == Statistics(2, 40, 1, 20, [
+            PathStatistics(a, 1, 20),
+            PathStatistics(b, 1, 20),
+        ])
+
+    def test_snapshot(self, temp_dir, store):
+        '''
+        Versions stored by a snapshot are counted.
+        '''
+        root = temp_dir / 'root'
+        root.mkdir()
+        (root / 'a.txt').write_text('a' * 10)
+        (root / 'b.txt').write_text('a' * 10)
+        store.snapshot(root, workers=1)
+        statistics = store.get_statistics()
+        assert statistics[:4] == (2, 20, 1, 10)
+
+    def test_chunks(self, temp_dir):
+        '''
+        The chunks of chunked contents are counted as contents.
+        '''
+        path = temp_dir / 'a.bin'
+        path.write_bytes(os.urandom(3 * 1024**2))
+        with Store(temp_dir / 'store', chunking=True) as store:
+            store.put(path)
+            statistics = store.get_statistics()
+            num_files = len([p for p in store._cas.path.rglob('*')
+                             if p.is_file()])
+            assert statistics.contents == num_files
+            assert statistics.size == 3 * 1024**2
+            assert 3 * 1024**2 < statistics.stored_size < 3.1 * 1024**2
+
 
 class TestVersion:
     def test_eq(self):
         '''
         Equality of versions.
         '''
-        _version1 = mock.Mock()
+        stored_at = datetime.datetime(2018, 1, 1)
+        _version1 = SimpleNamespace(id=1, path=Path('/a'), hash='x',
+                                    stored_at=stored_at, size=3)
         version1 = Version(_version1, None)
         assert version1 == version1
         assert None != version1
         assert version1 != _version1
         assert _version1 != version1
-        assert version1 != _version1
         assert 1 != version1
         assert version1 != 1
 
-        _version2 = mock.Mock()
+        _version2 = SimpleNamespace(**vars(_version1))
         version2 = Version(_version2, None)
         assert version1 == version2
+        assert hash(version1) == hash(version2)
 
-        _version1.x = 'hello'
-        _version2.x = 'hello'
-        assert version1 == version2
+        for attr, value in [('id', 2), ('path', Path('/b')), ('hash', 'y'),
+                            ('stored_at', datetime.datetime(2018, 1, 2)),
+                            ('size', 4)]:
+            _version3 = SimpleNamespace(**vars(_version1))
+            setattr(_version3, attr, value)
+            assert version1 != Version(_version3, None)
 
-        _version1.y = 'foo'
-        assert version1 != version2
-        assert version2 != version1
-        _version2.y = 'foo'
-        assert version1 == version2
+    def test_slots(self, store, temp_dir):
+        '''
+        Versions are lightweight records.
+        '''
+        test_file = temp_dir / 'test.txt'
+        test_file.write_text('foo')
+        version = store.put(test_file)
+        assert not hasattr(version, '__dict__')
+        assert version.size == 3
 
     def test_restore_default_arguments_existing_file(self, store, temp_dir):
         '''
@@ -323,4 +1024,3 @@ class TestVersion:
         result = version.restore(sub_dir, force=True)
         assert result == target_path
         assert target_path.read_text() == 'foo'
-
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import pickle
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from coba.throttle import Throttle, TokenBucket
+
+
+class TestTokenBucket:
+
+    def test_rate(self):
+        '''
+        Consuming more tokens than available waits for them.
+        '''
+        bucket = TokenBucket(100)
+        start = time.monotonic()
+        bucket.consume(100)
+        assert time.monotonic() - start < 0.1
+        bucket.consume(20)
+        bucket.consume(20)
+        assert time.monotonic() - start >= 0.35
+
+    def test_threads(self):
+        '''
+        The rate applies to all threads together.
+        '''
+        bucket = TokenBucket(100)
+        bucket.consume(100)
+        start = time.monotonic()
+        threads = [threading.Thread(target=bucket.consume, args=(20,))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert time.monotonic() - start >= 0.55
+
+    def test_invalid_rate(self):
+        '''
+        The rate must be positive.
+        '''
+        with pytest.raises(ValueError):
+            TokenBucket(0)
+
+
+class TestThrottle:
+
+    def test_unlimited(self):
+        '''
+        A default throttle does not wait.
+        '''
+        throttle = Throttle()
+        start = time.monotonic()
+        for _ in range(1000):
+            throttle.start_file()
+            throttle.process_bytes(1024**3)
+        assert time.monotonic() - start < 1
+
+    def test_bytes_per_second(self):
+        '''
+        The number of bytes per second can be limited.
+        '''
+        throttle = Throttle(bytes_per_second=1000)
+        start = time.monotonic()
+        throttle.process_bytes(1200)
+        assert time.monotonic() - start >= 0.15
+
+    def test_files_per_second(self):
+        '''
+        The number of files per second can be limited.
+        '''
+        throttle = Throttle(files_per_second=10)
+        start = time.monotonic()
+        for _ in range(12):
+            throttle.start_file()
+        assert time.monotonic() - start >= 0.15
+
+    def test_max_load(self):
+        '''
+        Work pauses while the load is too high.
+        '''
+        throttle = Throttle(max_load=2)
+        loads = iter([(3, 3, 3), (2.5, 3, 3), (1, 3, 3)])
+        with mock.patch('os.getloadavg', side_effect=lambda: next(loads)), \
+                mock.patch('coba.throttle.time.sleep') as sleep:
+            throttle.start_file()
+        assert sleep.call_count == 2
+
+    def test_priorities(self):
+        '''
+        Priorities are lowered once for each thread.
+        '''
+        throttle = Throttle(nice=5, io_class='idle')
+        with mock.patch('os.nice') as nice, \
+                mock.patch('coba.throttle.set_io_priority') as set_io:
+            throttle.start_file()
+            throttle.start_file()
+            thread = threading.Thread(target=throttle.start_file)
+            thread.start()
+            thread.join()
+        assert nice.call_args_list == [mock.call(5)] * 2
+        assert set_io.call_args_list == [mock.call('idle')] * 2
+
+    def test_invalid_io_class(self):
+        '''
+        The I/O class must be valid.
+        '''
+        with pytest.raises(ValueError):
+            Throttle(io_class='foobar')
+
+    def test_pickle(self):
+        '''
+        Throttles are pickled by their settings.
+        '''
+        throttle = Throttle(1000, 10, 2, 5, 'idle')
+        copy = pickle.loads(pickle.dumps(throttle))
+        assert copy == throttle
+        assert hash(copy) == hash(throttle)
+        assert copy != Throttle(1000, 10, 2, 5)
+
+    def test_split(self):
+        '''
+        Splitting a throttle divides its rates.
+        '''
+        throttle = Throttle(1000, 10, 2, 5, 'idle')
+        assert throttle.split(4) == Throttle(250, 2.5, 2, 5, 'idle')
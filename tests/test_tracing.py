@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+import threading
+
+from coba.tracing import Tracer
+
+
+class TestTracer:
+
+    def test_disabled(self):
+        '''
+        No spans are recorded while tracing is disabled.
+        '''
+        tracer = Tracer()
+        with tracer.span('foo'):
+            pass
+        assert len(tracer) == 0
+
+    def test_chrome_trace(self, temp_dir):
+        '''
+        Spans are exported in the Chrome trace format.
+        '''
+        tracer = Tracer()
+        tracer.enable()
+        with tracer.span('store.put', path='a'):
+            with tracer.span('store.hash'):
+                pass
+
+        def wait():
+            with tracer.span('queue.wait'):
+                pass
+
+        thread = threading.Thread(target=wait, name='worker')
+        thread.start()
+        thread.join()
+        tracer.disable()
+        with tracer.span('ignored'):
+            pass
+        path = temp_dir / 'trace.json'
+        tracer.write(path)
+        events = json.loads(path.read_text(encoding='utf-8'))['traceEvents']
+        spans = [event for event in events if event['ph'] == 'X']
+        assert [span['name'] for span in spans] == [
+            'store.hash', 'store.put', 'queue.wait']
+        hash_span, put_span, wait_span = spans
+        assert put_span['cat'] == 'store'
+        assert put_span['args'] == {'path': 'a'}
+        assert put_span['ts'] <= hash_span['ts']
+        assert hash_span['ts'] + hash_span['dur'] <= (put_span['ts']
+                                                      + put_span['dur'])
+        assert wait_span['tid'] != put_span['tid']
+        thread_names = {event['tid']: event['args']['name']
+                        for event in events if event['ph'] == 'M'}
+        assert thread_names[wait_span['tid']] == 'worker'
+
+    def test_max_spans(self):
+        '''
+        Only the newest spans are kept.
+        '''
+        tracer = Tracer(max_spans=2)
+        tracer.enable()
+        for name in 'abc':
+            with tracer.span(name):
+                pass
+        names = [event['name'] for event in tracer.to_dict()['traceEvents']
+                 if event['ph'] == 'X']
+        assert names == ['b', 'c']
+        tracer.clear()
+        assert len(tracer) == 0
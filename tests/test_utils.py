@@ -26,8 +26,9 @@ from pathlib import Path
 
 import pytest
 
-from coba.utils import (local_to_utc, make_path_absolute, parse_datetime,
-                        parse_file_size, utc_to_local)
+from coba.utils import (format_file_size, local_to_utc, make_path_absolute,
+                        parse_datetime, parse_duration, parse_file_size,
+                        utc_to_local)
 
 from .conftest import timezone, working_dir
 
@@ -134,3 +135,52 @@ class TestParseFileSize:
         ]:
             with pytest.raises(ValueError):
                 parse_file_size(s)
+
+
+class TestFormatFileSize:
+    def test_format_file_size(self):
+        '''
+        Format file sizes.
+        '''
+        for size, expected in [
+            (0, '0 B'),
+            (1023, '1023 B'),
+            (1024, '1.0 KiB'),
+            (1536, '1.5 KiB'),
+            (5 * 1024**2, '5.0 MiB'),
+            (1024**3 - 1, '1024.0 MiB'),
+            (3 * 1024**4, '3.0 TiB'),
+            (2048 * 1024**4, '2048.0 TiB'),
+        ]:
+            assert format_file_size(size) == expected
+
+
+class TestParseDuration:
+    def test_valid_inputs(self):
+        '''
+        Parse valid durations.
+        '''
+        for s, expected in [
+            ('0', datetime.timedelta()),
+            ('45', datetime.timedelta(seconds=45)),
+            ('3 s', datetime.timedelta(seconds=3)),
+            ('10m', datetime.timedelta(minutes=10)),
+            ('2 H', datetime.timedelta(hours=2)),
+            ('30 d', datetime.timedelta(days=30)),
+            ('1w', datetime.timedelta(weeks=1)),
+        ]:
+            assert parse_duration(s) == expected
+
+    def test_invalid_inputs(self):
+        '''
+        Parse invalid durations.
+        '''
+        for s in [
+            '',
+            'h',
+            '1.5 h',
+            '-1 d',
+            '2 hours',
+        ]:
+            with pytest.raises(ValueError):
+                parse_duration(s)
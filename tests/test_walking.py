@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+
+from coba.walking import walk_files
+
+
+class TestWalkFiles:
+
+    def test_walk(self, temp_dir):
+        '''
+        Walk a directory tree.
+        '''
+        for name in ['a', 'b/c', 'b/d/e', 'f/g/h']:
+            path = temp_dir / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(name)
+        (temp_dir / 'empty').mkdir()
+        os.symlink(str(temp_dir / 'a'), str(temp_dir / 'link'))
+        os.symlink(str(temp_dir / 'b'), str(temp_dir / 'dirlink'))
+        files = dict(walk_files(temp_dir, workers=3))
+        assert set(files) == {temp_dir / 'a', temp_dir / 'b' / 'c',
+                              temp_dir / 'b' / 'd' / 'e',
+                              temp_dir / 'f' / 'g' / 'h'}
+        assert files[temp_dir / 'b' / 'c'].st_size == 3
+
+    def test_ignored_directories(self, temp_dir):
+        '''
+        Ignored directories are not scanned.
+        '''
+        for name in ['a', 'b/c', 'b/d/e']:
+            path = temp_dir / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+        ignored = []
+
+        def is_directory_ignored(path):
+            ignored.append(path)
+            return path == str(temp_dir / 'b')
+
+        files = {path for path, _ in walk_files(temp_dir, is_directory_ignored)}
+        assert files == {temp_dir / 'a'}
+        assert ignored == [str(temp_dir / 'b')]
+
+    def test_not_recursive(self, temp_dir):
+        '''
+        Walk only the top directory.
+        '''
+        (temp_dir / 'sub').mkdir()
+        (temp_dir / 'sub' / 'b').touch()
+        (temp_dir / 'a').touch()
+        files = [path for path, _ in walk_files(temp_dir, recursive=False)]
+        assert files == [temp_dir / 'a']
+
+    def test_missing_directory(self, temp_dir):
+        '''
+        Walking a missing directory yields nothing.
+        '''
+        assert list(walk_files(temp_dir / 'missing')) == []
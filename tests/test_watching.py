@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2018 Florian Brucker (mail@florianbrucker.de).
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import shutil
+import sys
+import time
+from unittest import mock
+
+import pytest
+from watchdog.events import FileSystemEventHandler
+
+from coba.config import Config
+from coba.watching import _can_prune, create_observer
+
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith('linux'),
+                                reason='requires inotify')
+
+
+def _watched_directories(observer):
+    '''
+    Return the set of directories that have an inotify watch.
+    '''
+    directories = set()
+    for emitter in observer.emitters:
+        inotify = emitter._inotify._inotify
+        directories.update(os.fsdecode(path) for path, wd
+                           in inotify._wd_for_path.items() if wd != -1)
+    return directories
+
+
+class Observing:
+    '''
+    Context manager for an observer created via ``create_observer``.
+    '''
+    def __init__(self, path, config, handler):
+        self.observer = create_observer(config)
+        self.observer.schedule(handler, str(path), recursive=True)
+
+    def __enter__(self):
+        self.observer.start()
+        return self.observer
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.observer.stop()
+        self.observer.join()
+
+
+@linux_only
+class TestCreateObserver:
+
+    def test_watchdog_is_supported(self):
+        '''
+        The installed version of watchdog supports pruning.
+        '''
+        assert _can_prune()
+
+    def test_ignored_directories_are_not_watched(self, temp_dir):
+        '''
+        Existing ignored directories are not watched.
+        '''
+        for name in ['src/sub', 'build/sub', 'src/.git/objects']:
+            (temp_dir / name).mkdir(parents=True)
+        cfg = Config('x', 1, ['build/', '.*'])
+        with Observing(temp_dir, cfg, FileSystemEventHandler()) as observer:
+            time.sleep(0.5)
+            assert _watched_directories(observer) == {
+                str(temp_dir), str(temp_dir / 'src'),
+                str(temp_dir / 'src' / 'sub'),
+            }
+
+    def test_new_ignored_directories_are_not_watched(self, temp_dir):
+        '''
+        Ignored directories that are created later are not watched.
+        '''
+        cfg = Config('x', 1, ['build/'])
+        handler = mock.Mock(wraps=FileSystemEventHandler())
+        with Observing(temp_dir, cfg, handler) as observer:
+            (temp_dir / 'src' / 'build' / 'sub').mkdir(parents=True)
+            (temp_dir / 'src' / 'build' / 'sub' / 'test.txt').touch()
+            (temp_dir / 'src' / 'new').mkdir()
+            time.sleep(1)
+            assert _watched_directories(observer) == {
+                str(temp_dir), str(temp_dir / 'src'),
+                str(temp_dir / 'src' / 'new'),
+            }
+            (temp_dir / 'src' / 'new' / 'test.txt').write_text('foobar')
+            time.sleep(1)
+        paths = {event.src_path for (event,), _
+                 in handler.dispatch.call_args_list}
+        assert str(temp_dir / 'src' / 'new' / 'test.txt') in paths
+
+    def test_no_events_from_new_ignored_directories(self, temp_dir):
+        '''
+        No events arrive from ignored directories created later.
+        '''
+        template = temp_dir / 'template'
+        (template / 'sub').mkdir(parents=True)
+        for name in ['a.txt', 'b.txt', 'sub/c.txt']:
+            (template / name).write_text('foobar')
+        watched = temp_dir / 'watched'
+        (watched / 'src').mkdir(parents=True)
+        cfg = Config('x', 1, ['build/'])
+        handler = mock.Mock(wraps=FileSystemEventHandler())
+        with Observing(watched, cfg, handler):
+            shutil.copytree(str(template), str(watched / 'build'))
+            template.rename(watched / 'src' / 'build')
+            time.sleep(1)
+        paths = {event.src_path for (event,), _
+                 in handler.dispatch.call_args_list}
+        for ignored in [watched / 'build', watched / 'src' / 'build']:
+            prefix = str(ignored) + os.sep
+            assert not [path for path in paths if path.startswith(prefix)]